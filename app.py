@@ -1,15 +1,54 @@
 import streamlit as st
 import random
 import string
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta, date, time as dtime
 import time
+import os
+import pickle
+import threading
+import multiprocessing
+import heapq
+import bisect
+import math
+import json
+import hashlib
+import inspect
+import secrets
+import httpx
 from supabase import create_client, Client
-from collections import defaultdict
-from typing import List, Dict, Any, Optional
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
+from typing import List, Dict, Any, Optional, Iterator, Tuple, Mapping
+from dataclasses import dataclass, field, replace
+from types import MappingProxyType
+from functools import partial, wraps
+from contextlib import contextmanager
+import pandas as pd
 import plotly.graph_objects as go
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import planning_pool
+from planning_engine import (
+    DEFAULT_EXAM_SLOTS, PROF_DAILY_LIMIT, ExamWindow, PlanningSnapshot, StudentModuleMatrix, _ExamPlacer,
+    _ScheduleState, _exam_indexes, _exams_from_items, _items_from_exams, _multistart_runner, _parse_datetime,
+    _schedule_greedy, parse_exam_slots,
+)
+from code_outbox import CODE_MAX_CHECKS, CODE_TTL, CodeOutbox, SmtpConfig
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # analyses matricielles optionnelles : repli sur les dictionnaires Python
+    np = None
+    sparse = None
+try:
+    from ortools.sat.python import cp_model
+except ImportError:  # solveur exact optionnel : repli sur le moteur glouton
+    cp_model = None
+try:
+    import psycopg2
+    from pg_backend import PgBackend, PG_COPY_MIN_ROWS
+except ImportError:  # accès PostgreSQL direct optionnel : repli sur PostgREST
+    psycopg2 = None
 # ======================
 # CONFIG STREAMLIT
 # ======================
@@ -30,194 +69,1383 @@ if SERVICE_ROLE_KEY:
     except Exception as e:
         print("[supabase_admin] cannot create admin client:", e)
 is_real_db = False  
-tables_reset = ['etudiants','professeurs','chefs_departement','administrateurs','vice_doyens']
+
+# ======================
+# CACHE DONNÉES DE RÉFÉRENCE (partagé entre toutes les sessions)
+# ======================
+REFERENCE_TABLES = frozenset({"modules", "lieu_examen", "formations", "departements", "professeurs"})
+REF_CACHE_TTL_SECONDS = 300
+REF_CACHE_MAX_ENTRIES = 512
+
+class TTLCache:
+    """Thread-safe LRU cache with a per-entry TTL, tag-based invalidation and counters.
+    Each tag (here: table name) has a generation number bumped by invalidate(); a value
+    loaded before an invalidation is not stored afterwards (put() with a stale generation).
+    """
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Any, Tuple[float, str, Any]]" = OrderedDict()
+        self._generations: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def get(self, key) -> Tuple[bool, Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return False, None
+            expires_at, _, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def generation(self, tag: str) -> int:
+        with self._lock:
+            return self._generations[tag]
+
+    def put(self, key, value, tag: str, generation: Optional[int] = None):
+        with self._lock:
+            if generation is not None and generation != self._generations[tag]:
+                return
+            self._data[key] = (time.monotonic() + self.ttl_seconds, tag, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key) -> Tuple[bool, Any]:
+        """Remove and return (hit, value), atomically (expired entries are misses)."""
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] < time.monotonic():
+                return False, None
+            return True, item[2]
+
+    def invalidate(self, tag: str):
+        with self._lock:
+            self._generations[tag] += 1
+            stale = [k for k, (_, t, _) in self._data.items() if t == tag]
+            for k in stale:
+                del self._data[k]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            for tag in list(self._generations):
+                self._generations[tag] += 1
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio_pct": round(self.hits / total * 100, 1) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+@st.cache_resource
+def _get_ref_cache() -> TTLCache:
+    return TTLCache(REF_CACHE_TTL_SECONDS, REF_CACHE_MAX_ENTRIES)
+
+REF_CACHE = _get_ref_cache()
+
+def _ref_cache_key(table: str, select: str, eq: Optional[Dict[str, Any]], order: Optional[str],
+                   limit: Optional[int] = None, offset: Optional[int] = None,
+                   in_: Optional[Dict[str, List[Any]]] = None, gte: Optional[Dict[str, Any]] = None,
+                   lt: Optional[Dict[str, Any]] = None):
+    """Cache key for a read on a reference table, or None when the read must hit the DB."""
+    if table not in REFERENCE_TABLES or (eq and "password" in eq):
+        return None
+    frozen_eq = tuple(sorted((k, repr(v)) for k, v in eq.items())) if eq else ()
+    frozen_in = tuple(sorted((k, tuple(map(repr, v))) for k, v in in_.items())) if in_ else ()
+    frozen_range = (tuple(sorted((k, repr(v)) for k, v in (gte or {}).items())),
+                    tuple(sorted((k, repr(v)) for k, v in (lt or {}).items())))
+    return (table, select, frozen_eq, frozen_in, frozen_range, order, limit, offset)
+
+def ref_cache_stats() -> Dict[str, Any]:
+    return REF_CACHE.stats()
+
+# ======================
+# BACKEND POSTGRESQL DIRECT (optionnel : [postgres] dsn dans les secrets)
+# ======================
+PG_DSN = (st.secrets.get("postgres") or {}).get("dsn")
+
+@st.cache_resource
+def _get_pg_backend(dsn: str) -> Optional[PgBackend]:
+    try:
+        backend = PgBackend(dsn)
+        print("[postgres] connection pool created")
+        return backend
+    except Exception as e:
+        print("[postgres] cannot connect, PostgREST only:", e)
+        return None
+
+PG_BACKEND = _get_pg_backend(PG_DSN) if PG_DSN and psycopg2 is not None else None
+
+@contextmanager
+def db_transaction():
+    """Run several db_insert / db_update calls atomically with the PostgreSQL backend: inside
+    the block a failing write raises and everything is rolled back; cached reads of the
+    written tables are dropped once the transaction has ended. No-op over PostgREST, where
+    every request is its own transaction."""
+    if PG_BACKEND is None or PG_BACKEND.in_transaction():
+        yield
+        return
+    try:
+        with PG_BACKEND.transaction():
+            yield
+    finally:
+        for table in PG_BACKEND.take_written():
+            _after_write(table)
+
+# ======================
+# INSTRUMENTATION DES REQUÊTES (diagnostics admin)
+# ======================
+QUERY_LOG_MAX_RECORDS = 2000   # requêtes détaillées gardées par rerun (les suivantes sont seulement comptées)
+QUERY_HISTORY_MAX = 200        # reruns gardés, toutes sessions confondues
+N_PLUS_ONE_THRESHOLD = 3       # même forme de requête répétée dans un rerun -> N+1 probable
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+BYTES_SAMPLE_ROWS = 200        # lignes sérialisées pour estimer la taille d'un résultat
+
+def _latency_bucket(ms: float) -> str:
+    for bound in LATENCY_BUCKETS_MS:
+        if ms <= bound:
+            return f"≤{bound}ms"
+    return f">{LATENCY_BUCKETS_MS[-1]}ms"
+
+def _estimate_bytes(rows) -> int:
+    """JSON size of rows, extrapolated from the first BYTES_SAMPLE_ROWS rows."""
+    if not rows:
+        return 0
+    sample = rows[:BYTES_SAMPLE_ROWS]
+    size = len(json.dumps(sample, default=str))
+    return size if len(rows) <= len(sample) else int(size / len(sample) * len(rows))
+
+class QueryLog:
+    """db_* calls made by one script rerun: table, filters, rows, bytes and latency of each,
+    a latency histogram, and the query shapes repeated N_PLUS_ONE_THRESHOLD times or more
+    (same op / table / columns / filter keys with different values: N+1 candidates).
+    The log joins QUERY_HISTORY with its first query. Background jobs get their own log
+    (label job/<kind>, see _query_log); each record keeps its origin (rerun, fragment or job)."""
+    def __init__(self, session: str):
+        self.session = session
+        self.label = ""
+        self.user = ""
+        self.started_at = datetime.now()
+        self.records: List[Dict[str, Any]] = []
+        self.count = self.dropped = self.rows = self.bytes = 0
+        self.total_ms = 0.0
+        self.shapes: Dict[Tuple, int] = defaultdict(int)
+        self.histogram: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def record(self, op: str, table: str, shape: Tuple, filters: str, rows: int, nbytes: int, ms: float,
+               error: Optional[str] = None, origin: str = "rerun"):
+        with self._lock:
+            if not self._registered:
+                self._registered = True
+                QUERY_HISTORY.append(self)
+            self.count += 1
+            self.rows += rows
+            self.bytes += nbytes
+            self.total_ms += ms
+            self.shapes[shape] += 1
+            self.histogram[_latency_bucket(ms)] += 1
+            if len(self.records) >= QUERY_LOG_MAX_RECORDS:
+                self.dropped += 1
+                return
+            self.records.append({"n": self.count, "origine": origin, "op": op, "table": table, "filtres": filters,
+                                 "lignes": rows, "octets": nbytes, "ms": round(ms, 2), "erreur": error})
+
+    def n_plus_one(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            shapes = [(shape, n) for shape, n in self.shapes.items() if n >= N_PLUS_ONE_THRESHOLD]
+        return [{"op": op, "table": table, "colonnes": select, "filtres": ", ".join(keys), "appels": n}
+                for (op, table, select, keys), n in sorted(shapes, key=lambda it: -it[1])]
+
+    def summary(self) -> Dict[str, Any]:
+        return {"debut": self.started_at.strftime("%Y-%m-%d %H:%M:%S"), "session": self.session,
+                "page": self.label, "utilisateur": self.user, "requetes": self.count,
+                "ms_total": round(self.total_ms, 1), "lignes": self.rows, "octets": self.bytes,
+                "n_plus_1": len(self.n_plus_one())}
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            records, histogram = list(self.records), dict(self.histogram)
+        return dict(self.summary(), histogramme_ms={b: histogram.get(b, 0) for b in self.buckets()},
+                    n_plus_1_details=self.n_plus_one(), requetes_detail=records, requetes_non_detaillees=self.dropped)
+
+    @staticmethod
+    def buckets() -> List[str]:
+        return [f"≤{b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+
+@st.cache_resource
+def _get_query_history() -> "deque[QueryLog]":
+    return deque(maxlen=QUERY_HISTORY_MAX)
+
+QUERY_HISTORY = _get_query_history()
+QUERY_LOG = QueryLog(st.session_state.setdefault("_diag_session", secrets.token_hex(4)))   # ce rerun
+_QUERY_DEPTH = threading.local()   # appels db_* imbriqués : seul l'appel le plus externe est mesuré
+
+_FILTER_ARGS = ("eq", "in_", "gte", "lt", "order", "limit", "offset", "col", "params", "after")
+SENSITIVE_FILTER_KEYS = frozenset({"password", "email", "p_password", "p_email"})   # valeurs jamais journalisées
+
+def _sensitive_values(args: Dict[str, Any]) -> List[str]:
+    return [str(v) for name in _FILTER_ARGS if isinstance(args.get(name), dict)
+            for k, v in args[name].items() if k in SENSITIVE_FILTER_KEYS and v not in (None, "")]
+
+def _masked(values: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    return {k: "***" if k in SENSITIVE_FILTER_KEYS else v for k, v in values.items()} if values else values
+
+def _redact(text: Optional[str], hidden: List[str]) -> Optional[str]:
+    """text with every sensitive filter value masked (database errors may echo the query)."""
+    for value in hidden:
+        text = text.replace(value, "***") if text else text
+    return text
+
+def _query_filters(args: Dict[str, Any]) -> Tuple[Tuple[str, ...], str]:
+    """(filter keys, readable filters) of a db_* call; `in_` / id lists are shown by size only,
+    values of SENSITIVE_FILTER_KEYS not at all."""
+    keys, shown = [], []
+    for name in _FILTER_ARGS:
+        value = args.get(name)
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            for k, v in value.items():
+                keys.append(f"{name}.{k}")
+                if name == "in_":
+                    shown.append(f"{k} in [{len(v)}]")
+                else:
+                    shown.append(f"{k} {name} ***" if k in SENSITIVE_FILTER_KEYS else f"{k} {name} {v!r}")
+        else:
+            keys.append(name)
+            shown.append(f"{name}={value!r}")
+    for name in ("ids", "values"):   # db_update_many / db_select_in
+        if args.get("col") is not None and args.get(name) is not None and not isinstance(args[name], dict):
+            shown.append(f"{args['col']} in [{len(list(args[name]))}]")
+    text = ", ".join(shown)
+    return tuple(keys), text if len(text) <= 200 else text[:197] + "..."
+
+def _result_size(result, args: Dict[str, Any]) -> Tuple[int, int, Optional[str]]:
+    """(rows, estimated bytes, error) of a db_* result."""
+    if isinstance(result, tuple):             # fetch_pending_final_page
+        result = result[0]
+    if isinstance(result, list):
+        return len(result), _estimate_bytes(result), None
+    if isinstance(result, dict) and "error" in result:
+        if "inserted_count" in result:
+            payload = args.get("payload")
+            payload = payload if isinstance(payload, list) else [payload]
+            return result["inserted_count"], _estimate_bytes(payload), result["error"]
+        if "updated_count" in result:
+            return result["updated_count"], _estimate_bytes([args.get("values")]), result["error"]
+        data = result.get("data") or []
+        return len(data), _estimate_bytes(data), result["error"]
+    if isinstance(result, dict):              # db_get_one
+        return 1, _estimate_bytes([result]), None
+    return 0, 0, None
+
+def _query_log() -> Tuple[QueryLog, str]:
+    """(log, origin) for a db_* call. Inside a JOBS worker: the job's own log, created on its
+    first query and labelled job/<kind>, so work outliving its rerun is not billed to it.
+    Otherwise this rerun's QUERY_LOG; st.fragment reruns add to it and are marked "fragment"."""
+    job = JOBS.current()
+    if job is not None:
+        if job.query_log is None:
+            job.query_log = QueryLog(QUERY_LOG.session)
+            job.query_log.label, job.query_log.user = f"job/{job.kind}", job.owner or ""
+        return job.query_log, "job"
+    ctx = get_script_run_ctx()
+    return QUERY_LOG, "fragment" if ctx is not None and ctx.fragment_ids_this_run else "rerun"
+
+def instrumented(op: str):
+    """Record every outermost call of the decorated db_* helper in its log (see _query_log;
+    generators are measured until exhausted or closed)."""
+    def decorate(fn):
+        signature = inspect.signature(fn)
+
+        def describe(args, kwargs):
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            keys, filters = _query_filters(bound)
+            table = bound.get("table") or bound.get("fn") or op
+            return bound, table, (op, table, bound.get("select"), keys), filters, _sensitive_values(bound)
+
+        if inspect.isgeneratorfunction(fn):
+            @wraps(fn)
+            def gen_wrapper(*args, **kwargs):
+                if getattr(_QUERY_DEPTH, "n", 0):
+                    yield from fn(*args, **kwargs)
+                    return
+                bound, table, shape, filters, hidden = describe(args, kwargs)
+                log, origin = _query_log()
+                sample, n, error = [], 0, None
+                t0 = time.perf_counter()
+                try:
+                    for row in fn(*args, **kwargs):
+                        n += 1
+                        if len(sample) < BYTES_SAMPLE_ROWS:
+                            sample.append(row)
+                        yield row
+                except Exception as e:
+                    error = str(e)
+                    raise
+                finally:
+                    nbytes = int(_estimate_bytes(sample) * n / len(sample)) if sample else 0
+                    log.record(op, table, shape, filters, n, nbytes, (time.perf_counter() - t0) * 1000,
+                               _redact(error, hidden), origin)
+            return gen_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if getattr(_QUERY_DEPTH, "n", 0):
+                return fn(*args, **kwargs)
+            bound, table, shape, filters, hidden = describe(args, kwargs)
+            log, origin = _query_log()
+            _QUERY_DEPTH.n = 1
+            t0 = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                log.record(op, table, shape, filters, 0, 0, (time.perf_counter() - t0) * 1000,
+                           _redact(str(e), hidden), origin)
+                raise
+            finally:
+                _QUERY_DEPTH.n = 0
+            rows, nbytes, error = _result_size(result, bound)
+            log.record(op, table, shape, filters, rows, nbytes, (time.perf_counter() - t0) * 1000,
+                       _redact(error, hidden), origin)
+            return result
+        return wrapper
+    return decorate
 
 # ======================
 # DB HELPERS (Supabase wrappers)
 # ======================
+DB_PAGE_SIZE = 1000      # PostgREST (Supabase) renvoie au plus 1000 lignes par requête
+DB_PAGE_WORKERS = 4      # pages récupérées en parallèle
+
+class DBReadError(RuntimeError):
+    """Raised when a paged read cannot return the complete result set."""
+
+def _order_columns(select: str, order: Optional[str]) -> List[Tuple[str, bool]]:
+    """Return [(column, desc)] for `order` ("col" / "col.desc", comma separated).
+    Without explicit order, pages are ordered on `id` (select "*") or on every selected
+    column, so that .range() pagination is stable between requests."""
+    if order:
+        cols = []
+        for part in order.split(","):
+            bits = part.strip().split(".")
+            cols.append((bits[0], len(bits) > 1 and bits[1].lower() == "desc"))
+        return cols
+    plain = [c.strip() for c in select.split(",") if c.strip() and "(" not in c and ")" not in c]
+    if not plain or "*" in plain or "id" in plain:
+        return [("id", False)]
+    return [(c, False) for c in plain]
+
+def _select_query(table: str, select: str, eq: Optional[Dict[str, Any]], order_cols: List[Tuple[str, bool]],
+                  count: Optional[str] = None, in_: Optional[Dict[str, List[Any]]] = None,
+                  gte: Optional[Dict[str, Any]] = None, lt: Optional[Dict[str, Any]] = None):
+    q = supabase.table(table).select(select, count=count) if count else supabase.table(table).select(select)
+    if eq:
+        for k, v in eq.items():
+            q = q.eq(k, v)
+    if in_:
+        for k, values in in_.items():
+            q = q.in_(k, list(values))
+    for k, v in (gte or {}).items():
+        if v is not None:
+            q = q.gte(k, v)
+    for k, v in (lt or {}).items():
+        if v is not None:
+            q = q.lt(k, v)
+    for col, desc in order_cols:
+        q = q.order(col, desc=desc)
+    return q
+
+@instrumented("select_iter")
+def db_select_iter(table: str, select: str = "*", eq: Dict[str, Any] = None, order: Optional[str] = None,
+                   page_size: int = DB_PAGE_SIZE, max_workers: int = DB_PAGE_WORKERS,
+                   in_: Optional[Dict[str, List[Any]]] = None, gte: Optional[Dict[str, Any]] = None,
+                   lt: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """Yield every row of table using .range() pages (filters: eq, in_, gte, lt).
+    The first page also returns the exact row count; remaining pages are fetched by a bounded
+    thread pool and yielded in order. Raises DBReadError instead of returning partial data.
+    """
+    order_cols = _order_columns(select, order)
+    if PG_BACKEND is not None and PG_BACKEND.handles(select):
+        try:
+            yield from PG_BACKEND.select(table, select, eq, order_cols, in_=in_, gte=gte, lt=lt)
+        except psycopg2.Error as e:
+            raise DBReadError(f"table={table} : {e}") from e
+        return
+    try:
+        first = _select_query(table, select, eq, order_cols, count="exact", in_=in_, gte=gte, lt=lt).range(0, page_size - 1).execute()
+    except Exception as e:
+        raise DBReadError(f"table={table} page=0 : {e}") from e
+    rows = first.data or []
+    total = first.count if first.count is not None else len(rows)
+    if len(rows) < min(page_size, total):
+        # le serveur plafonne plus bas que page_size : on s'aligne sur sa taille de page
+        page_size = len(rows)
+    yield from rows
+    received = len(rows)
+    if received >= total or page_size == 0:
+        if received != total:
+            raise DBReadError(f"table={table} : {received}/{total} rows received")
+        return
+
+    def fetch(offset: int) -> List[Dict[str, Any]]:
+        try:
+            res = _select_query(table, select, eq, order_cols, in_=in_, gte=gte, lt=lt).range(offset, offset + page_size - 1).execute()
+            return res.data or []
+        except Exception as e:
+            raise DBReadError(f"table={table} offset={offset} : {e}") from e
+
+    offsets = iter(range(received, total, page_size))
+    pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        pending = deque(pool.submit(fetch, off) for off in islice(offsets, max(1, max_workers)))
+        while pending:
+            page = pending.popleft().result()
+            nxt = next(offsets, None)
+            if nxt is not None:
+                pending.append(pool.submit(fetch, nxt))
+            received += len(page)
+            yield from page
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    if received != total:
+        raise DBReadError(f"table={table} : {received}/{total} rows received (table modifiée pendant la lecture ?)")
+
+@instrumented("select_all")
+def db_select_all(table: str, select: str = "*", eq: Dict[str, Any] = None, order: Optional[str] = None,
+                  page_size: int = DB_PAGE_SIZE, max_workers: int = DB_PAGE_WORKERS,
+                  in_: Optional[Dict[str, List[Any]]] = None, gte: Optional[Dict[str, Any]] = None,
+                  lt: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Materialize db_select_iter: the whole (filtered) table, or DBReadError.
+    Reads on REFERENCE_TABLES are served from REF_CACHE when possible."""
+    key = _ref_cache_key(table, select, eq, order, in_=in_, gte=gte, lt=lt)
+    if key is None:
+        return list(db_select_iter(table, select, eq=eq, order=order, page_size=page_size,
+                                   max_workers=max_workers, in_=in_, gte=gte, lt=lt))
+    hit, rows = REF_CACHE.get(key)
+    if not hit:
+        gen = REF_CACHE.generation(table)
+        rows = list(db_select_iter(table, select, eq=eq, order=order, page_size=page_size,
+                                   max_workers=max_workers, in_=in_, gte=gte, lt=lt))
+        REF_CACHE.put(key, rows, table, gen)
+    return [dict(r) for r in rows]
+
+@instrumented("select")
 def db_select(table: str, select: str = "*", eq: Dict[str, Any] = None, order: Optional[str] = None,
-              limit: Optional[int] = None, offset: Optional[int] = None) -> List[Dict[str, Any]]:
-    """Return list of rows from supabase.table(table).select(select) with optional eq filters."""
+              limit: Optional[int] = None, offset: Optional[int] = None,
+              in_: Optional[Dict[str, List[Any]]] = None, gte: Optional[Dict[str, Any]] = None,
+              lt: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Return list of rows from supabase.table(table).select(select) with optional eq / in_ / gte / lt filters.
+    Without limit, every row is read through the paged reader (no 1000-row truncation).
+    """
     try:
-        q = supabase.table(table).select(select)
-        if eq:
-            for k, v in eq.items():
-                q = q.eq(k, v)
-        if order:
-            parts = order.split(".")
-            col = parts[0]
-            asc = True
-            if len(parts) > 1 and parts[1].lower() == "desc":
-                asc = False
-            q = q.order(col, ascending=asc)
-        if limit:
-            q = q.limit(limit)
-        if offset and limit:
-            q = q.range(offset, offset + (limit - 1))
-        res = q.execute()
-        return res.data or []
+        if not limit and not offset:
+            return db_select_all(table, select, eq=eq, order=order, in_=in_, gte=gte, lt=lt)
+        key = _ref_cache_key(table, select, eq, order, limit, offset, in_, gte, lt)
+        if key is not None:
+            hit, rows = REF_CACHE.get(key)
+            if hit:
+                return [dict(r) for r in rows]
+            gen = REF_CACHE.generation(table)
+        order_cols = _order_columns(select, order) if order else []
+        if PG_BACKEND is not None and PG_BACKEND.handles(select):
+            rows = PG_BACKEND.select(table, select, eq, order_cols, limit=limit, offset=offset, in_=in_, gte=gte, lt=lt)
+        else:
+            q = _select_query(table, select, eq, order_cols, in_=in_, gte=gte, lt=lt)
+            if limit and offset:
+                q = q.range(offset, offset + (limit - 1))
+            elif limit:
+                q = q.limit(limit)
+            res = q.execute()
+            rows = res.data or []
+        if key is not None:
+            REF_CACHE.put(key, rows, table, gen)
+            return [dict(r) for r in rows]
+        return rows
     except Exception as e:
-        print(f"[db_select] error table={table} select={select} eq={eq} : {e}")
+        print(f"[db_select] error table={table} select={select} eq={_masked(eq)} in_={in_} : "
+              f"{_redact(str(e), _sensitive_values({'eq': eq}))}")
         return []
 
+@instrumented("get_one")
 def db_get_one(table: str, select: str = "*", eq: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
     rows = db_select(table, select=select, eq=eq, limit=1)
     return rows[0] if rows else None
+
+@instrumented("rpc")
+def db_rpc(fn: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Call a SQL function (sql/kpi_functions.sql) and return its rows, or raise DBReadError
+    (function not installed, network error...) so callers can fall back to Python."""
+    params = params or {}
+    try:
+        if PG_BACKEND is not None:
+            return PG_BACKEND.call(fn, params)
+        return supabase.rpc(fn, params).execute().data or []
+    except Exception as e:
+        raise DBReadError(f"rpc {fn} : {e}") from e
+
+BATCH_IN_CHUNK = 200     # ids par filtre in_ (longueur d'URL PostgREST)
+
+@instrumented("select_in")
+def db_select_in(table: str, select: str, col: str, values, chunk: int = BATCH_IN_CHUNK,
+                 eq: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Rows whose `col` is in values: one paged `in_` read per chunk (DBReadError on failure)."""
+    values = list(dict.fromkeys(v for v in values if v is not None))
+    rows = []
+    for n in range(0, len(values), chunk):
+        rows.extend(db_select_all(table, select, eq=eq, in_={col: values[n:n + chunk]}))
+    return rows
+
+class BatchLoader:
+    """DataLoader-style id resolver, scoped to one script rerun.
+    Ids are queued with prime() and resolved per (table, select) with one `in_` query per
+    chunk of BATCH_IN_CHUNK ids; reference tables are resolved from their cached full
+    projection instead. Rows already resolved during the rerun are never fetched again.
+    """
+    def __init__(self):
+        self._rows: Dict[Tuple[str, str], Dict[Any, Optional[Dict[str, Any]]]] = defaultdict(dict)
+        self._pending: Dict[Tuple[str, str], set] = defaultdict(set)
+
+    @staticmethod
+    def _with_id(select: str) -> str:
+        cols = [c.strip() for c in select.split(",")]
+        return select if "*" in cols or "id" in cols else "id," + select
+
+    def prime(self, table: str, ids, select: str = "*"):
+        key = (table, self._with_id(select))
+        known = self._rows[key]
+        self._pending[key].update(i for i in ids if i is not None and i not in known)
+
+    def _dispatch(self, key: Tuple[str, str]):
+        ids = self._pending.pop(key, set())
+        if not ids:
+            return
+        table, select = key
+        known = self._rows[key]
+        if table in REFERENCE_TABLES:
+            by_id = {r['id']: r for r in db_select(table, select)}
+            for i in ids:
+                known[i] = by_id.get(i)
+            return
+        ordered = list(ids)
+        for n in range(0, len(ordered), BATCH_IN_CHUNK):
+            chunk = ordered[n:n + BATCH_IN_CHUNK]
+            for r in db_select(table, select, in_={"id": chunk}):
+                known[r['id']] = r
+            for i in chunk:
+                known.setdefault(i, None)
+
+    def load_many(self, table: str, ids, select: str = "*") -> Dict[Any, Dict[str, Any]]:
+        """Return {id: row} for the ids found in table."""
+        ids = list(ids)
+        self.prime(table, ids, select)
+        key = (table, self._with_id(select))
+        self._dispatch(key)
+        known = self._rows[key]
+        return {i: known[i] for i in ids if known.get(i) is not None}
+
+    def load(self, table: str, id_value: Any, select: str = "*") -> Optional[Dict[str, Any]]:
+        return self.load_many(table, [id_value], select).get(id_value)
+
+BATCH_LOADER = BatchLoader()
+DB_INSERT_CHUNK = 500     # lignes par requête d'insertion PostgREST
+DB_WRITE_RETRIES = 3      # tentatives par lot en cas d'erreur de connexion
+DB_RETRY_BACKOFF = 0.5    # secondes, doublées à chaque nouvelle tentative
+
+def _is_transient(exc: Exception) -> bool:
+    """Connection errors raised before the request reached the server (safe to resend)."""
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+@instrumented("insert")
 def db_insert(table: str, payload: Any) -> Dict[str, Any]:
     """Insert payload (dict or list) into table. Uses admin client if available for writes.
-    Returns dict {data, error, inserted_count}.
+    Returns dict {data, error, inserted_count, failed_chunks}.
+    - PostgreSQL backend: one transaction, execute_values (COPY from PG_COPY_MIN_ROWS rows, then
+      data is None); all or nothing.
+    - PostgREST: chunks of DB_INSERT_CHUNK rows, each retried on connection errors; a failed
+      chunk does not stop the others and is reported in failed_chunks (offset, size, error).
+    Cached reads of a reference table are invalidated once the write has been sent.
     """
+    rows = payload if isinstance(payload, list) else [payload]
     try:
+        if not rows:
+            return {"data": [], "error": None, "inserted_count": 0, "failed_chunks": []}
+        if PG_BACKEND is not None:
+            if len(rows) >= PG_COPY_MIN_ROWS:
+                return {"data": None, "error": None, "inserted_count": PG_BACKEND.copy_rows(table, rows),
+                        "failed_chunks": []}
+            data = PG_BACKEND.insert(table, rows)
+            return {"data": data, "error": None, "inserted_count": len(data), "failed_chunks": []}
+
         client = supabase_admin if supabase_admin is not None else supabase
-        res = client.table(table).insert(payload).execute()
-        err = getattr(res, "error", None)
-        data = getattr(res, "data", None)
-        inserted = len(data) if isinstance(data, list) else (1 if data else 0)
-        return {"data": data, "error": err, "inserted_count": inserted}
+        data, failed = [], []
+        for offset in range(0, len(rows), DB_INSERT_CHUNK):
+            chunk = rows[offset:offset + DB_INSERT_CHUNK]
+            for attempt in range(DB_WRITE_RETRIES):
+                try:
+                    res = client.table(table).insert(chunk).execute()
+                    data.extend(res.data or [])
+                    break
+                except Exception as e:
+                    if attempt + 1 < DB_WRITE_RETRIES and _is_transient(e):
+                        time.sleep(DB_RETRY_BACKOFF * 2 ** attempt)
+                        continue
+                    print(f"[db_insert] error table={table} chunk={offset}+{len(chunk)} : {e}")
+                    failed.append({"offset": offset, "size": len(chunk), "error": str(e)})
+                    break
+        err = None
+        if failed:
+            err = f"{sum(f['size'] for f in failed)}/{len(rows)} ligne(s) non insérée(s) : {failed[0]['error']}"
+        return {"data": data, "error": err, "inserted_count": len(rows) - sum(f['size'] for f in failed),
+                "failed_chunks": failed}
     except Exception as e:
-        print(f"[db_insert] error table={table} payload_size={len(payload) if isinstance(payload, list) else 1} : {e}")
-        return {"data": None, "error": str(e), "inserted_count": 0}
+        print(f"[db_insert] error table={table} payload_size={len(rows)} : {e}")
+        if PG_BACKEND is not None and PG_BACKEND.in_transaction():
+            raise   # db_transaction() : le bloc entier est annulé
+        return {"data": None, "error": str(e), "inserted_count": 0, "failed_chunks": []}
+    finally:
+        _after_write(table)
+
+@instrumented("update")
 def db_update(table: str, values: Dict[str, Any], eq: Dict[str, Any]) -> Dict[str, Any]:
     """Update table set values where eq filters apply."""
     try:
+        if PG_BACKEND is not None:
+            return {"data": PG_BACKEND.update(table, values, eq), "error": None}
         q = supabase.table(table).update(values)
         if eq:
             for k, v in eq.items():
                 q = q.eq(k, v)
         res = q.execute()
-        return {"data": res.data, "error": res.error}
+        return {"data": res.data, "error": getattr(res, "error", None)}
     except Exception as e:
-        print(f"[db_update] error table={table} values={values} eq={eq} : {e}")
+        print(f"[db_update] error table={table} values={_masked(values)} eq={_masked(eq)} : "
+              f"{_redact(str(e), _sensitive_values({'eq': eq, 'params': values}))}")
+        if PG_BACKEND is not None and PG_BACKEND.in_transaction():
+            raise   # db_transaction() : le bloc entier est annulé
         return {"data": None, "error": str(e)}
+    finally:
+        _after_write(table)
+
+@instrumented("update_many")
+def db_update_many(table: str, values: Dict[str, Any], col: str, ids, eq: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Set values on every row whose `col` is in ids (and matching eq).
+    Returns dict {error, updated_count, failed_chunks}.
+    - PostgreSQL backend: a single UPDATE ... WHERE col = ANY(ids), all or nothing.
+    - PostgREST: one request per chunk of BATCH_IN_CHUNK ids (URL length), counted server-side
+      without sending the rows back, retried on connection errors; failed chunks are reported.
+    """
+    ids = list(dict.fromkeys(i for i in ids if i is not None))
+    try:
+        if not ids:
+            return {"error": None, "updated_count": 0, "failed_chunks": []}
+        if PG_BACKEND is not None:
+            return {"error": None, "updated_count": len(PG_BACKEND.update(table, values, eq, in_={col: ids})),
+                    "failed_chunks": []}
+
+        client = supabase_admin if supabase_admin is not None else supabase
+        updated, failed = 0, []
+        for offset in range(0, len(ids), BATCH_IN_CHUNK):
+            chunk = ids[offset:offset + BATCH_IN_CHUNK]
+            for attempt in range(DB_WRITE_RETRIES):
+                try:
+                    q = client.table(table).update(values, count="exact", returning="minimal").in_(col, chunk)
+                    for k, v in (eq or {}).items():
+                        q = q.eq(k, v)
+                    updated += q.execute().count or 0
+                    break
+                except Exception as e:
+                    if attempt + 1 < DB_WRITE_RETRIES and _is_transient(e):
+                        time.sleep(DB_RETRY_BACKOFF * 2 ** attempt)
+                        continue
+                    print(f"[db_update_many] error table={table} chunk={offset}+{len(chunk)} : {e}")
+                    failed.append({"offset": offset, "size": len(chunk), "error": str(e)})
+                    break
+        err = None
+        if failed:
+            err = f"{sum(f['size'] for f in failed)}/{len(ids)} id(s) non mis à jour : {failed[0]['error']}"
+        return {"error": err, "updated_count": updated, "failed_chunks": failed}
+    except Exception as e:
+        print(f"[db_update_many] error table={table} values={_masked(values)} ids={len(ids)} : "
+              f"{_redact(str(e), _sensitive_values({'params': values}))}")
+        if PG_BACKEND is not None and PG_BACKEND.in_transaction():
+            raise   # db_transaction() : le bloc entier est annulé
+        return {"error": str(e), "updated_count": 0, "failed_chunks": []}
+    finally:
+        _after_write(table)
+
+def _after_write(table: str):
+    """Write-through hook: drop cached reads of table and bump the planning data version."""
+    if PG_BACKEND is not None and PG_BACKEND.in_transaction():
+        PG_BACKEND.defer_write(table)   # après le COMMIT (voir db_transaction)
+        return
+    if table in REFERENCE_TABLES:
+        REF_CACHE.invalidate(table)
+    if table in IDENTITY_TABLE_NAMES:
+        REF_CACHE.invalidate(IDENTITY_TAG)
+    if table in PLANNING_TABLES:
+        PLANNING_STORE.bump_version()
 
 # ======================
-# FONCTION ENVOI EMAIL
+# IDENTITÉS (connexion / mot de passe oublié)
 # ======================
-def send_email_code(to_email, subject, message):
-    code = ''.join(random.choices(string.digits, k=6))
-
-    sender_email = "inconu2004@gmail.com"
-    app_password = "gffb jryz igmf xnuq"
+IDENTITY_TABLES = (("Etudiant", "etudiants"), ("Professeur", "professeurs"), ("Chef", "chefs_departement"),
+                   ("Admin", "administrateurs"), ("Vice-doyen", "vice_doyens"))   # ordre de priorité
+IDENTITY_TABLE_NAMES = frozenset(t for _, t in IDENTITY_TABLES)
+IDENTITY_FUNCTION = "find_identity"   # sql/identity_lookup.sql
+IDENTITY_TAG = "identites"      # tag REF_CACHE : index email et absence de la fonction
+
+def _identity_rows(email: str, password: Optional[str]) -> List[Dict[str, Any]]:
+    return db_rpc(IDENTITY_FUNCTION, {"p_email": email, "p_password": password})
+
+def _identity_index() -> Dict[str, List[Dict[str, Any]]]:
+    """email -> [{role, table, id}] in priority order, from one id,email read per table.
+    Kept in REF_CACHE until an identity table is written (or the TTL expires); holds no passwords."""
+    key = (IDENTITY_TAG, "index")
+    hit, index = REF_CACHE.get(key)
+    if hit:
+        return index
+    gen = REF_CACHE.generation(IDENTITY_TAG)
+    index = defaultdict(list)
+    for role, table in IDENTITY_TABLES:
+        for row in db_select_iter(table, "id,email"):
+            if row.get('email'):
+                index[row['email']].append({'role': role, 'table': table, 'id': row['id']})
+    index = dict(index)
+    REF_CACHE.put(key, index, IDENTITY_TAG, gen)
+    return index
+
+def find_identities(email: str, password: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Accounts matching email (and password when given) as [{role, table, id}], in login
+    priority order. One call to the find_identity SQL function; without it, the cached email
+    index narrows the search to the owning table(s) (one primary-key lookup to check a password).
+    Raises DBReadError when the identity tables cannot be read."""
+    if not email:
+        return []
+    missing_key = (IDENTITY_TAG, "function_missing")
+    if not REF_CACHE.get(missing_key)[0]:
+        try:
+            return [{'role': r['role'], 'table': r['table_name'], 'id': r['user_id']}
+                    for r in _identity_rows(email, password)]
+        except Exception as e:
+            hidden = [v for v in (email, password) if v]
+            print(f"[identites] fonction {IDENTITY_FUNCTION} indisponible, index en mémoire : {_redact(str(e), hidden)}")
+            REF_CACHE.put(missing_key, True, IDENTITY_TAG)
+    candidates = _identity_index().get(email, [])
+    if password is None:
+        return list(candidates)
+    return [c for c in candidates
+            if db_select(c['table'], "id", eq={"id": c['id'], "password": password}, limit=1)]
 
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(message + f"\n\nCode : {code}", "plain"))
+# ======================
+# ENVOI EMAIL : OUTBOX DES CODES DE VÉRIFICATION
+# ======================
+SMTP_CONFIG = SmtpConfig.from_settings(st.secrets.get("smtp"))
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-        server.login(sender_email, app_password)
-        server.sendmail(sender_email, to_email, msg.as_string())
+@st.cache_resource
+def _get_code_outbox() -> CodeOutbox:
+    return CodeOutbox(SMTP_CONFIG)
 
-    return code
+OUTBOX = _get_code_outbox()
 
-# ======================
-# HELPERS: TEMPS & CODES
-# ======================
-def can_resend(last_time):
-    if last_time is None:
-        return True
-    return datetime.now() - last_time >= timedelta(minutes=1)
+def send_verification_code(email: str, purpose: str, subject: str, message: str) -> bool:
+    """Queue a new code for email (see CodeOutbox.request_code); False inside the resend interval."""
+    accepted, _ = OUTBOX.request_code(email, purpose, subject, message)
+    return accepted
 
-def code_is_valid(sent_time):
-    if sent_time is None:
-        return False
-    return datetime.now() - sent_time <= timedelta(minutes=3)
+@st.fragment(run_every=1.0)
+def _code_delivery_live(email: str, purpose: str):
+    entry = OUTBOX.status(email, purpose)
+    if entry is None or entry.status != "queued":
+        st.rerun()
+    st.info(f"⏳ Envoi du code à {email} en cours…")
+
+def show_code_status(email: str, purpose: str):
+    """Delivery state of the latest code: live while queued, then sent / failed / expired."""
+    entry = OUTBOX.status(email, purpose)
+    if entry is None:
+        st.warning("Aucun code en cours : renvoyez-en un.")
+    elif entry.status == "queued":
+        _code_delivery_live(email, purpose)
+    elif entry.status == "failed" and entry.checks >= CODE_MAX_CHECKS:
+        st.error(f"Code invalidé ({entry.error}) : renvoyez-en un.")
+    elif entry.status == "failed":
+        st.error(f"Échec de l'envoi du code à {email} : {entry.error}")
+    else:
+        st.success(f"Code envoyé à {email}")
+    if entry is not None and entry.expired:
+        st.error(f"⏳ Code expiré ({int(CODE_TTL.total_seconds() // 60)} minutes dépassées)")
 
 # ======================
 # UTIL: TEMPS & TABLES (UISAFE)
 # ======================
-def show_table_safe(rows, title=None):
-    """Affiche une table si rows non vide, sinon message."""
-    if not rows:
+RENDER_PAGE_SIZE = 200   # lignes envoyées au navigateur par page de tableau
+TABLE_FRAMES_KEPT = 6    # DataFrames gardés par session (_cached_frame)
+
+def rows_frame(rows) -> pd.DataFrame:
+    """List of dicts (or one dict) -> columnar frame. Object columns mixing several types are
+    turned into text so they convert to Arrow and sort consistently."""
+    df = pd.DataFrame.from_records(rows if isinstance(rows, list) else [rows])
+    for col in df.columns:
+        if df[col].dtype == object and df[col].dropna().map(type).nunique() > 1:
+            df[col] = df[col].map(lambda v: v if v is None else str(v))
+    return df
+
+def _cached_frame(rows, key: str) -> pd.DataFrame:
+    """rows_frame, reused across reruns while the same rows object is displayed under key.
+    Only rows kept in st.session_state hit (detect_*, kpi_top_profs, kpi_par_dept); tables
+    whose list is rebuilt on every rerun (etu_exams, prof_surv, chef_pending, final_val_table,
+    diagnostics...) always miss. The session keeps the TABLE_FRAMES_KEPT most recently shown frames."""
+    frames = st.session_state.setdefault("_table_frames", OrderedDict())
+    cached = frames.get(key)
+    if cached is None or cached[0] is not rows:
+        cached = frames[key] = (rows, rows_frame(rows))
+    frames.move_to_end(key)
+    while len(frames) > TABLE_FRAMES_KEPT:
+        frames.popitem(last=False)
+    return cached[1]
+
+def show_table_safe(rows, title=None, key: Optional[str] = None, page_size: int = RENDER_PAGE_SIZE):
+    """Affiche rows (liste de dicts) dans un st.dataframe (Arrow), sinon message.
+    Au-delà de page_size lignes : filtre par colonne, tri et pagination côté serveur, seule la
+    page affichée est envoyée au navigateur. `key` distingue les tableaux d'une même page."""
+    if rows is None or (isinstance(rows, list) and not rows):
         st.info("Aucun résultat.")
         return
-    st.table(rows if isinstance(rows, list) else [rows])
+    if title:
+        st.markdown(f"**{title}**")
+    key = key or "tbl_" + hashlib.md5(repr((title, sorted(rows[0] if isinstance(rows, list) else rows))).encode()).hexdigest()[:10]
+    df = _cached_frame(rows, key)
+    if len(df) <= page_size:
+        st.dataframe(df, hide_index=True)
+        return
+    cols = [str(c) for c in df.columns]
+    def first_page():
+        st.session_state[f"{key}_page"] = 1
+
+    c1, c2, c3, c4 = st.columns([2, 3, 2, 1])
+    filter_col = c1.selectbox("Filtrer", ["(toutes)"] + cols, key=f"{key}_fcol", on_change=first_page)
+    needle = c2.text_input("contient", key=f"{key}_fval", on_change=first_page)
+    sort_col = c3.selectbox("Trier par", ["(aucun)"] + cols, key=f"{key}_sort", on_change=first_page)
+    desc = c4.toggle("↓", key=f"{key}_desc", on_change=first_page)
+    view = df
+    if needle:
+        target = view if filter_col == "(toutes)" else view[[filter_col]]
+        mask = target.astype(str).apply(lambda s: s.str.contains(needle, case=False, regex=False)).any(axis=1)
+        view = view[mask]
+    if sort_col != "(aucun)":
+        try:
+            view = view.sort_values(sort_col, ascending=not desc, kind="stable")
+        except TypeError:
+            view = view.sort_values(sort_col, ascending=not desc, kind="stable", key=lambda s: s.astype(str))
+    pages = max(1, math.ceil(len(view) / page_size))
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages
+    page = st.number_input(f"Page (sur {pages})", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    st.dataframe(view.iloc[(page - 1) * page_size:page * page_size], hide_index=True)
+    st.caption(f"{len(view)} ligne(s) sur {len(df)} — page {page}/{pages}")
+
+def bulk_validate_controls(exams: List[Dict[str, Any]], label_of, values: Dict[str, Any], key: str,
+                           verb: str = "Valider", all_label: str = "tout le filtre"):
+    """Multi-select + "all filtered" actions over exams. Each action is one db_update_many call
+    (single UPDATE / one request per chunk of ids); the affected row count is shown after the rerun."""
+    done = st.session_state.pop(f"{key}_done", None)
+    if done is not None:
+        st.success(f"{done} examen(s) mis à jour.")
+    labels = {e['id']: label_of(e) for e in exams}
+    chosen = st.multiselect("Sélection", list(labels), format_func=labels.get, key=f"{key}_sel")
+    c1, c2 = st.columns(2)
+    ids = []
+    if c1.button(f"{verb} la sélection ({len(chosen)})", key=f"{key}_sel_btn", disabled=not chosen):
+        ids = chosen
+    if c2.button(f"{verb} {all_label} ({len(labels)})", key=f"{key}_all_btn", type="primary", disabled=not labels):
+        ids = list(labels)
+    if ids:
+        res = db_update_many("examens", values, "id", ids)
+        if res['error']:
+            st.error(f"{res['updated_count']}/{len(ids)} examen(s) mis à jour — erreur : {res['error']}")
+        else:
+            st.session_state[f"{key}_done"] = res['updated_count']
+            del st.session_state[f"{key}_sel"]
+            st.rerun()
 
 # ======================
-# CONFLICTS / KPIS / GENERATION / OPTIMISATION (Supabase-based implementations)
+# JOBS (calculs en arrière-plan)
 # ======================
-def _parse_datetime(val):
-    if val is None:
-        return None
-    if isinstance(val, str):
+JOB_WORKERS = 2              # calculs longs simultanés
+JOB_MAX_KEPT = 50            # tâches terminées conservées (résultats consultables plus tard)
+JOB_POLL_SECONDS = 1.0
+
+JOB_STATUS_LABELS = {
+    "queued": "⏳ en attente",
+    "running": "⚙️ en cours",
+    "done": "✅ terminée",
+    "failed": "❌ en erreur",
+    "cancelled": "🚫 annulée",
+}
+
+
+class JobCancelled(Exception):
+    """Raised by job_progress inside a job whose cancellation was requested."""
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    label: str
+    owner: Optional[str]
+    submitted_at: float
+    meta: Dict[str, Any] = field(default_factory=dict)
+    status: str = "queued"
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    progress: Dict[str, Any] = field(default_factory=dict)
+    result: Any = None
+    error: Optional[str] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    future: Any = None
+    query_log: Any = None      # QueryLog "job/<kind>", créé à la première requête du job
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class JobManager:
+    """Process-wide worker pool for long computations (generation, detection, KPIs,
+    optimisation). Jobs outlive the Streamlit rerun that submitted them: the UI keeps the job
+    id, polls `get(id).progress` and fetches `result` once finished. The job bound to a worker
+    thread is reachable through `current()`, so compute loops report progress and notice
+    cancellation with job_progress()."""
+
+    def __init__(self, max_workers: int = JOB_WORKERS, max_kept: int = JOB_MAX_KEPT):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.max_kept = max_kept
+
+    def submit(self, kind: str, fn, *args, label: Optional[str] = None, owner: Optional[str] = None,
+               meta: Optional[Dict[str, Any]] = None, **kwargs) -> str:
+        job = Job(id=''.join(random.choices(string.ascii_lowercase + string.digits, k=10)), kind=kind,
+                  label=label or kind, owner=owner, submitted_at=time.time(), meta=meta or {})
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        job.future = self._pool.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def _run(self, job: Job, fn, args, kwargs):
+        if job.cancel_event.is_set():
+            job.status, job.finished_at = "cancelled", time.time()
+            return
+        job.status, job.started_at = "running", time.time()
+        self._local.job = job
         try:
-            return datetime.fromisoformat(val)
-        except Exception:
-            try:
-                return datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
-            except Exception:
-                return None
-    if isinstance(val, datetime):
-        return val
-    return None
+            job.result = fn(*args, **kwargs)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            print(f"[jobs] {job.kind} {job.id} failed: {e}")
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = "failed"
+        finally:
+            self._local.job = None
+            job.finished_at = time.time()
+
+    def _prune(self):
+        finished = [j.id for j in self._jobs.values() if j.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_kept)]:
+            del self._jobs[job_id]
+
+    def current(self) -> Optional[Job]:
+        return getattr(self._local, "job", None)
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        return self._jobs.get(job_id) if job_id else None
+
+    def list(self, owner: Optional[str] = None, kind: Optional[str] = None) -> List[Job]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [j for j in reversed(jobs) if (owner is None or j.owner == owner) and (kind is None or j.kind == kind)]
+
+    def cancel(self, job_id: str) -> bool:
+        """Queued jobs never start; running ones stop at their next job_progress() call."""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            job.status, job.finished_at = "cancelled", time.time()
+        return True
+
+
+@st.cache_resource
+def _get_job_manager() -> JobManager:
+    return JobManager()
+
+JOBS = _get_job_manager()
+
+
+def job_progress(**progress):
+    """Report progress from the computation running as a job in this thread (no-op outside
+    jobs). Raises JobCancelled once the job's cancellation has been requested."""
+    job = JOBS.current()
+    if job is None:
+        return
+    job.progress.update(progress)
+    if job.cancel_event.is_set():
+        raise JobCancelled(job.id)
+
+
+def _job_progress_text(job: Job) -> str:
+    parts = [f"{JOB_STATUS_LABELS.get(job.status, job.status)} — {job.elapsed():.0f}s"]
+    for k, v in job.progress.items():
+        if k not in ("modules_places", "modules_total"):
+            parts.append(f"{k.replace('_', ' ')} : {v}")
+    return " · ".join(parts)
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def _job_live_panel(job_id: str):
+    """Refreshed every JOB_POLL_SECONDS without rerunning the page; reruns the whole app once
+    the job is finished so its owner can consume the result."""
+    job = JOBS.get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+    st.caption(f"{job.label} (tâche {job.id})")
+    total = job.progress.get("modules_total")
+    if total:
+        placed = job.progress.get("modules_places", 0)
+        st.progress(min(1.0, placed / total), text=f"{placed}/{total} modules placés")
+    st.write(_job_progress_text(job))
+    if st.button("Annuler", key=f"job_cancel_{job.id}", disabled=job.cancel_event.is_set()):
+        JOBS.cancel(job.id)
+
+
+def start_job(kind: str, fn, *args, label: str, meta: Optional[Dict[str, Any]] = None, **kwargs):
+    """Submit fn as a background job owned by the logged-in user; the session tracks the
+    latest job of each kind (st.session_state.jobs[kind])."""
+    st.session_state.setdefault("jobs", {})[kind] = JOBS.submit(
+        kind, fn, *args, label=label, owner=st.session_state.get("user_email"), meta=meta, **kwargs)
+
+
+def poll_job(kind: str) -> Optional[Job]:
+    """Tracked job of this kind: shows its live panel while it runs; once it is finished,
+    stops tracking it and returns it (result in job.result)."""
+    tracked = st.session_state.setdefault("jobs", {})
+    job = JOBS.get(tracked.get(kind))
+    if job is None:
+        tracked.pop(kind, None)
+        return None
+    if not job.finished:
+        _job_live_panel(job.id)
+        return None
+    del tracked[kind]
+    return job
+
+
+def show_recent_jobs(kinds: Tuple[str, ...]):
+    """Jobs of the logged-in user (they survive reruns and page reloads): status, and a button
+    to load the result of a finished one."""
+    jobs = [j for j in JOBS.list(owner=st.session_state.get("user_email")) if j.kind in kinds]
+    with st.expander(f"🗂️ Tâches en arrière-plan ({len(jobs)})"):
+        if not jobs:
+            st.write("Aucune tâche.")
+        for job in jobs:
+            cols = st.columns([4, 3, 1])
+            cols[0].write(f"**{job.label}** — {datetime.fromtimestamp(job.submitted_at).strftime('%H:%M:%S')}")
+            cols[1].write(job.error or _job_progress_text(job))
+            if job.status == "done" and cols[2].button("Charger", key=f"job_load_{job.id}"):
+                st.session_state.setdefault("jobs", {})[job.kind] = job.id
+                st.rerun()
+            elif not job.finished and cols[2].button("Annuler", key=f"job_stop_{job.id}"):
+                JOBS.cancel(job.id)
+                st.rerun()
 
-def detect_conflicts(start_date=None, end_date=None):
+# ======================
+# PLANNING SNAPSHOT (jeu de données partagé conflits / KPIs / génération)
+# ======================
+PLANNING_TABLES = frozenset({"examens", "modules", "inscriptions", "etudiants", "professeurs",
+                             "lieu_examen", "formations", "departements"})
+SNAPSHOT_MAX_AGE_SECONDS = 120
+SNAPSHOT_MAX_WINDOWS = 8
+EXAM_COLUMNS = "id,module_id,prof_id,salle_id,date_heure,duree_minutes"  # colonnes lues par l'analyse
+
+def exam_window(start_date: Optional[str] = None, end_date: Optional[str] = None) -> ExamWindow:
+    """"YYYY-MM-DD" dates (end day included) -> ISO bounds [gte, lt) pushed down as filters."""
+    gte = datetime.strptime(start_date, "%Y-%m-%d").isoformat() if start_date else None
+    lt = (datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)).isoformat() if end_date else None
+    return (gte, lt)
+
+def build_inscription_matrix(inscriptions) -> Optional[StudentModuleMatrix]:
+    if sparse is None or not inscriptions:
+        return None
+    student_pos: Dict[Any, int] = {}
+    module_pos: Dict[Any, int] = {}
+    rows = np.fromiter((student_pos.setdefault(i['etudiant_id'], len(student_pos)) for i in inscriptions),
+                       dtype=np.int32, count=len(inscriptions))
+    cols = np.fromiter((module_pos.setdefault(i['module_id'], len(module_pos)) for i in inscriptions),
+                       dtype=np.int32, count=len(inscriptions))
+    csr = sparse.csr_matrix((np.ones(len(inscriptions), dtype=np.int32), (rows, cols)),
+                            shape=(len(student_pos), len(module_pos)))
+    return StudentModuleMatrix(csr=csr, student_ids=list(student_pos), module_pos=MappingProxyType(module_pos))
+
+def build_planning_snapshot(exams, inscriptions, modules, students, profs, rooms, formations, departements,
+                            version: int = 0, window: ExamWindow = (None, None)) -> PlanningSnapshot:
+    """Build a PlanningSnapshot (and its indexes) from already fetched row lists."""
+    module_students = defaultdict(list)
+    for ins in inscriptions:
+        module_students[ins['module_id']].append(ins['etudiant_id'])
+    return PlanningSnapshot(
+        version=version,
+        loaded_at=time.monotonic(),
+        inscriptions=tuple(inscriptions),
+        modules=MappingProxyType({m['id']: m for m in modules}),
+        students=MappingProxyType({x['id']: x for x in students}),
+        profs=MappingProxyType({p['id']: p for p in profs}),
+        rooms=MappingProxyType({r['id']: r for r in rooms}),
+        formations=MappingProxyType({f['id']: f for f in formations}),
+        departements=MappingProxyType({d['id']: d for d in departements}),
+        module_students=MappingProxyType({k: tuple(v) for k, v in module_students.items()}),
+        module_ins_count=MappingProxyType({k: len(v) for k, v in module_students.items()}),
+        window=window,
+        inscription_matrix=build_inscription_matrix(inscriptions),
+        **_exam_indexes(exams),
+    )
+
+def snapshot_with_exams(snap: PlanningSnapshot, exams, window: Optional[ExamWindow] = None) -> PlanningSnapshot:
+    """Copy of snap with another exam list (exam indexes rebuilt, other tables shared)."""
+    return replace(snap, window=snap.window if window is None else window, **_exam_indexes(exams))
+
+def restrict_snapshot(snap: PlanningSnapshot, window: ExamWindow) -> PlanningSnapshot:
+    """Limit snap to the exams inside window, in memory (no DB access)."""
+    gte, lt = window
+    if snap.window == window or (gte is None and lt is None):
+        return snap
+    lo = _parse_datetime(gte) if gte else None
+    hi = _parse_datetime(lt) if lt else None
+    kept = [e for e in snap.exams
+            if (dt := snap.exam_dt.get(e.get('id'))) and (lo is None or dt >= lo) and (hi is None or dt < hi)]
+    return snapshot_with_exams(snap, kept, window)
+
+def load_planning_snapshot(version: int = 0, window: ExamWindow = (None, None)) -> PlanningSnapshot:
+    """Fetch every planning table once (paged reads, DBReadError on failure).
+    The exam window and column projection are pushed down to PostgREST."""
+    gte, lt = window
+    return build_planning_snapshot(
+        exams=db_select_all("examens", EXAM_COLUMNS, gte={"date_heure": gte}, lt={"date_heure": lt}),
+        inscriptions=db_select_all("inscriptions", "etudiant_id,module_id"),
+        modules=db_select_all("modules", "id,nom,formation_id"),
+        students=db_select_all("etudiants", "id,nom,prenom,email,formation_id"),
+        profs=db_select_all("professeurs", "id,nom,email,dept_id"),
+        rooms=db_select_all("lieu_examen", "id,nom,capacite"),
+        formations=db_select_all("formations", "id,nom,dept_id"),
+        departements=db_select_all("departements", "id,nom"),
+        version=version,
+        window=window,
+    )
+
+class PlanningStore:
+    """Process-wide holder of the current PlanningSnapshot per exam window.
+    Writes through db_insert/db_update bump `version`; get() reloads when the snapshot is
+    older than the current version or than max_age (changes made outside the app).
+    Loading is single-flight: concurrent sessions wait for one load instead of starting their own.
+    """
+    def __init__(self, max_windows: int = SNAPSHOT_MAX_WINDOWS):
+        self.version = 0
+        self.max_windows = max_windows
+        self._snapshots: "OrderedDict[ExamWindow, PlanningSnapshot]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def bump_version(self):
+        with self._lock:
+            self.version += 1
+
+    def _fresh(self, window: ExamWindow, max_age: float) -> Optional[PlanningSnapshot]:
+        with self._lock:
+            snap = self._snapshots.get(window)
+            if snap is not None and snap.version == self.version and snap.age_seconds() <= max_age:
+                self._snapshots.move_to_end(window)
+                return snap
+            return None
+
+    def get(self, window: ExamWindow = (None, None), max_age: float = SNAPSHOT_MAX_AGE_SECONDS) -> PlanningSnapshot:
+        snap = self._fresh(window, max_age)
+        if snap is not None:
+            return snap
+        with self._load_lock:
+            snap = self._fresh(window, max_age)
+            if snap is not None:
+                return snap
+            with self._lock:
+                version = self.version
+            snap = load_planning_snapshot(version, window)
+            with self._lock:
+                self._snapshots[window] = snap
+                self._snapshots.move_to_end(window)
+                while len(self._snapshots) > self.max_windows:
+                    self._snapshots.popitem(last=False)
+            return snap
+
+@st.cache_resource
+def _get_planning_store() -> PlanningStore:
+    return PlanningStore()
+
+PLANNING_STORE = _get_planning_store()
+
+def get_planning_snapshot(window: ExamWindow = (None, None),
+                          max_age: float = SNAPSHOT_MAX_AGE_SECONDS) -> PlanningSnapshot:
+    return PLANNING_STORE.get(window, max_age)
+
+# ======================
+# CONFLICTS / KPIS / GENERATION / OPTIMISATION (Supabase-based implementations)
+# ======================
+def _overlap_pairs(items) -> List[Tuple[Any, Any]]:
+    """Sweep-line over [(start, end, ref)]: return every (ref_a, ref_b) whose [start, end)
+    intervals overlap, in O(n log n + k). Active intervals sit in a heap keyed on end."""
+    pairs = []
+    active = []  # (end, start, ref)
+    for start, end, ref in sorted(items, key=lambda it: (it[0], it[1])):
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, a_start, a_ref in active:
+            if end > a_start:  # an empty interval only overlaps intervals that started before it
+                pairs.append((a_ref, ref))
+        heapq.heappush(active, (end, start, ref))
+    return pairs
+
+def _multi_exam_student_days(snap: PlanningSnapshot) -> List[Tuple[int, date, int]]:
+    """(matrix row, day, nb_exams) for every student with more than one exam on a day, from one
+    sparse product: (students x modules) @ (modules x days) gives every per-student per-day count."""
+    mat = snap.inscription_matrix
+    day_pos: Dict[date, int] = {}
+    rows, cols = [], []
+    for e in snap.exams:
+        col = mat.module_pos.get(e.get('module_id'))
+        dt = snap.exam_dt.get(e.get('id'))
+        if col is None or not dt:
+            continue
+        rows.append(col)
+        cols.append(day_pos.setdefault(dt.date(), len(day_pos)))
+    if not rows:
+        return []
+    module_day = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                   shape=(len(mat.module_pos), len(day_pos)))
+    counts = (mat.csr @ module_day).tocoo()
+    over = counts.data > 1
+    days = list(day_pos)
+    return [(i, days[j], int(n))
+            for i, j, n in zip(counts.row[over].tolist(), counts.col[over].tolist(), counts.data[over].tolist())]
+
+def _student_day_overlaps(snap: PlanningSnapshot, busy_days, intervals) -> Iterator[Tuple[Any, date, int, int]]:
+    """(etudiant_id, day, pos1, pos2) for overlapping exams, swept only over the student-days
+    the sparse product found with more than one exam (`busy_days`)."""
+    mat = snap.inscription_matrix
+    module_ids = list(mat.module_pos)   # colonne -> module id
+    by_day_module = defaultdict(list)   # (jour, module_id) -> [(début, fin, pos)]
+    for start, end, pos, e in intervals.values():
+        by_day_module[(start.date(), e.get('module_id'))].append((start, end, pos))
+    indptr, indices = mat.csr.indptr, mat.csr.indices
+    for row, day, _ in busy_days:
+        items = [it for c in indices[indptr[row]:indptr[row + 1]].tolist()
+                 for it in by_day_module.get((day, module_ids[c]), ())]
+        for p1, p2 in _overlap_pairs(items):
+            yield mat.student_ids[row], day, min(p1, p2), max(p1, p2)
+
+def detect_conflicts(start_date=None, end_date=None, snapshot: Optional[PlanningSnapshot] = None):
     """
     Detect conflicts using Supabase data and Python logic.
+    Only exams inside [start_date, end_date] are analysed; the window is pushed down to the DB,
+    or applied in memory when a wider `snapshot` is passed in.
     Returns dict with keys:
       - etudiants_1parjour
       - profs_3parjour
       - salles_capacite
       - surveillances_par_prof
       - conflits_par_dept
+      - chevauchements (pairs of overlapping exams sharing a room and/or a prof)
+      - etudiants_chevauchement (pairs of overlapping exams of one student)
     """
     conflicts = {
         'etudiants_1parjour': [],
         'profs_3parjour': [],
         'salles_capacite': [],
         'surveillances_par_prof': [],
-        'conflits_par_dept': []
+        'conflits_par_dept': [],
+        'chevauchements': [],
+        'etudiants_chevauchement': []
     }
 
-    # fetch tables
-    exams = db_select("examens", "*")
-    modules = {m['id']: m for m in db_select("modules", "id,nom,formation_id")}
-    inscriptions = db_select("inscriptions", "etudiant_id,module_id")
-    students = {s['id']: s for s in db_select("etudiants", "id,nom,prenom,email,formation_id")}
-    profs = {p['id']: p for p in db_select("professeurs", "id,nom,email,dept_id")}
-    rooms = {r['id']: r for r in db_select("lieu_examen", "id,nom,capacite")}
-    formations = {f['id']: f for f in db_select("formations", "id,nom,dept_id")}
-    departements = {d['id']: d for d in db_select("departements", "id,nom")}
-
-    # Build indices
-    exams_by_id = {}
-    for e in exams:
-        eid = e.get('id')
-        e_parsed = dict(e)
-        e_parsed['date_heure_dt'] = _parse_datetime(e_parsed.get('date_heure'))
-        exams_by_id[eid] = e_parsed
+    window = exam_window(start_date, end_date)
+    snap = restrict_snapshot(snapshot, window) if snapshot else get_planning_snapshot(window)
+    job_progress(etape="analyse des conflits")
+    exams = snap.exams
+    inscriptions = snap.inscriptions
+    profs = snap.profs
+    rooms = snap.rooms
+    departements = snap.departements
+    exam_dt = snap.exam_dt
 
     # 1) Students >1 exam per day
-    stud_exams_by_day = defaultdict(lambda: defaultdict(list))  # student_id -> date -> [exam_ids]
-    module_to_exams = defaultdict(list)
-    for e in exams:
-        mid = e.get('module_id')
-        module_to_exams[mid].append(e.get('id'))
-    for ins in inscriptions:
-        sid = ins.get('etudiant_id')
-        mid = ins.get('module_id')
-        exam_ids = module_to_exams.get(mid, [])
-        for eid in exam_ids:
-            e = exams_by_id.get(eid)
-            if not e or not e.get('date_heure_dt'):
-                continue
-            day = e['date_heure_dt'].date()
-            stud_exams_by_day[sid][day].append(eid)
-    for sid, days in stud_exams_by_day.items():
-        for day, lst in days.items():
-            if len(lst) > 1:
-                conflicts['etudiants_1parjour'].append({
-                    'etudiant_id': sid,
-                    'jour': str(day),
-                    'nb_exams': len(lst)
-                })
+    busy_days = None
+    if snap.inscription_matrix is not None:
+        busy_days = _multi_exam_student_days(snap)
+        student_ids = snap.inscription_matrix.student_ids
+        conflicts['etudiants_1parjour'] = [{'etudiant_id': student_ids[row], 'jour': str(day), 'nb_exams': n}
+                                           for row, day, n in busy_days]
+    else:
+        stud_exams_by_day = defaultdict(lambda: defaultdict(list))  # student_id -> date -> [exam_ids]
+        for ins in inscriptions:
+            sid = ins.get('etudiant_id')
+            mid = ins.get('module_id')
+            for eid in snap.module_exams.get(mid, ()):
+                dt = exam_dt.get(eid)
+                if not dt:
+                    continue
+                stud_exams_by_day[sid][dt.date()].append(eid)
+        for sid, days in stud_exams_by_day.items():
+            for day, lst in days.items():
+                if len(lst) > 1:
+                    conflicts['etudiants_1parjour'].append({
+                        'etudiant_id': sid,
+                        'jour': str(day),
+                        'nb_exams': len(lst)
+                    })
 
     # 2) Profs >3 exams per day
     profs_by_day = defaultdict(lambda: defaultdict(int))  # prof_id -> date -> count
     for e in exams:
         pid = e.get('prof_id')
-        dt = _parse_datetime(e.get('date_heure'))
+        dt = exam_dt.get(e.get('id'))
         if pid and dt:
             profs_by_day[pid][dt.date()] += 1
     for pid, days in profs_by_day.items():
@@ -226,9 +1454,7 @@ def detect_conflicts(start_date=None, end_date=None):
                 conflicts['profs_3parjour'].append({'prof_id': pid, 'jour': str(day), 'nb_exams': cnt})
 
     # 3) Room capacity: count unique students per exam (via inscriptions on module)
-    module_ins_counts = defaultdict(int)
-    for ins in inscriptions:
-        module_ins_counts[ins['module_id']] += 1
+    module_ins_counts = snap.module_ins_count
     for e in exams:
         mid = e.get('module_id')
         eid = e.get('id')
@@ -255,97 +1481,234 @@ def detect_conflicts(start_date=None, end_date=None):
         })
     conflicts['surveillances_par_prof'] = surveillances
 
-    # 5) Conflicts per department: overlap same day and overlapping time & same room or same prof
+    # 5) Overlaps: same day, overlapping time & same room or same prof (sweep-line per group)
+    intervals = {}
+    for pos, e in enumerate(exams):
+        dt = exam_dt.get(e.get('id'))
+        if dt:
+            intervals[e.get('id')] = (dt, dt + timedelta(minutes=int(e.get('duree_minutes') or 0)), pos, e)
+    pair_motifs = defaultdict(set)  # (pos1, pos2) -> {"salle", "prof"}
+    for motif, col in (("salle", 'salle_id'), ("prof", 'prof_id')):
+        groups = defaultdict(list)
+        for start, end, pos, e in intervals.values():
+            if e.get(col) is not None:
+                groups[(start.date(), e.get(col))].append((start, end, pos))
+        for items in groups.values():
+            for p1, p2 in _overlap_pairs(items):
+                pair_motifs[(min(p1, p2), max(p1, p2))].add(motif)
     dept_conflict_counts = defaultdict(int)
-    exam_list = list(exams_by_id.values())
-    for i in range(len(exam_list)):
-        e1 = exam_list[i]
-        dt1 = e1.get('date_heure_dt')
-        dur1 = int(e1.get('duree_minutes') or 0)
-        if not dt1:
-            continue
-        end1 = dt1 + timedelta(minutes=dur1)
-        for j in range(i+1, len(exam_list)):
-            e2 = exam_list[j]
-            dt2 = e2.get('date_heure_dt')
-            dur2 = int(e2.get('duree_minutes') or 0)
-            if not dt2:
-                continue
-            if dt1.date() != dt2.date():
-                continue
-            end2 = dt2 + timedelta(minutes=dur2)
-            overlap = not (end1 <= dt2 or end2 <= dt1)
-            if not overlap:
-                continue
-            same_room = (e1.get('salle_id') is not None and e1.get('salle_id') == e2.get('salle_id'))
-            same_prof = (e1.get('prof_id') is not None and e1.get('prof_id') == e2.get('prof_id'))
-            if same_room or same_prof:
-                prof_id = e1.get('prof_id')
-                if prof_id and profs.get(prof_id):
-                    dept_id = profs[prof_id].get('dept_id')
-                    dept_conflict_counts[dept_id] += 1
+    for (p1, p2), motifs in sorted(pair_motifs.items()):
+        e1, e2 = exams[p1], exams[p2]
+        conflicts['chevauchements'].append({
+            'jour': str(exam_dt[e1.get('id')].date()),
+            'examen_id_1': e1.get('id'),
+            'examen_id_2': e2.get('id'),
+            'motif': "+".join(sorted(motifs)),
+            'salle_id': e1.get('salle_id') if "salle" in motifs else None,
+            'prof_id': e1.get('prof_id') if "prof" in motifs else None,
+        })
+        prof_id = e1.get('prof_id')
+        if prof_id and profs.get(prof_id):
+            dept_conflict_counts[profs[prof_id].get('dept_id')] += 1
     for dept_id, cnt in dept_conflict_counts.items():
         conflicts['conflits_par_dept'].append({'departement': departements.get(dept_id, {}).get('nom'), 'conflits_estimes': cnt})
 
+    # 6) Students with two exams overlapping in time (same engine, grouped by student & day)
+    if busy_days is not None:
+        overlaps = _student_day_overlaps(snap, busy_days, intervals)
+    else:
+        overlaps = []
+        by_student_day = defaultdict(list)
+        for ins in inscriptions:
+            for eid in snap.module_exams.get(ins.get('module_id'), ()):
+                iv = intervals.get(eid)
+                if iv:
+                    by_student_day[(ins.get('etudiant_id'), iv[0].date())].append((iv[0], iv[1], iv[2]))
+        for (sid, day), items in by_student_day.items():
+            if len(items) < 2:
+                continue
+            for p1, p2 in _overlap_pairs(items):
+                overlaps.append((sid, day, min(p1, p2), max(p1, p2)))
+    for sid, day, p1, p2 in overlaps:
+        conflicts['etudiants_chevauchement'].append({
+            'etudiant_id': sid,
+            'jour': str(day),
+            'examen_id_1': exams[p1].get('id'),
+            'examen_id_2': exams[p2].get('id'),
+        })
+
     return conflicts
 
-def compute_kpis(start_date=None, end_date=None):
-    """Compute KPIs using Supabase data."""
-    kpis = {}
-    # total rooms
-    rooms = db_select("lieu_examen", "id,nom,capacite")
-    total_salles = len(rooms)
-    kpis['total_salles'] = total_salles
+@dataclass(frozen=True)
+class DeptSlice:
+    """The part of the planning one department (or a set of its formations) owns.
+    Only these formations' modules, exams and inscriptions are read."""
+    dept_id: Any
+    formations: Mapping[Any, Dict[str, Any]]        # formation id -> row
+    modules: Mapping[Any, Dict[str, Any]]           # module id -> row
+    exams: Tuple[Dict[str, Any], ...]
+    exams_by_id: Mapping[Any, Dict[str, Any]]
+    rooms: Mapping[Any, Dict[str, Any]]
+    module_ins_count: Mapping[Any, int]
+
+    def formation_of(self, exam: Dict[str, Any]) -> Any:
+        return self.modules.get(exam.get('module_id'), {}).get('formation_id')
+
+def load_dept_slice(dept_id: Any = None, formation_ids=None) -> DeptSlice:
+    """Read the slice of a department, optionally narrowed to formation_ids (DBReadError on failure)."""
+    eq = {"dept_id": dept_id} if dept_id is not None else None
+    formations = {f['id']: f for f in db_select_all("formations", "id,nom,dept_id", eq=eq)}
+    if formation_ids is not None:
+        wanted = set(formation_ids)
+        formations = {fid: f for fid, f in formations.items() if fid in wanted}
+    modules = {m['id']: m for m in db_select_in("modules", "id,nom,formation_id", "formation_id", formations)}
+    exams = db_select_in("examens", "*", "module_id", modules)
+    module_ins_count = defaultdict(int)
+    for ins in db_select_in("inscriptions", "module_id", "module_id", modules):
+        module_ins_count[ins['module_id']] += 1
+    return DeptSlice(
+        dept_id=dept_id,
+        formations=MappingProxyType(formations),
+        modules=MappingProxyType(modules),
+        exams=tuple(exams),
+        exams_by_id=MappingProxyType({e['id']: e for e in exams}),
+        rooms=MappingProxyType({r['id']: r for r in db_select_all("lieu_examen", "id,nom,capacite")}),
+        module_ins_count=MappingProxyType(dict(module_ins_count)),
+    )
+
+def detect_conflicts_scoped(scope: DeptSlice) -> Dict[Any, Dict[str, List[Dict[str, Any]]]]:
+    """Conflicts of a DeptSlice keyed by formation id: {formation_id: {'salles_capacite': [...]}}.
+    Same capacity rule as detect_conflicts; formations without conflicts are left out."""
+    by_formation = defaultdict(lambda: defaultdict(list))
+    for e in scope.exams:
+        room = scope.rooms.get(e.get('salle_id'))
+        if not room:
+            continue
+        cap = int(room.get('capacite') or 0)
+        inscrits = scope.module_ins_count.get(e.get('module_id'), 0)
+        if inscrits > cap:
+            by_formation[scope.formation_of(e)]['salles_capacite'].append({
+                'examen_id': e.get('id'),
+                'salle': room.get('nom'),
+                'capacite': cap,
+                'inscrits': inscrits
+            })
+    return {fid: dict(kinds) for fid, kinds in by_formation.items()}
+
+KPI_TOP_PROFS = 10
+
+def _dept_conflict_rates(departements, exams_per_dept, conflicts_per_dept) -> List[Dict[str, Any]]:
+    rows = []
+    for dept_id in set(exams_per_dept) | set(conflicts_per_dept):
+        n, c = exams_per_dept.get(dept_id, 0), conflicts_per_dept.get(dept_id, 0)
+        rows.append({'departement': departements.get(dept_id, {}).get('nom'), 'nb_examens': n,
+                     'conflits_estimes': c, 'taux_conflits_pct': round(c / n * 100, 1) if n else 0})
+    return sorted(rows, key=lambda r: (-r['taux_conflits_pct'], str(r['departement'])))
+
+def _kpis_server_side(window: ExamWindow, seances: ExamWindow) -> Dict[str, Any]:
+    """KPIs from the SQL aggregates of sql/kpi_functions.sql (a few dozen rows instead of the
+    whole schedule). Raises DBReadError when the functions are not installed."""
+    bounds = {"p_start": window[0], "p_end": window[1]}
+    job_progress(etape="agrégats SQL")
+    util = db_rpc("kpi_room_utilization", {"p_start": seances[0], "p_end": seances[1]})[0]
+    top = db_rpc("kpi_prof_minutes", {"p_start": seances[0], "p_end": seances[1], "p_limit": KPI_TOP_PROFS})
+    summary = dict(db_rpc("kpi_conflicts_summary", bounds)[0])
+    by_dept = db_rpc("kpi_conflicts_by_dept", bounds)
+    total_exams = summary.pop('nb_examens')
+    return {
+        'total_salles': util['total_salles'],
+        'nb_seances': util['nb_seances'],
+        'top_profs_minutes': [{'nom': r['nom'], 'email': r['email'], 'minutes_surv': r['minutes_surv']} for r in top],
+        'conflit_estime_ratio_pct': round((summary['salles_capacite'] / total_exams * 100) if total_exams > 0 else 0, 1),
+        'conflits_summary': summary,
+        'conflits_par_dept': [dict(r, taux_conflits_pct=float(r['taux_conflits_pct'])) for r in by_dept],
+        'source': "sql",
+    }
 
-    # nb seances in window or last 30 days
-    exams = db_select("examens", "*")
+def compute_kpis(start_date=None, end_date=None, snapshot: Optional[PlanningSnapshot] = None):
+    """Compute KPIs: server-side SQL aggregates when installed (see sql/kpi_functions.sql),
+    otherwise in Python on one PlanningSnapshot shared with detect_conflicts."""
     if start_date and end_date:
-        s_date = datetime.strptime(start_date, "%Y-%m-%d")
-        e_date = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
-        nb_seances = sum(1 for e in exams if (e.get('date_heure') and s_date <= _parse_datetime(e.get('date_heure')) < e_date))
-        periode_days = (e_date.date() - s_date.date()).days
+        window = exam_window(start_date, end_date)
+        seances = window
+        periode_days = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
     else:
-        cutoff = datetime.now() - timedelta(days=30)
-        nb_seances = sum(1 for e in exams if (e.get('date_heure') and _parse_datetime(e.get('date_heure')) >= cutoff))
+        # borne au jour près : la fenêtre reste identique (et en cache) toute la journée
+        window = exam_window((date.today() - timedelta(days=30)).strftime("%Y-%m-%d"), None)
+        seances = ((datetime.now() - timedelta(days=30)).isoformat(), None)
         periode_days = 30
-    kpis['nb_seances'] = nb_seances
+    kpis = None
+    if snapshot is None:
+        try:
+            kpis = _kpis_server_side(window, seances)
+        except DBReadError as e:
+            print("[kpis] agrégats SQL indisponibles, calcul Python :", e)
+    if kpis is None:
+        kpis = _kpis_python(window, seances, snapshot)
     kpis['periode_days'] = periode_days
-    possible_slots = total_salles * periode_days if total_salles else 0
-    taux_util = (nb_seances / possible_slots * 100) if possible_slots > 0 else 0
+    possible_slots = kpis['total_salles'] * periode_days
+    taux_util = (kpis['nb_seances'] / possible_slots * 100) if possible_slots > 0 else 0
     kpis['taux_utilisation_salles_pct'] = round(taux_util, 1)
+    return kpis
+
+def _kpis_python(window: ExamWindow, seances: ExamWindow, snapshot: Optional[PlanningSnapshot]) -> Dict[str, Any]:
+    kpis = {}
+    snap = restrict_snapshot(snapshot, window) if snapshot else get_planning_snapshot(window)
+    job_progress(etape="calcul des KPIs")
+    # total rooms
+    kpis['total_salles'] = len(snap.rooms)
+
+    # nb seances in the window (or the last 30 days)
+    exams = snap.exams
+    exam_dt = snap.exam_dt
+    s_date = _parse_datetime(seances[0])
+    e_date = _parse_datetime(seances[1]) if seances[1] else None
+
+    def in_seances(dt):
+        return dt is not None and s_date <= dt and (e_date is None or dt < e_date)
+
+    kpis['nb_seances'] = sum(1 for e in exams if in_seances(exam_dt.get(e.get('id'))))
 
     # top profs minutes
-    profs = db_select("professeurs", "id,nom,email")
+    profs = snap.profs.values()
     prof_minutes = defaultdict(int)
     for e in exams:
         pid = e.get('prof_id')
         dur = int(e.get('duree_minutes') or 0)
-        dt = _parse_datetime(e.get('date_heure'))
-        if pid and dur and dt:
-            if start_date and end_date:
-                if not (start_date <= dt.strftime("%Y-%m-%d") <= end_date):
-                    continue
-            else:
-                if dt < datetime.now() - timedelta(days=30):
-                    continue
+        if pid and dur and in_seances(exam_dt.get(e.get('id'))):
             prof_minutes[pid] += dur
     top = []
     for p in profs:
         pid = p['id']
         top.append({'nom': p.get('nom'), 'email': p.get('email'), 'minutes_surv': prof_minutes.get(pid, 0)})
-    top_sorted = sorted(top, key=lambda x: -x['minutes_surv'])[:10]
+    top_sorted = sorted(top, key=lambda x: -x['minutes_surv'])[:KPI_TOP_PROFS]
     kpis['top_profs_minutes'] = top_sorted
 
     # conflict estimate ratio
-    conflicts = detect_conflicts(start_date, end_date)
+    conflicts = detect_conflicts(snapshot=snap)
     nb_exams_with_conflicts = len(conflicts.get('salles_capacite', []))
     total_exams = len(exams)
     kpis['conflit_estime_ratio_pct'] = round((nb_exams_with_conflicts / total_exams * 100) if total_exams > 0 else 0, 1)
     kpis['conflits_summary'] = {
         'etudiants_1parjour': len(conflicts.get('etudiants_1parjour', [])),
         'profs_3parjour': len(conflicts.get('profs_3parjour', [])),
-        'salles_capacite': len(conflicts.get('salles_capacite', []))
+        'salles_capacite': len(conflicts.get('salles_capacite', [])),
+        'chevauchements': len(conflicts.get('chevauchements', [])),
+        'etudiants_chevauchement': len(conflicts.get('etudiants_chevauchement', []))
     }
+
+    # conflicts per department (pairs attributed to the prof of the first exam, as in detect_conflicts)
+    exams_per_dept, conflicts_per_dept = defaultdict(int), defaultdict(int)
+    for e in exams:
+        prof = snap.profs.get(e.get('prof_id'))
+        if prof and exam_dt.get(e.get('id')):
+            exams_per_dept[prof.get('dept_id')] += 1
+    for c in conflicts.get('chevauchements', []):
+        prof = snap.profs.get(snap.exams_by_id.get(c['examen_id_1'], {}).get('prof_id'))
+        if prof:
+            conflicts_per_dept[prof.get('dept_id')] += 1
+    kpis['conflits_par_dept'] = _dept_conflict_rates(snap.departements, exams_per_dept, conflicts_per_dept)
+    kpis['source'] = "python"
     return kpis
 
 # ======================
@@ -361,12 +1724,393 @@ def _get_dates_between(start_str, end_str):
         cur = cur + timedelta(days=1)
     return days
 
-def generate_timetable(start_date=None, end_date=None, force=False):
+def module_conflict_graph(module_students: Mapping[Any, Tuple[Any, ...]]) -> Dict[Any, Dict[Any, int]]:
+    """module id -> {neighbour module id: number of shared students}. Two adjacent modules can
+    never be examined on the same day."""
+    student_modules = defaultdict(set)
+    for mid, studs in module_students.items():
+        for sid in studs:
+            student_modules[sid].add(mid)
+    graph = {mid: {} for mid in module_students}
+    for mids in student_modules.values():
+        if len(mids) < 2:
+            continue
+        mids = list(mids)
+        for i, a in enumerate(mids):
+            ga = graph[a]
+            for b in mids[i + 1:]:
+                ga[b] = ga.get(b, 0) + 1
+                graph[b][a] = graph[b].get(a, 0) + 1
+    return graph
+
+
+def _schedule_dsatur(placer: _ExamPlacer, days: List[date]):
     """
-    Optimized Supabase-only greedy timetable generator.
-    - Prefetches modules, inscriptions, salles, profs, formations, existing exams.
-    - Performs scheduling in memory with minimal Python overhead.
-    - Persists with a single bulk insert (via db_insert).
+    Graph-colouring engine.
+    Phase 1: DSatur colours the module conflict graph with days (most saturated module first,
+    then highest degree, then largest enrollment; smallest day that no neighbour uses and that
+    still has room x slot places left).
+    Phase 2: each day places its modules (largest first) in slots/rooms/profs; modules that do
+    not fit, or got no colour, are retried on every day once all days are placed.
+    """
+    snap = placer.snap
+    module_ins_count = snap.module_ins_count
+    modules = snap.modules
+    graph = module_conflict_graph(snap.module_students)
+    empty = {}
+    day_capacity = len(snap.rooms) * len(placer.slot_times)
+    if snap.profs:
+        day_capacity = min(day_capacity, len(snap.profs) * PROF_DAILY_LIMIT)
+
+    # phase 1: DSatur (lazy heap: stale entries are skipped when their saturation changed)
+    job_progress(etape="coloration du graphe")
+    neighbour_days = {mid: set() for mid in modules}
+    colour = {}
+    day_load = [0] * len(days)
+    order = {mid: i for i, mid in enumerate(modules)}
+
+    def entry(mid):
+        return (-len(neighbour_days[mid]), -len(graph.get(mid, empty)), -module_ins_count.get(mid, 0),
+                order[mid], mid)
+
+    heap = [entry(mid) for mid in modules]
+    heapq.heapify(heap)
+    while heap:
+        neg_sat, _, _, _, mid = heapq.heappop(heap)
+        if mid in colour or -neg_sat != len(neighbour_days[mid]):
+            continue
+        taken = neighbour_days[mid]
+        d = next((i for i in range(len(days)) if i not in taken and day_load[i] < day_capacity), None)
+        colour[mid] = d
+        if d is None:
+            continue
+        day_load[d] += 1
+        for nb in graph.get(mid, empty):
+            if nb in neighbour_days and nb not in colour and d not in neighbour_days[nb]:
+                neighbour_days[nb].add(d)
+                heapq.heappush(heap, entry(nb))
+
+    # phase 2: rooms, slots and profs day by day
+    by_day = defaultdict(list)
+    for mid, d in colour.items():
+        by_day[d].append(mid)
+    by_size = lambda mid: (-module_ins_count.get(mid, 0), order[mid])
+    job_progress(etape="salles et surveillants")
+    scheduled, retry = [], list(by_day.pop(None, []))
+    for i, d in enumerate(days):
+        for mid in sorted(by_day.get(i, ()), key=by_size):
+            placed = placer.place(modules[mid], d)
+            if placed:
+                scheduled.append(placed)
+            else:
+                retry.append(mid)
+        job_progress(modules_places=len(scheduled))
+
+    placed, unscheduled = _place_anywhere(placer, [modules[mid] for mid in sorted(retry, key=by_size)], days)
+    scheduled.extend(placed)
+    return scheduled, unscheduled, {"colours": len(set(colour.values()) - {None})}
+
+
+def _place_anywhere(placer: _ExamPlacer, mods: List[Dict[str, Any]], days: List[date]):
+    """Second chance for modules an engine could not place: first day/slot that still fits."""
+    scheduled, unscheduled = [], []
+    for mod in mods:
+        for d in days:
+            placed = placer.place(mod, d)
+            if placed:
+                scheduled.append(placed)
+                break
+        else:
+            unscheduled.append(mod)
+    return scheduled, unscheduled
+
+
+CPSAT_TIME_LIMIT = 60.0      # secondes de calcul par défaut pour le solveur exact
+CPSAT_WORKERS = 8
+
+
+if cp_model is not None:
+    class _CpsatProgress(cp_model.CpSolverSolutionCallback):
+        """Job reporting while CP-SAT searches. The callbacks run in the solver's threads, where
+        job_progress() does not see the job, so the job is passed in: each improving solution is
+        reported (modules placed, bound) and the search stops once cancellation is requested."""
+        def __init__(self, job: Optional[Job], solver):
+            super().__init__()
+            self.job = job
+            self.solver = solver
+            self.solutions = 0
+
+        def on_solution_callback(self):
+            self.solutions += 1
+            if self.job is None:
+                return
+            self.job.progress.update(solutions=self.solutions, modules_places=int(self.ObjectiveValue()),
+                                     borne=int(self.BestObjectiveBound()))
+            if self.job.cancel_event.is_set():
+                self.StopSearch()
+
+        def on_bound(self, bound: float):
+            """best_bound_callback: reports the bound and checks cancellation between solutions."""
+            if self.job is None:
+                return
+            self.job.progress["borne"] = int(bound)
+            if self.job.cancel_event.is_set():
+                self.solver.StopSearch()
+
+
+def _schedule_cpsat(placer: _ExamPlacer, days: List[date], time_limit: float = CPSAT_TIME_LIMIT):
+    """
+    Exact engine (OR-Tools CP-SAT, local): x[m, d, s] = module m starts on day d in slot s;
+    maximises the number of scheduled modules under the generate_timetable constraints:
+    - one exam per student per day: one AtMostOne per distinct set of modules followed by a
+      student, per day;
+    - room capacity and exclusivity: for every (day, slot) and room capacity level, exams needing
+      at least that level <= rooms offering it (Hall's condition on nested capacities, so a
+      largest-first room assignment exists); exams larger than every room need the largest;
+    - prof daily limit and no double surveillance, on the prof pool (<= nb profs per slot,
+      <= nb profs x PROF_DAILY_LIMIT per day); designated profs are kept when free, as in greedy.
+    The greedy schedule is the hint; rooms and profs are assigned afterwards with the placer,
+    so the reported objective and gap are those of the final schedule (len(scheduled) against the
+    solver's bound, gap None when the final schedule beats that bound); `solver_objective` is the model's, `moved_after_solve` counts solved modules
+    that did not fit their solved slot. `time_limit` covers the whole engine: the search gets what
+    the model build and the greedy hint left of it.
+    Falls back to the greedy when ortools is missing or no solution is found within `time_limit`.
+    Inside a job, solutions are reported as they are found and a cancellation stops the search.
+    """
+    snap = placer.snap
+    stats = {"time_limit": time_limit}
+
+    def fallback(reason):
+        scheduled, unscheduled, _ = _schedule_greedy(placer, days, progress=job_progress)
+        stats["fallback"] = reason
+        return scheduled, unscheduled, stats
+
+    if cp_model is None:
+        return fallback("ortools non installé")
+
+    started = time.monotonic()
+    modules = snap.modules
+    module_ins_count = snap.module_ins_count
+    n_days, n_slots = len(days), len(placer.slot_times)
+    job_progress(etape="construction du modèle")
+    model = cp_model.CpModel()
+    x = {}                                          # (module, day, slot) -> start variable
+    module_day = defaultdict(list)                  # (module, day) -> start variables
+    active = defaultdict(list)                      # (day, slot) -> [(module, variable)] exams running
+    for mid in modules:
+        masks = placer.masks(placer.duration(mid))
+        for d in range(n_days):
+            for s in range(n_slots):
+                v = model.NewBoolVar(f"x_{mid}_{d}_{s}")
+                x[mid, d, s] = v
+                module_day[mid, d].append(v)
+                for t in range(n_slots):
+                    if masks[s] >> t & 1:
+                        active[d, t].append((mid, v))
+        model.AddAtMostOne(v for d in range(n_days) for v in module_day[mid, d])
+
+    # students: one exam per day for every distinct module set
+    student_modules = defaultdict(set)
+    for mid, studs in snap.module_students.items():
+        if mid in modules:
+            for sid in studs:
+                student_modules[sid].add(mid)
+    groups = {frozenset(mids) for mids in student_modules.values() if len(mids) > 1}
+    for group in groups:
+        for d in range(n_days):
+            model.AddAtMostOne(v for mid in group for v in module_day[mid, d])
+
+    # rooms: nested capacity levels (Hall), level 0 is room exclusivity
+    caps = placer.room_index.caps
+    levels = sorted(set(caps))
+    need = {mid: bisect.bisect_left(levels, min(module_ins_count.get(mid, 0), levels[-1]))
+            for mid in modules} if levels else {}
+    rooms_from = [len(caps) - bisect.bisect_left(caps, c) for c in levels]
+    n_profs = len(snap.profs)
+    for (d, t), running in active.items():
+        if not levels:
+            model.Add(sum(v for _, v in running) == 0)
+            continue
+        for k, available in enumerate(rooms_from):
+            model.Add(sum(v for mid, v in running if need[mid] >= k) <= available)
+        model.Add(sum(v for _, v in running) <= n_profs)
+    for d in range(n_days):
+        model.Add(sum(v for mid in modules for v in module_day[mid, d]) <= n_profs * PROF_DAILY_LIMIT)
+
+    model.Maximize(sum(x.values()))
+
+    # warm start: the greedy schedule
+    day_pos = {day: i for i, day in enumerate(days)}
+    slot_pos = {t: i for i, t in enumerate(placer.slot_times)}
+    hint_schedule, _, _ = _schedule_greedy(_ExamPlacer(snap, placer.slot_times), days, progress=job_progress)
+    hinted = {(e['module_id'], day_pos[e['date_heure'].date()], slot_pos[e['date_heure'].time()])
+              for e in hint_schedule}
+    for key, v in x.items():
+        model.AddHint(v, key in hinted)
+
+    stats["build_seconds"] = round(time.monotonic() - started, 3)
+    search_limit = float(time_limit) - stats["build_seconds"]
+    if search_limit <= 0:
+        return fallback(f"construction du modèle plus longue que {time_limit:g}s")
+    job_progress(etape=f"résolution CP-SAT (≤ {search_limit:.0f}s)")
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = search_limit
+    solver.parameters.num_search_workers = CPSAT_WORKERS
+    monitor = _CpsatProgress(JOBS.current(), solver)
+    solver.best_bound_callback = monitor.on_bound
+    status = solver.Solve(model, monitor)
+    job_progress(solutions=monitor.solutions, borne=int(solver.BestObjectiveBound()))   # JobCancelled si annulé
+    stats.update(status=solver.StatusName(status), wall_time=solver.WallTime(), variables=len(x),
+                 student_groups=len(groups), hint_scheduled=len(hint_schedule))
+    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        return fallback(f"aucune solution en {time_limit:g}s ({stats['status']})")
+    bound = solver.BestObjectiveBound()
+    stats.update(solver_objective=solver.ObjectiveValue(), bound=bound)
+
+    # rooms and profs: day by day, largest exams first (smallest fitting room)
+    job_progress(etape="salles et surveillants")
+    chosen = sorted((d, -module_ins_count.get(mid, 0), s, mid) for (mid, d, s), v in x.items()
+                    if solver.Value(v))
+    scheduled, retry = [], []
+    for d, _, s, mid in chosen:
+        placed = placer.place(modules[mid], days[d], slots=(s,))
+        if placed:
+            scheduled.append(placed)
+        else:
+            retry.append(modules[mid])
+    chosen_ids = {mid for _, _, _, mid in chosen}
+    retry.extend(sorted((m for mid, m in modules.items() if mid not in chosen_ids),
+                        key=lambda m: -module_ins_count.get(m['id'], 0)))
+    moved = len(chosen) - len(scheduled)
+    placed, unscheduled = _place_anywhere(placer, retry, days)
+    scheduled.extend(placed)
+    objective = len(scheduled)
+    # placement hors modèle (_place_anywhere) peut dépasser la borne : pas d'écart dans ce cas
+    gap = None if objective > bound else (bound - objective) / bound if bound > 0 else 0.0
+    stats.update(objective=objective, gap=gap, moved_after_solve=moved, placed_after_solve=len(placed))
+    return scheduled, unscheduled, stats
+
+
+MULTISTART_RUNS = 16
+MULTISTART_START_METHODS = ("forkserver", "spawn")   # jamais "fork" : serveur multi-thread
+
+
+def _generation_payload(snap: PlanningSnapshot, slot_times: List[dtime], days: List[date]) -> bytes:
+    """What the generators read from a snapshot, as plain picklable data (one serialization
+    shared by every worker of the pool)."""
+    return pickle.dumps({
+        "exams": [{'id': e.get('id'), 'module_id': e.get('module_id'), 'prof_id': e.get('prof_id'),
+                   'duree_minutes': e.get('duree_minutes')} for e in snap.exams],
+        "modules": dict(snap.modules),
+        "profs": dict(snap.profs),
+        "rooms": dict(snap.rooms),
+        "formations": dict(snap.formations),
+        "module_students": dict(snap.module_students),
+        "slot_times": slot_times,
+        "days": days,
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _multistart_context():
+    """Start method for the multi-start pool: never "fork" (the Streamlit server is multi-threaded,
+    a forked child can inherit a lock held by another thread); None when neither is available."""
+    methods = multiprocessing.get_all_start_methods()
+    method = next((m for m in MULTISTART_START_METHODS if m in methods), None)
+    if method is None:
+        return None
+    ctx = multiprocessing.get_context(method)
+    if method == "forkserver":
+        ctx.set_forkserver_preload(["planning_pool"])
+    return ctx
+
+
+def _schedule_multistart(placer: _ExamPlacer, days: List[date], runs: int = MULTISTART_RUNS,
+                         workers: Optional[int] = None, seed: Optional[int] = None):
+    """
+    Multi-start engine: `runs` randomized greedy variants (seeds seed, seed+1, ...) on a
+    ProcessPoolExecutor sharing one serialized input. The best run wins by scheduled count,
+    then conflicts (the optimizer's terms), then cost; with runs > 1 the plain greedy also
+    competes (seed None). Replay a run with engine_options={"runs": 1, "seed": best_seed}.
+    Workers are started with "forkserver" (or "spawn") and run planning_pool's entry points,
+    which rebuild the runner from the pickled payload; runs in-process with a single worker.
+    """
+    if seed is None:
+        seed = random.randrange(2**31)
+    seeds = [seed + i for i in range(max(1, int(runs)))]
+    payload = _generation_payload(placer.snap, placer.slot_times, days)
+    workers = min(len(seeds), workers or os.cpu_count() or 1)
+    ctx = _multistart_context() if workers > 1 else None
+    if ctx is not None:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                 initializer=planning_pool.init_worker, initargs=(payload,)) as pool:
+            results = []
+            try:
+                for result in pool.map(planning_pool.run, seeds):
+                    results.append(result)
+                    job_progress(essais=f"{len(results)}/{len(seeds)}")
+            except JobCancelled:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+    else:
+        workers = 1
+        run = _multistart_runner(pickle.loads(payload))
+        results = []
+        for s in seeds:
+            results.append(run(s))
+            job_progress(essais=f"{len(results)}/{len(seeds)}")
+    if len(seeds) > 1:
+        results.append(_multistart_runner(pickle.loads(payload))(None))
+
+    best = min(results, key=lambda r: (-r["scheduled"], r["conflicts"], r["cost"]))
+    unscheduled = [placer.snap.modules[mid] for mid in best["unscheduled"]]
+    stats = {
+        "runs": len(seeds), "workers": workers, "seeds": seeds, "best_seed": best["seed"],
+        "payload_bytes": len(payload),
+        "results": [{k: r[k] for k in ("seed", "scheduled", "conflicts", "cost")} for r in results],
+    }
+    return best["schedule"], unscheduled, stats
+
+
+GENERATION_ENGINES = {
+    "greedy": partial(_schedule_greedy, progress=job_progress),
+    "dsatur": _schedule_dsatur,
+    "cpsat": _schedule_cpsat,
+    "multistart": _schedule_multistart,
+}
+
+
+GENERATION_CACHE_TTL_SECONDS = 3600
+GENERATION_CACHE_MAX_ENTRIES = 32
+
+@st.cache_resource
+def _get_generation_cache() -> TTLCache:
+    return TTLCache(GENERATION_CACHE_TTL_SECONDS, GENERATION_CACHE_MAX_ENTRIES)
+
+GENERATION_CACHE = _get_generation_cache()
+
+
+def generation_result_key(start_date, end_date, slots: List[str], engine: str,
+                          engine_options: Optional[Dict[str, Any]], fingerprint: str) -> str:
+    """Content address of a generate_timetable result: window, parameters and data fingerprint."""
+    params = json.dumps([start_date, end_date, slots, engine, engine_options or {}], sort_keys=True, default=str)
+    return hashlib.sha256(f"{params}|{fingerprint}".encode()).hexdigest()
+
+
+def generate_timetable(start_date=None, end_date=None, force=False, snapshot: Optional[PlanningSnapshot] = None,
+                       slots=None, engine: str = "greedy", engine_options: Optional[Dict[str, Any]] = None):
+    """
+    Optimized Supabase-only timetable generator.
+    - Reads modules, inscriptions, salles, profs, formations, existing exams from one PlanningSnapshot.
+    - Places exams on a grid of daily slots (`slots`, default DEFAULT_EXAM_SLOTS); a room or a
+      prof is only blocked for the slots the exam overlaps.
+    - `engine` picks the placement strategy (GENERATION_ENGINES): "greedy" (first fit by
+      descending enrollment), "dsatur" (graph colouring of the module conflict graph) or "cpsat"
+      (exact solver, `engine_options={"time_limit": s}`) or "multistart" (best of randomized greedy
+      runs on a process pool, `engine_options={"runs": n, "seed": s}`); engine details go to
+      report['engine_stats'].
+    - Results are cached under report['result_key'] (window, parameters, data fingerprint): an
+      identical simulation returns the cached result, and commit_timetable(result_key) persists
+      exactly that schedule. force=True simulates (or reuses the cache) then commits.
     """
     tic = time.time()
     report = {"message": "Génération automatique exécutée.", "created_slots": 0, "attempts": 0}
@@ -374,142 +2118,84 @@ def generate_timetable(start_date=None, end_date=None, force=False):
 
     if not start_date or not end_date:
         return {"error": "start_date & end_date required"}, {}
+    if engine not in GENERATION_ENGINES:
+        return {"error": f"Unknown engine: {engine}"}, {}
 
     # build date list
     try:
         days = _get_dates_between(start_date, end_date)
     except Exception as e:
         return {"error": f"Invalid dates: {e}"}, {}
+    try:
+        slot_times = parse_exam_slots(DEFAULT_EXAM_SLOTS if slots is None else slots)
+    except ValueError as e:
+        return {"error": f"Invalid slots: {e}"}, {}
+    report['slots'] = [t.strftime("%H:%M") for t in slot_times]
+    report['engine'] = engine
+
+    # 1) Prefetched data, shared with detect_conflicts
+    job_progress(etape="chargement des données")
+    snap = snapshot or get_planning_snapshot()
+    fingerprint = snap.generation_fingerprint(exam_window(start_date, end_date))
+    result_key = generation_result_key(start_date, end_date, report['slots'], engine, engine_options, fingerprint)
+    hit, cached = GENERATION_CACHE.get(result_key)
+    if hit:
+        report, conflicts_report = cached
+        report, conflicts_report = dict(report, cache_hit=True), dict(conflicts_report)
+        return commit_timetable(result_key) if force else (report, conflicts_report)
+
+    # 2) In-memory placement
+    job_progress(etape="placement", modules_total=len(snap.modules), modules_places=0)
+    placer = _ExamPlacer(snap, slot_times)
+    scheduled, unscheduled, report['engine_stats'] = GENERATION_ENGINES[engine](placer, days, **(engine_options or {}))
+    report['attempts'] = len(snap.modules)
+    report['created_slots'] = len(scheduled)
+    report['days_used'] = len({s['date_heure'].date() for s in scheduled})
+    for mod in unscheduled:
+        conflicts_report.setdefault('unscheduled_modules', []).append({
+            'module_id': mod.get('id'),
+            'module_nom': mod.get('nom'),
+            'nb_inscrits': snap.module_ins_count.get(mod.get('id'), 0)
+        })
 
-    # 1) Prefetch everything once
-    modules = db_select("modules", "id,nom,formation_id")           # list
-    inscriptions = db_select("inscriptions", "etudiant_id,module_id")
-    rooms = db_select("lieu_examen", "id,nom,capacite")
-    profs = db_select("professeurs", "id,nom,dept_id")
-    formations = {f['id']: f for f in db_select("formations", "id,nom,dept_id")}
-    # existing examens used to detect prior assignments/durations
-    existing_exams = db_select("examens", "id,module_id,prof_id,duree_minutes,date_heure,salle_id")
-
-    # build fast lookup maps
-    module_to_students = defaultdict(list)
-    for ins in inscriptions:
-        module_to_students[ins['module_id']].append(ins['etudiant_id'])
-
-    module_ins_count = {mid: len(studs) for mid, studs in module_to_students.items()}
-
-    rooms_by_capacity = sorted([{ 'id': r['id'], 'capacite': int(r.get('capacite') or 0) } for r in rooms],
-                                key=lambda x: x['capacite'])
-
-    profs_by_id = {p['id']: p for p in profs}
-    profs_by_dept = defaultdict(list)
-    for p in profs:
-        profs_by_dept[p.get('dept_id')].append(p)
-
-    module_default_prof = {}
-    module_default_duration = {}
-    for e in existing_exams:
-        mid = e.get('module_id')
-        if mid and e.get('prof_id'):
-            module_default_prof.setdefault(mid, e.get('prof_id'))
-        if mid and e.get('duree_minutes'):
-            try:
-                module_default_duration.setdefault(mid, int(e.get('duree_minutes')))
-            except Exception:
-                pass
-
-    # trackers 
-    scheduled = []
-    student_busy_days = defaultdict(set)            
-    prof_count_day = defaultdict(lambda: defaultdict(int)) 
-    room_used_day = defaultdict(set)               
-    
-    # sort modules by descending number of students 
-    modules_sorted = sorted(modules, key=lambda m: -module_ins_count.get(m['id'], 0))
-
-    for mod in modules_sorted:
-        mid = mod.get('id')
-        mname = mod.get('nom')
-        nb_ins = module_ins_count.get(mid, 0)
-        formation_id = mod.get('formation_id')
-        report['attempts'] += 1
-        scheduled_flag = False
-
-        # pick suitable rooms once
-        suitable_rooms = [r for r in rooms_by_capacity if r['capacite'] >= nb_ins]
-        if not suitable_rooms:
-            suitable_rooms = sorted(rooms_by_capacity, key=lambda r: -r['capacite'])
-
-        duration = module_default_duration.get(mid, 120)
-
-        studs = module_to_students.get(mid, [])
-
-        for d in days:
-            # check students free 
-            conflict_found = False
-            for s in studs:
-                if d in student_busy_days.get(s, ()):
-                    conflict_found = True
-                    break
-            if conflict_found:
-                continue
-
-            # find free room for that day
-            chosen_room = None
-            for r in suitable_rooms:
-                if r['id'] not in room_used_day.get(d, set()):
-                    chosen_room = r
-                    break
-            if not chosen_room:
-                continue
-
-            # choose prof
-            chosen_prof = module_default_prof.get(mid)
-            if chosen_prof is None:
-                dept_id = formations.get(formation_id, {}).get('dept_id') if formation_id else None
-                if dept_id and profs_by_dept.get(dept_id):
-                    chosen_prof = min(profs_by_dept[dept_id], key=lambda p: sum(prof_count_day[p['id']].values()))['id']
-                elif profs:
-                    chosen_prof = min(profs, key=lambda p: sum(prof_count_day[p['id']].values()))['id']
-            # ensure prof daily limit (<3)
-            if chosen_prof is None:
-                continue
-            if prof_count_day[chosen_prof].get(d, 0) >= 3:
-                other_cands = [p for p in profs if prof_count_day[p['id']].get(d, 0) < 3]
-                if other_cands:
-                    chosen_prof = min(other_cands, key=lambda p: sum(prof_count_day[p['id']].values()))['id']
-                else:
-                    continue
-
-            # schedule at fixed time 09:00 
-            dt = datetime.combine(d, dtime(hour=9, minute=0))
-            scheduled.append({
-                "module_id": mid,
-                "module_nom": mname,
-                "prof_id": chosen_prof,
-                "salle_id": chosen_room['id'],
-                "date_heure": dt,
-                "duree_minutes": duration,
-                "nb_inscrits": nb_ins
-            })
+    # conflicts check on the data the schedule was computed from
+    job_progress(etape="contrôle des conflits")
+    conflicts_after = detect_conflicts(start_date, end_date, snapshot=snap)
+    duration = time.time() - tic
+    report['duration_seconds'] = duration
+    report['scheduled_count'] = len(scheduled)
+    report['scheduled_preview_count'] = min(len(scheduled), 10)
+    report['schedule'] = scheduled
+    report['conflicts_post'] = {k: len(v) for k, v in conflicts_after.items()}
+    for k, v in conflicts_after.items():
+        conflicts_report[k] = v
 
-            # mark busy
-            for s in studs:
-                student_busy_days[s].add(d)
-            prof_count_day[chosen_prof][d] += 1
-            room_used_day[d].add(chosen_room['id'])
-            report['created_slots'] += 1
-            scheduled_flag = True
-            break
+    report.update(result_key=result_key, window=(start_date, end_date), data_fingerprint=fingerprint,
+                  cache_hit=False)
+    GENERATION_CACHE.put(result_key, (report, conflicts_report), tag=result_key)
+    if force:
+        return commit_timetable(result_key)
+    return dict(report), dict(conflicts_report)
 
-        if not scheduled_flag:
-            conflicts_report.setdefault('unscheduled_modules', []).append({
-                'module_id': mid,
-                'module_nom': mname,
-                'nb_inscrits': nb_ins
-            })
 
-    # persistence 
-    if force and scheduled:
+def commit_timetable(result_key: str):
+    """
+    Persist the exact schedule of a cached generate_timetable result with a single bulk insert
+    (via db_insert), then re-check conflicts on fresh data. Refused when the result expired or
+    the planning data changed since the simulation. The entry is claimed (removed) first, so a
+    double click cannot insert the schedule twice; it is put back if the insert fails.
+    """
+    hit, cached = GENERATION_CACHE.pop(result_key)
+    if not hit:
+        return {"error": "Simulation introuvable ou expirée : relancez la génération."}, {}
+    report, conflicts_report = dict(cached[0]), {}
+    if get_planning_snapshot().generation_fingerprint(exam_window(*report['window'])) != report['data_fingerprint']:
+        return {"error": "Les données ont changé depuis la simulation : relancez la génération."}, {}
+
+    scheduled = report['schedule']
+    report['created_slots'] = 0
+    if scheduled:
+        job_progress(etape="enregistrement")
         payload = []
         for s in scheduled:
             payload.append({
@@ -520,54 +2206,290 @@ def generate_timetable(start_date=None, end_date=None, force=False):
                 "duree_minutes": s['duree_minutes']
             })
         res = db_insert("examens", payload)
+        report['created_slots'] = res.get('inserted_count', 0)
         if res.get('error'):
             conflicts_report['insert_error'] = res.get('error')
-        else:
-            inserted = res.get('inserted_count', 0)
-            report['created_slots'] = inserted
+            if not report['created_slots']:
+                # rien d'écrit : l'aperçu reste enregistrable (sinon l'empreinte a changé)
+                GENERATION_CACHE.put(result_key, cached, tag=result_key)
 
-    # final conflicts check
+    # final conflicts check (after an insert the store version changed: fresh snapshot)
+    job_progress(etape="contrôle des conflits")
+    start_date, end_date = report['window']
     conflicts_after = detect_conflicts(start_date, end_date)
-    duration = time.time() - tic
-    report['duration_seconds'] = duration
-    report['scheduled_count'] = len(scheduled)
-    report['scheduled_preview_count'] = min(len(scheduled), 10)
     report['conflicts_post'] = {k: len(v) for k, v in conflicts_after.items()}
-    for k, v in conflicts_after.items():
-        conflicts_report[k] = v
-
+    if cached[1].get('unscheduled_modules'):
+        conflicts_report['unscheduled_modules'] = cached[1]['unscheduled_modules']
+    conflicts_report.update(conflicts_after)
     return report, conflicts_report
 
-def optimize_resources(start_date=None, end_date=None):
+# ======================
+# OPTIMISATION (recuit simulé, coûts incrémentaux)
+# ======================
+def optimize_resources(start_date=None, end_date=None, time_budget: float = 5.0, seed: Optional[int] = None,
+                       max_iterations: Optional[int] = None, schedule: Optional[List[Dict[str, Any]]] = None,
+                       snapshot: Optional[PlanningSnapshot] = None, slots=None):
+    """
+    Simulated annealing over an exam schedule.
+    Starts from `schedule` (a generate_timetable result) or from the examens of the window,
+    and tries two moves: put an exam on another day/slot/room, or swap the invigilators of two
+    exams. Each move is scored incrementally (_ScheduleState) against the terms checked by
+    detect_conflicts plus wasted seats. Stops after time_budget seconds (or max_iterations)
+    and returns the best schedule seen. Same seed + same iteration count = same result.
+    Nothing is written to the database. Invalid `slots` return ({"error": ...}, {}) like
+    generate_timetable.
+    """
     tic = time.time()
-    time.sleep(1)
+    seed = random.randrange(2 ** 31) if seed is None else seed
+    rng = random.Random(seed)
+    window = exam_window(start_date, end_date)
+    try:
+        slot_times = parse_exam_slots(DEFAULT_EXAM_SLOTS if slots is None else slots)
+    except ValueError as e:
+        return {"error": f"Invalid slots: {e}"}, {}
+    snap = restrict_snapshot(snapshot, window) if snapshot else get_planning_snapshot(window)
+    base_exams = schedule if schedule is not None else snap.exams
+    items = _items_from_exams(base_exams, snap.exam_dt, snap.module_ins_count)
+    if start_date and end_date:
+        days = _get_dates_between(start_date, end_date)
+    else:
+        days = sorted({it['day'] for it in items})
+    room_ids = sorted(snap.rooms, key=lambda rid: int(snap.rooms[rid].get('capacite') or 0))
+    room_caps = [int(snap.rooms[rid].get('capacite') or 0) for rid in room_ids]
+    starts = [t.hour * 60 + t.minute for t in slot_times]
+
+    state = _ScheduleState([dict(it) for it in items], snap.module_students, snap.rooms)
+    initial_cost, initial_terms = state.cost, state.breakdown()
+    best_cost = state.cost
+    best = [(it['day'], it['start'], it['salle_id'], it['prof_id']) for it in state.items]
+    iterations = accepted = 0
+    t_start, t_end = 10.0, 0.01
+
+    n = len(state.items)
+    while n and days and room_ids:
+        elapsed = time.time() - tic
+        if (max_iterations is not None and iterations >= max_iterations) or \
+                (max_iterations is None and elapsed >= time_budget):
+            break
+        progress = iterations / max_iterations if max_iterations else elapsed / time_budget
+        temperature = t_start * (t_end / t_start) ** min(1.0, progress)
+        if not iterations % 1024:
+            job_progress(etape="recuit simulé", iterations=iterations, cout_meilleur=round(best_cost, 3))
+        iterations += 1
+        i = rng.randrange(n)
+        it = state.items[i]
+        if rng.random() < 0.75 or n < 2:
+            old = {'day': it['day'], 'start': it['start'], 'salle_id': it['salle_id']}
+            fitting = room_ids[bisect.bisect_left(room_caps, it['nb']):] if rng.random() < 0.8 else room_ids
+            new = {'day': rng.choice(days), 'start': rng.choice(starts), 'salle_id': rng.choice(fitting or room_ids)}
+            delta = state.move(i, **new)
+            undo = [(i, old)]
+        else:
+            j = rng.randrange(n)
+            if j == i or state.items[j]['prof_id'] == it['prof_id']:
+                continue
+            pi, pj = it['prof_id'], state.items[j]['prof_id']
+            delta = state.move(i, prof_id=pj) + state.move(j, prof_id=pi)
+            undo = [(j, {'prof_id': pj}), (i, {'prof_id': pi})]
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            accepted += 1
+            if state.cost < best_cost - 1e-9:
+                best_cost = state.cost
+                best = [(x['day'], x['start'], x['salle_id'], x['prof_id']) for x in state.items]
+        else:
+            for k, values in undo:
+                state.move(k, **values)
+
+    # rebuild the best schedule and score it again from scratch
+    optimized = []
+    for it, (day, start, room, prof) in zip(items, best):
+        optimized.append(dict(it, day=day, start=start, salle_id=room, prof_id=prof))
+    final_state = _ScheduleState([dict(x) for x in optimized], snap.module_students, snap.rooms)
+    changes = []
+    for before, after in zip(items, optimized):
+        diff = {k: (before[k], after[k]) for k in ('day', 'start', 'salle_id', 'prof_id') if before[k] != after[k]}
+        if diff:
+            changes.append({'id': before.get('id'), 'module_id': before['module_id'], 'changes': diff})
+    optimized_exams = _exams_from_items(optimized)
+    conflicts = detect_conflicts(start_date, end_date, snapshot=snapshot_with_exams(snap, optimized_exams, window))
+    conflicts_initial = detect_conflicts(start_date, end_date,
+                                         snapshot=snapshot_with_exams(snap, _exams_from_items(items), window))
+    conflict_keys = ('etudiants_1parjour', 'profs_3parjour', 'salles_capacite', 'chevauchements', 'etudiants_chevauchement')
     duration = time.time() - tic
     report = {
         "message": "Optimisation terminée",
         "duration_seconds": duration,
+        "seed": seed,
+        "iterations": iterations,
+        "accepted_moves": accepted,
+        "cost_initial": round(initial_cost, 3),
+        "cost_best": round(final_state.cost, 3),
+        "terms_initial": initial_terms,
+        "terms_best": final_state.breakdown(),
         "notes": [
-            "Optimisation réalisée (prototype).",
-            "Pour production, brancher un solver et exécuter modifications en base après revue."
+            "Recuit simulé : déplacement d'examen (jour / créneau / salle) et échange de surveillants.",
+            f"Rejouer : seed={seed}, max_iterations={iterations}.",
+            "Aucune écriture en base : appliquer les modifications après revue.",
         ],
         "improvements": {
-            "reduction_conflits_estime": 12,
-            "reaffectations_salles": 5
-        }
+            "reduction_conflits": sum(len(conflicts_initial[k]) - len(conflicts[k]) for k in conflict_keys),
+            "places_perdues_economisees": int(initial_terms['places_perdues'] - final_state.terms['places_perdues']),
+            "examens_deplaces": sum(1 for c in changes if {'day', 'start', 'salle_id'} & set(c['changes'])),
+            "reaffectations_surveillants": sum(1 for c in changes if 'prof_id' in c['changes']),
+        },
+        "conflicts_initial": {k: len(conflicts_initial[k]) for k in conflict_keys},
+        "conflicts_best": {k: len(conflicts[k]) for k in conflict_keys},
+        "changes": changes,
+        "schedule": optimized_exams,
     }
-    conflicts = detect_conflicts(start_date, end_date)
     return report, conflicts
 
+# ======================
+# DIAGNOSTICS REQUÊTES (page admin cachée : ?diag=1)
+# ======================
+def show_query_diagnostics():
+    """Recent reruns of every session with their db_* calls (see QueryLog), N+1 candidates,
+    latency histogram, per-page totals and a JSON export."""
+    st.title("🩺 Diagnostics des requêtes")
+    logs = list(QUERY_HISTORY)[::-1]
+    if st.button("Vider l'historique"):
+        QUERY_HISTORY.clear()
+        st.rerun()
+    if not logs:
+        st.info("Aucune requête enregistrée.")
+        return
+
+    st.subheader("Par page")
+    per_page = defaultdict(lambda: {"reruns": 0, "requetes": 0, "ms_total": 0.0, "octets": 0, "n_plus_1": 0})
+    for log in logs:
+        agg = per_page[log.label]
+        summary = log.summary()
+        agg["reruns"] += 1
+        for k in ("requetes", "ms_total", "octets", "n_plus_1"):
+            agg[k] += summary[k]
+    show_table_safe(sorted(({"page": page, **agg, "requetes_par_rerun": round(agg["requetes"] / agg["reruns"], 1),
+                             "ms_total": round(agg["ms_total"], 1)} for page, agg in per_page.items()),
+                           key=lambda r: -r["ms_total"]), key="diag_pages")
+
+    st.subheader("Reruns récents")
+    show_table_safe([log.summary() for log in logs], key="diag_reruns")
+    labels = {i: f"{log.started_at:%H:%M:%S} — {log.label or '?'} — {log.count} requête(s)" for i, log in enumerate(logs)}
+    log = logs[st.selectbox("Rerun", list(labels), format_func=labels.get, key="diag_rerun")]
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Requêtes", log.count)
+    c2.metric("Latence cumulée", f"{log.total_ms:.0f} ms")
+    c3.metric("Lignes", log.rows)
+    c4.metric("Octets (estim.)", f"{log.bytes / 1024:.0f} Ko")
+    suspects = log.n_plus_one()
+    if suspects:
+        st.warning(f"{len(suspects)} forme(s) de requête répétée(s) {N_PLUS_ONE_THRESHOLD} fois ou plus (N+1 probable) :")
+        show_table_safe(suspects, key="diag_n1")
+    detail = log.to_dict()
+    fig = go.Figure(data=[go.Bar(x=list(detail["histogramme_ms"]), y=list(detail["histogramme_ms"].values()))])
+    fig.update_layout(margin=dict(t=10, b=0, l=0, r=0), height=220, yaxis_title="requêtes")
+    st.plotly_chart(fig, use_container_width=True)
+    show_table_safe(detail["requetes_detail"], key="diag_detail")
+    if detail["requetes_non_detaillees"]:
+        st.caption(f"{detail['requetes_non_detaillees']} requête(s) comptée(s) sans détail (limite {QUERY_LOG_MAX_RECORDS}).")
+
+    st.subheader("Cache des données de référence")
+    st.json(ref_cache_stats())
+    export = {"genere_le": datetime.now().isoformat(timespec="seconds"), "cache_reference": ref_cache_stats(),
+              "reruns": [l.to_dict() for l in logs]}
+    st.download_button("Exporter (JSON)", json.dumps(export, ensure_ascii=False, indent=2, default=str),
+                       file_name=f"diagnostics_requetes_{datetime.now():%Y%m%d_%H%M%S}.json", mime="application/json")
+
+# ======================
+# VALIDATION FINALE (Vice-doyen)
+# ======================
+PENDING_FINAL_PAGE_SIZE = 25
+PendingKey = Optional[Tuple[Optional[str], Any]]   # (date_heure, id) du dernier examen de la page précédente
+PENDING_FINAL_EMBED = "id,date_heure,duree_minutes,module_id,salle_id,modules(nom),lieu_examen(nom)"
+
+def _pending_final_pg(after: PendingKey, limit: int, with_count: bool) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    where = "e.validated = true AND coalesce(e.final_validated, 0) = 0"
+    params: List[Any] = []
+    total = None
+    if with_count:
+        total = PG_BACKEND.query(f"SELECT count(*) AS n FROM examens e WHERE {where}")[0]['n']
+    if after is not None and after[0] is None:     # déjà dans les examens sans date (en fin de liste)
+        where += " AND e.date_heure IS NULL AND e.id > %s"
+        params.append(after[1])
+    elif after is not None:
+        where += " AND ((e.date_heure, e.id) > (%s, %s) OR e.date_heure IS NULL)"
+        params += list(after)
+    rows = PG_BACKEND.query(
+        "SELECT e.id, e.date_heure, e.duree_minutes, e.module_id, e.salle_id,"
+        " m.nom AS module_nom, l.nom AS salle_nom"
+        " FROM examens e LEFT JOIN modules m ON m.id = e.module_id LEFT JOIN lieu_examen l ON l.id = e.salle_id"
+        f" WHERE {where} ORDER BY e.date_heure NULLS LAST, e.id LIMIT %s", params + [limit])
+    return rows, total
+
+def _pending_final_rest(after: PendingKey, limit: int, with_count: bool) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    def query(select):
+        q = supabase.table("examens").select(select, count="exact" if with_count else None)
+        q = q.eq("validated", True).or_("final_validated.is.null,final_validated.eq.0")
+        if after is not None and after[0] is None:
+            q = q.is_("date_heure", "null").gt("id", after[1])
+        elif after is not None:
+            d, i = after
+            q = q.or_(f'date_heure.gt."{d}",and(date_heure.eq."{d}",id.gt.{i}),date_heure.is.null')
+        return q.order("date_heure", nullsfirst=False).order("id").limit(limit).execute()
+    try:
+        res = query(PENDING_FINAL_EMBED)
+        rows = [dict(r, module_nom=(r.pop('modules', None) or {}).get('nom'),
+                     salle_nom=(r.pop('lieu_examen', None) or {}).get('nom')) for r in res.data or []]
+    except Exception as e:
+        # pas de clé étrangère déclarée : mêmes lignes, noms résolus par lots
+        print(f"[pending_final] embedding indisponible ({e}), résolution par BATCH_LOADER")
+        res = query(PENDING_FINAL_EMBED.split(",modules(")[0])
+        rows = res.data or []
+        mods = BATCH_LOADER.load_many("modules", {r['module_id'] for r in rows}, "nom")
+        lieux = BATCH_LOADER.load_many("lieu_examen", {r['salle_id'] for r in rows}, "nom")
+        rows = [dict(r, module_nom=mods.get(r['module_id'], {}).get('nom'),
+                     salle_nom=lieux.get(r['salle_id'], {}).get('nom')) for r in rows]
+    return rows, res.count
+
+@instrumented("pending_final")
+def fetch_pending_final_page(after: PendingKey = None, limit: int = PENDING_FINAL_PAGE_SIZE,
+                             with_count: bool = False) -> Tuple[List[Dict[str, Any]], PendingKey, Optional[int]]:
+    """One page of exams validated by their department and awaiting final validation, with module
+    and room names, ordered by (date_heure, id) with undated exams last (sorted by id). Keyset
+    pagination: `after` is the key of the last row of the previous page, so any page costs one
+    indexed range read.
+    Returns (rows, key of the next page or None on the last page, total when with_count).
+    Raises DBReadError on failure."""
+    try:
+        if PG_BACKEND is not None:
+            rows, total = _pending_final_pg(after, limit + 1, with_count)
+        else:
+            rows, total = _pending_final_rest(after, limit + 1, with_count)
+    except Exception as e:
+        raise DBReadError(f"examens en attente de validation finale : {e}") from e
+    next_key = (rows[limit - 1]['date_heure'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return rows[:limit], next_key, total
+
+def fetch_pending_final_page_counted(after: PendingKey, limit: int = PENDING_FINAL_PAGE_SIZE,
+                                     key: str = "final_val_total") -> Tuple[List[Dict[str, Any]], PendingKey, int]:
+    """fetch_pending_final_page with the total counted once and kept in session_state[key]:
+    it is recounted only after a write to the planning tables (PLANNING_STORE.version) or when
+    older than SNAPSHOT_MAX_AGE_SECONDS, not on every rerun or page change."""
+    version, now = PLANNING_STORE.version, time.monotonic()
+    cached = st.session_state.get(key)
+    fresh = cached is not None and cached[0] == version and now - cached[1] <= SNAPSHOT_MAX_AGE_SECONDS
+    rows, next_key, total = fetch_pending_final_page(after, limit, with_count=not fresh)
+    if fresh:
+        return rows, next_key, cached[2]
+    st.session_state[key] = (version, now, total)
+    return rows, next_key, total
+
 # ======================
 # SESSION STATE INIT
 # ======================
 defaults = {
     "step": "login",
     "reset_email": "",
-    "reset_code": "",
-    "reset_sent_time": None,
     "register_email": "",
-    "register_code": "",
-    "register_sent_time": None,
     "register_role": "",
     "user_email": "",
     "role": ""
@@ -576,6 +2498,8 @@ defaults = {
 for key, value in defaults.items():
     if key not in st.session_state:
         st.session_state[key] = value
+QUERY_LOG.label = st.session_state.step
+QUERY_LOG.user = st.session_state.user_email
 
 
 
@@ -654,34 +2578,19 @@ if st.session_state.step == "login":
 
             # BOUTON PRINCIPAL
             if st.button("Se connecter", type="primary"):
-                roles_tables = {
-                    "Etudiant": "etudiants",
-                    "Professeur": "professeurs",
-                    "Chef": "chefs_departement",
-                    "Admin": "administrateurs",
-                    "Vice-doyen": "vice_doyens",
-                    "Administrateur examens": "administrateurs"
-                }
-
-                found_user = False
-                for role_name, table_name in roles_tables.items():
-                    users = db_select(
-                        table_name,
-                        "*",
-                        eq={"email": email, "password": password}
-                    )
-                    if users:
+                try:
+                    matches = find_identities(email, password)
+                except DBReadError as e:
+                    st.error(f"Connexion impossible : {e}")
+                else:
+                    if matches:
                         st.session_state.user_email = email
-                        st.session_state.role = role_name
+                        st.session_state.role = matches[0]['role']
                         st.session_state.step = "dashboard"
-                        found_user = True
-                        break
-
-                if found_user:
-                    st.success(f"Connecté en tant que {st.session_state.role}")
-                    st.rerun()
-                else:
-                    st.error("Identifiants incorrects")
+                        st.success(f"Connecté en tant que {st.session_state.role}")
+                        st.rerun()
+                    else:
+                        st.error("Identifiants incorrects")
             st.markdown("<hr style='border:1px solid white;'>", unsafe_allow_html=True)
 
             # BOUTONS SECONDAIRES 
@@ -733,12 +2642,11 @@ elif st.session_state.step == "register_email":
             st.error("L’email doit se terminer par @gmail.com")
         else:
             st.session_state.register_email = reg_email
-            st.session_state.register_code = send_email_code(
-                reg_email,
+            send_verification_code(
+                reg_email, "register",
                 "Confirmation d'inscription",
                 "Votre code pour valider votre inscription :"
             )
-            st.session_state.register_sent_time = datetime.now()
             st.session_state.step = "confirm_register_code"
             st.rerun()
 
@@ -752,29 +2660,27 @@ elif st.session_state.step == "register_email":
 elif st.session_state.step == "confirm_register_code":
 
     st.subheader("Inscription — Étape 2/3")
-    st.success(f"Code envoyé à {st.session_state.register_email}")
-
-    if not code_is_valid(st.session_state.register_sent_time):
-        st.error("⏳ Code expiré (3 minutes dépassées)")
+    show_code_status(st.session_state.register_email, "register")
 
     if st.button("Renvoyer le code"):
-        if can_resend(st.session_state.register_sent_time):
-            st.session_state.register_code = send_email_code(
-                st.session_state.register_email,
-                "Nouveau code d'inscription",
-                "Voici votre nouveau code :"
-            )
-            st.session_state.register_sent_time = datetime.now()
-            st.success("Nouveau code envoyé !")
+        if send_verification_code(
+            st.session_state.register_email, "register",
+            "Nouveau code d'inscription",
+            "Voici votre nouveau code :"
+        ):
+            st.rerun()
         else:
             st.warning("Attendez 1 minute avant de renvoyer.")
 
     code_input = st.text_input("Entrez le code reçu")
 
     if st.button("Valider le code"):
-        if not code_is_valid(st.session_state.register_sent_time):
+        check = OUTBOX.verify(st.session_state.register_email, "register", code_input)
+        if check == "expired":
             st.error("Code expiré, renvoyez-en un nouveau.")
-        elif code_input == st.session_state.register_code:
+        elif check == "locked":
+            st.error("Trop de codes incorrects, renvoyez-en un nouveau.")
+        elif check == "ok":
             st.session_state.step = "create_account"
             st.rerun()
         else:
@@ -916,23 +2822,22 @@ elif st.session_state.step == "forgot_email":
     reset_email = st.text_input("Entrez votre email")
 
     if st.button("Envoyer le code"):
-        found = False
-        for table in tables_reset:
-            user = db_get_one(table, "*", eq={"email": reset_email})
-            if user:
-                found = True
+        try:
+            found = bool(find_identities(reset_email))
+        except DBReadError as e:
+            st.error(f"Recherche impossible : {e}")
+        else:
+            if found:
                 st.session_state.reset_email = reset_email
-                st.session_state.reset_code = send_email_code(
-                    reset_email,
+                send_verification_code(
+                    reset_email, "reset",
                     "Réinitialisation mot de passe",
                     "Votre code est :"
                 )
-                st.session_state.reset_sent_time = datetime.now()
                 st.session_state.step = "enter_code"
                 st.rerun()
-
-        if not found:
-            st.error("Email non trouvé")
+            else:
+                st.error("Email non trouvé")
 
     if st.button("Retour"):
         st.session_state.step = "login"
@@ -944,26 +2849,27 @@ elif st.session_state.step == "forgot_email":
 elif st.session_state.step == "enter_code":
 
     st.subheader("Réinitialisation — Étape 2/3")
-    st.success(f"Code envoyé à {st.session_state.reset_email}")
+    show_code_status(st.session_state.reset_email, "reset")
 
     if st.button("Renvoyer le code"):
-        if can_resend(st.session_state.reset_sent_time):
-            st.session_state.reset_code = send_email_code(
-                st.session_state.reset_email,
-                "Nouveau code",
-                "Voici votre nouveau code :"
-            )
-            st.session_state.reset_sent_time = datetime.now()
-            st.success("Nouveau code envoyé !")
+        if send_verification_code(
+            st.session_state.reset_email, "reset",
+            "Nouveau code",
+            "Voici votre nouveau code :"
+        ):
+            st.rerun()
         else:
             st.warning("Attendez 1 minute.")
 
     code_input = st.text_input("Entrez le code reçu")
 
     if st.button("Suivant"):
-        if not code_is_valid(st.session_state.reset_sent_time):
+        check = OUTBOX.verify(st.session_state.reset_email, "reset", code_input)
+        if check == "expired":
             st.error("Code expiré, renvoyez-en un nouveau.")
-        elif code_input == st.session_state.reset_code:
+        elif check == "locked":
+            st.error("Trop de codes incorrects, renvoyez-en un nouveau.")
+        elif check == "ok":
             st.session_state.step = "new_password"
             st.rerun()
         else:
@@ -988,14 +2894,17 @@ elif st.session_state.step == "new_password":
             st.error("Les mots de passe ne correspondent pas")
         else:
             updated_any = False
-            for table in tables_reset:
-                user = db_get_one(table, "*", eq={"email": st.session_state.reset_email})
-                if user:
-                    res = db_update(table, {"password": new_pass}, {"email": st.session_state.reset_email})
-                    if res.get('error'):
-                        st.error(f"Erreur mise à jour: {res['error']}")
-                    else:
-                        updated_any = True
+            try:
+                owners = dict.fromkeys(i['table'] for i in find_identities(st.session_state.reset_email))
+            except DBReadError as e:
+                owners = {}
+                st.error(f"Recherche impossible : {e}")
+            for table in owners:
+                res = db_update(table, {"password": new_pass}, {"email": st.session_state.reset_email})
+                if res.get('error'):
+                    st.error(f"Erreur mise à jour: {res['error']}")
+                else:
+                    updated_any = True
 
             if updated_any:
                 st.success("Mot de passe mis à jour !")
@@ -1010,6 +2919,7 @@ elif st.session_state.step == "new_password":
 elif st.session_state.step == "dashboard":
 
     role = st.session_state.role
+    QUERY_LOG.label = f"dashboard/{role}"
     email = st.session_state.user_email
     user_data = {}
 
@@ -1072,20 +2982,15 @@ elif st.session_state.step == "dashboard":
     if role == "Etudiant":
         st.title(f"👋 Bienvenue, {user_data.get('prenom','')} {user_data.get('nom','')}")
         st.subheader("🎓 Emploi du temps des examens")
-        # Fetch modules the student is enrolled in
-        etu = db_get_one("etudiants", "*", eq={"email": email})
+        # Fetch modules the student is enrolled in (profil déjà chargé en tête de dashboard)
+        etu = user_data or None
         liste_modules = []
+        module_ids = []
         if etu:
-            etu_id = etu.get('id')
-            ins = db_select("inscriptions", "module_id", eq={"etudiant_id": etu_id})
-            module_ids = [i['module_id'] for i in ins]
-            if module_ids:
-                mods = []
-                for mid in module_ids:
-                    m = db_get_one("modules", "nom", eq={"id": mid})
-                    if m:
-                        mods.append(m['nom'])
-                liste_modules = mods
+            ins = db_select("inscriptions", "module_id", eq={"etudiant_id": etu.get('id')})
+            module_ids = list(dict.fromkeys(i['module_id'] for i in ins))
+            mods_by_id = BATCH_LOADER.load_many("modules", module_ids, "id,nom")
+            liste_modules = [mods_by_id[mid]['nom'] for mid in module_ids if mid in mods_by_id]
 
         col_f1, col_f2 = st.columns(2)
         with col_f1:
@@ -1096,20 +3001,15 @@ elif st.session_state.step == "dashboard":
             except Exception:
                 date_filtre = None
 
-        # Build query by fetching examens for student's modules
-        examens = []
-        if etu:
-            ins = db_select("inscriptions", "module_id", eq={"etudiant_id": etu.get('id')})
-            mids = [i['module_id'] for i in ins]
-            for mid in mids:
-                exs = db_select("examens", "*", eq={"module_id": mid})
-                for ex in exs:
-                    examens.append(ex)
+        # Build query by fetching examens for student's modules (une seule requête in_)
+        examens = db_select("examens", "*", in_={"module_id": module_ids}) if module_ids else []
+        mods_by_id = BATCH_LOADER.load_many("modules", [ex.get('module_id') for ex in examens], "id,nom")
+        salles_by_id = BATCH_LOADER.load_many("lieu_examen", [ex.get('salle_id') for ex in examens], "id,nom")
         # Filter by module name if needed
         display_rows = []
         for ex in examens:
-            mod = db_get_one("modules", "nom", eq={"id": ex.get('module_id')})
-            salle = db_get_one("lieu_examen", "nom", eq={"id": ex.get('salle_id')})
+            mod = mods_by_id.get(ex.get('module_id'))
+            salle = salles_by_id.get(ex.get('salle_id'))
             if module_filtre != "Tous les modules" and mod and mod.get('nom') != module_filtre:
                 continue
             if date_filtre:
@@ -1125,7 +3025,7 @@ elif st.session_state.step == "dashboard":
                 "Durée": ex.get('duree_minutes')
             })
         if display_rows:
-            st.table(display_rows)
+            show_table_safe(display_rows, key="etu_exams")
         else:
             st.info("Aucun examen trouvé.")
 
@@ -1136,22 +3036,20 @@ elif st.session_state.step == "dashboard":
         st.title(f"👨‍🏫 Bienvenue, M. {user_data.get('nom','')}")
         st.subheader("📋 Mes surveillances d'examens")
 
-        prof = db_get_one("professeurs", "*", eq={"email": email})
+        prof = user_data or None
         liste_modules_prof = []
         liste_salles_prof = []
+        exs = []
         if prof:
-            pid = prof.get('id')
-            exs = db_select("examens", "*", eq={"prof_id": pid})
-            mids = list({e['module_id'] for e in exs})
-            for mid in mids:
-                m = db_get_one("modules", "nom", eq={"id": mid})
-                if m:
-                    liste_modules_prof.append(m['nom'])
-            sids = list({e['salle_id'] for e in exs})
-            for sid in sids:
-                s = db_get_one("lieu_examen", "nom", eq={"id": sid})
-                if s:
-                    liste_salles_prof.append(s['nom'])
+            exs = db_select("examens", "*", eq={"prof_id": prof.get('id')})
+        mods_by_id = BATCH_LOADER.load_many("modules", [e.get('module_id') for e in exs], "id,nom")
+        salles_by_id = BATCH_LOADER.load_many("lieu_examen", [e.get('salle_id') for e in exs], "id,nom")
+        for mid in dict.fromkeys(e.get('module_id') for e in exs):
+            if mid in mods_by_id:
+                liste_modules_prof.append(mods_by_id[mid]['nom'])
+        for sid in dict.fromkeys(e.get('salle_id') for e in exs):
+            if sid in salles_by_id:
+                liste_salles_prof.append(salles_by_id[sid]['nom'])
 
         col_f1, col_f2, col_f3 = st.columns(3)
         with col_f1:
@@ -1164,29 +3062,27 @@ elif st.session_state.step == "dashboard":
             except Exception:
                 dat_f = None
 
-        # fetch exams for prof
+        # exams for prof, déjà chargés ci-dessus
         res = []
-        if prof:
-            exs = db_select("examens", "*", eq={"prof_id": prof.get('id')})
-            for ex in exs:
-                mod = db_get_one("modules", "nom", eq={"id": ex.get('module_id')})
-                salle = db_get_one("lieu_examen", "nom", eq={"id": ex.get('salle_id')})
-                if mod_f != "Tous les modules" and mod and mod.get('nom') != mod_f:
-                    continue
-                if salle_f != "Toutes les salles" and salle and salle.get('nom') != salle_f:
+        for ex in exs:
+            mod = mods_by_id.get(ex.get('module_id'))
+            salle = salles_by_id.get(ex.get('salle_id'))
+            if mod_f != "Tous les modules" and mod and mod.get('nom') != mod_f:
+                continue
+            if salle_f != "Toutes les salles" and salle and salle.get('nom') != salle_f:
+                continue
+            if dat_f:
+                dt = _parse_datetime(ex.get('date_heure'))
+                if not dt or dt.date() != dat_f:
                     continue
-                if dat_f:
-                    dt = _parse_datetime(ex.get('date_heure'))
-                    if not dt or dt.date() != dat_f:
-                        continue
-                res.append({
-                    "Module": mod.get('nom') if mod else "-",
-                    "Salle": salle.get('nom') if salle else "-",
-                    "Date & Heure": ex.get('date_heure'),
-                    "Durée": ex.get('duree_minutes')
-                })
+            res.append({
+                "Module": mod.get('nom') if mod else "-",
+                "Salle": salle.get('nom') if salle else "-",
+                "Date & Heure": ex.get('date_heure'),
+                "Durée": ex.get('duree_minutes')
+            })
         if res:
-            st.table(res)
+            show_table_safe(res, key="prof_surv")
         else:
             st.info("Aucune surveillance trouvée pour ces critères.")
     # --------------------------------------
@@ -1200,23 +3096,18 @@ elif st.session_state.step == "dashboard":
         if not dept_id:
             st.error("Département non détecté dans la base 'chefs_departement'.")
         else:
-            all_forms = db_select("formations", "id, nom", eq={"dept_id": dept_id})
-            f_map = {f['id']: f['nom'] for f in all_forms}
-            f_ids = list(f_map.keys())
-
-            # On récupère tous les modules pour ces formations
-            all_mods = db_select("modules", "id, nom, formation_id")
-            dept_mods = [m for m in all_mods if m['formation_id'] in f_ids]
-            m_map = {m['id']: m for m in dept_mods}
-            m_ids = list(m_map.keys())
-
-            # On récupère TOUS les examens du département
-            all_exs = db_select("examens", "*")
-            dept_exams = [e for e in all_exs if e['module_id'] in m_ids]
+            try:
+                scope = load_dept_slice(dept_id)
+            except DBReadError as e:
+                st.error(f"Lecture des données du département impossible : {e}")
+                st.stop()
+            f_map = {fid: f['nom'] for fid, f in scope.formations.items()}
+            m_map = scope.modules
+            dept_exams = scope.exams
             pending_exams = [e for e in dept_exams if not e.get('validated')]
 
             # Salles
-            salle_map = {s['id']: s['nom'] for s in db_select("lieu_examen", "id, nom")}
+            salle_map = {sid: r['nom'] for sid, r in scope.rooms.items()}
 
             # GRAPHIQUE CIRCULAIRE
             st.subheader("📊 Performance du Département")
@@ -1253,25 +3144,15 @@ elif st.session_state.step == "dashboard":
 
             # CONFLITS PAR FORMATION
             st.subheader("⚠️ Conflits par Formation")
-            all_conflicts = detect_conflicts()
-            s_conf = all_conflicts.get('salles_capacite', [])
-            
-            # Filtrer les conflits pour ce département
-            dept_conflicts = {}
-            for c in s_conf:
-                ex_id = c.get('examen_id')
-                ex_obj = next((e for e in dept_exams if e['id'] == ex_id), None)
-                if ex_obj:
-                    f_nom = f_map.get(m_map.get(ex_obj['module_id'], {}).get('formation_id'))
-                    if f_nom not in dept_conflicts: dept_conflicts[f_nom] = []
-                    dept_conflicts[f_nom].append(c)
+            dept_conflicts = {f_map.get(fid): kinds['salles_capacite']
+                              for fid, kinds in detect_conflicts_scoped(scope).items()}
 
             if not dept_conflicts:
                 st.success("Aucun conflit détecté pour vos formations.")
             else:
                 for f_nom, list_c in dept_conflicts.items():
                     with st.expander(f"Conflits : {f_nom} ({len(list_c)})"):
-                        st.table(list_c)
+                        show_table_safe(list_c, key=f"chef_conf_{f_nom}")
 
             st.divider()
 
@@ -1280,28 +3161,29 @@ elif st.session_state.step == "dashboard":
             if not pending_exams:
                 st.info("Tout est validé.")
             else:
-                for ex in pending_exams:
-                    m_nom = m_map.get(ex['module_id'], {}).get('nom', 'Inconnu')
-                    f_id = m_map.get(ex['module_id'], {}).get('formation_id')
-                    f_nom = f_map.get(f_id, '-')
-                    
-                    with st.container():
-                        c1, c2, c3 = st.columns([3, 2, 1])
-                        c1.write(f"**{m_nom}** \n*{f_nom}*")
-                        c2.write(f"📅 {ex['date_heure']}  \n📍 {salle_map.get(ex['salle_id'], 'N/A')}")
-                        
-                        # LE BOUTON QUI FORCE LE CHANGEMENT
-                        if c3.button("Valider", key=f"btn_v_{ex['id']}", type="primary"):
-                            # On met à jour la base
-                            db_update("examens", {"validated": True}, {"id": ex['id']})
-                            # On vide tout le cache possible de Streamlit pour ce bouton
-                            st.toast(f"Examen {m_nom} validé !")
-                            st.rerun() # Recharge la page immédiatement
-                    st.divider()
+                def exam_formation(ex):
+                    return f_map.get(m_map.get(ex['module_id'], {}).get('formation_id'), '-')
+
+                form_f = st.selectbox("Filtrer par formation", ["Toutes les formations"] + sorted(set(map(exam_formation, pending_exams))),
+                                      key="chef_val_formation")
+                filtered = [ex for ex in pending_exams if form_f == "Toutes les formations" or exam_formation(ex) == form_f]
+                show_table_safe([{
+                    "Module": m_map.get(ex['module_id'], {}).get('nom', 'Inconnu'),
+                    "Formation": exam_formation(ex),
+                    "Date": ex['date_heure'],
+                    "Salle": salle_map.get(ex['salle_id'], 'N/A'),
+                } for ex in filtered], key="chef_pending")
+                bulk_validate_controls(
+                    filtered,
+                    lambda ex: f"{m_map.get(ex['module_id'], {}).get('nom', 'Inconnu')} — {exam_formation(ex)} — {ex['date_heure']}",
+                    {"validated": True}, key="chef_val")
     # ----------------------------------------------------------------
     # Administrateur exams  : génération + optimisation + détection
     # ----------------------------------------------------------------
     elif role in ("Admin", "Administrateur examens"):
+        if st.query_params.get("diag") == "1":
+            show_query_diagnostics()
+            st.stop()
         st.title("🛠️ Service Planification — Administrateur examens")
         
         # --- INITIALISATION DES ETATS (Session State) ---
@@ -1322,6 +3204,24 @@ elif st.session_state.step == "dashboard":
 
         start_str = start_date.strftime("%Y-%m-%d")
         end_str = end_date.strftime("%Y-%m-%d")
+        slots_str = st.text_input("Créneaux horaires (HH:MM, séparés par des virgules)",
+                                  value=", ".join(DEFAULT_EXAM_SLOTS), key="admin_gen_slots")
+        engine_labels = {"greedy": "Glouton (premier créneau libre)", "dsatur": "DSatur (coloration du graphe de conflits)",
+                         "cpsat": "Solveur exact CP-SAT (optimal ou écart prouvé)",
+                         "multistart": "Multi-départs aléatoires (meilleur de N essais en parallèle)"}
+        gen_engine = st.selectbox("Moteur de génération", list(GENERATION_ENGINES),
+                                  format_func=lambda k: engine_labels.get(k, k), key="admin_gen_engine")
+        gen_options = None
+        if gen_engine == "cpsat":
+            gen_options = {"time_limit": st.number_input("Limite de temps du solveur (secondes)", min_value=5,
+                                                         max_value=600, value=int(CPSAT_TIME_LIMIT), key="admin_gen_limit")}
+        elif gen_engine == "multistart":
+            col_m1, col_m2 = st.columns(2)
+            with col_m1:
+                ms_runs = st.number_input("Nombre d'essais", min_value=1, max_value=256, value=MULTISTART_RUNS, key="admin_gen_runs")
+            with col_m2:
+                ms_seed = st.number_input("Seed de départ (0 = aléatoire)", min_value=0, value=0, step=1, key="admin_gen_seed")
+            gen_options = {"runs": int(ms_runs), "seed": int(ms_seed) or None}
 
         # Configuration des filtres d'affichage
         excluded_keys = {'etudiants_1parjour', 'profs_3parjour', 'surveillances_par_prof', 'conflits_par_dept'}
@@ -1336,23 +3236,60 @@ elif st.session_state.step == "dashboard":
                 if start_str > end_str:
                     st.error("La date de début doit être inférieure à la date de fin.")
                 else:
-                    with st.spinner("Calcul de l'emploi du temps optimal..."):
-                        report, conflicts = generate_timetable(start_str, end_str, force=False)
+                    start_job("generate", generate_timetable, start_str, end_str, force=False, slots=slots_str,
+                              engine=gen_engine, engine_options=gen_options,
+                              label=f"Génération EDT {start_str} → {end_str} ({engine_labels.get(gen_engine, gen_engine)})")
+            gen_job = poll_job("generate")
+            if gen_job:
+                if gen_job.status == "done":
+                    report, conflicts = gen_job.result
+                    if report.get('error'):
+                        st.error(report['error'])
+                    else:
                         st.session_state.last_report = report
                         st.session_state.last_conflicts = conflicts
                         st.session_state.simulation_done = True
+                elif gen_job.status == "failed":
+                    st.error(f"Génération en erreur : {gen_job.error}")
+                else:
+                    st.info("Génération annulée.")
             if st.session_state.simulation_done:
                 rep = st.session_state.last_report
                 conf = st.session_state.last_conflicts
                 
-                st.info(f"**Résultat simulation :** {rep.get('scheduled_count',0)} créneaux planifiables.")
+                if rep.get('cache_hit'):
+                    st.caption("Résultat identique déjà calculé : repris du cache.")
+                st.info(f"**Résultat simulation :** {rep.get('scheduled_count',0)} créneaux planifiables "
+                        f"sur {rep.get('days_used',0)} jour(s) ({engine_labels.get(rep.get('engine'), rep.get('engine'))}).")
+                solver_stats = rep.get('engine_stats') or {}
+                if solver_stats.get('fallback'):
+                    st.warning(f"Solveur exact indisponible : {solver_stats['fallback']}. Résultat du moteur glouton.")
+                elif 'solver_objective' in solver_stats:
+                    gap = solver_stats['gap']
+                    st.caption(f"CP-SAT : {solver_stats['status']} en {solver_stats['wall_time']:.1f}s "
+                               f"(+ {solver_stats['build_seconds']:.1f}s de construction) ; planning enregistrable : "
+                               f"{solver_stats['objective']} module(s) pour une borne de {solver_stats['bound']:.0f}, "
+                               + (f"écart d'optimalité {gap:.1%}" if gap is not None
+                                  else "borne du modèle dépassée par le placement final")
+                               + f" ; {solver_stats['moved_after_solve']} "
+                               f"module(s) hors de leur créneau résolu (salle ou surveillant), "
+                               f"{solver_stats['placed_after_solve']} placé(s) ensuite.")
+                elif 'best_seed' in solver_stats:
+                    st.caption(f"Multi-départs : {solver_stats['runs']} essais sur {solver_stats['workers']} processus, "
+                               + (f"meilleur seed {solver_stats['best_seed']} (1 essai avec ce seed pour le rejouer)."
+                                  if solver_stats['best_seed'] is not None else "le glouton déterministe reste le meilleur."))
                 
                 st.warning("⚠️ Ces données ne sont pas encore enregistrées.")
                 if st.button("✅ SAUVEGARDER DANS LA BASE", type="primary", use_container_width=True):
+                    # enregistre exactement l'aperçu affiché (résultat en cache), sans recalcul
                     with st.spinner("Écriture dans Supabase..."):
-                        final_rep, final_conf = generate_timetable(start_str, end_str, force=True)
-                        if final_rep.get('created_slots', 0) > 0:
+                        final_rep, final_conf = commit_timetable(rep.get('result_key'))
+                        if final_rep.get('error'):
+                            st.error(final_rep['error'])
+                        elif final_rep.get('created_slots', 0) > 0:
                             st.success(f"🚀 Succès ! {final_rep.get('created_slots',0)} examens enregistrés.")
+                            if final_conf.get('insert_error'):
+                                st.warning(f"Enregistrement partiel : {final_conf['insert_error']}")
                             st.session_state.simulation_done = False 
                         else:
                             st.error(f"Erreur lors de l'insertion : {final_conf.get('insert_error', 'Inconnue')}")
@@ -1360,28 +3297,84 @@ elif st.session_state.step == "dashboard":
         with col_a2:
             st.write("### ⚡ Optimisation & Analyse")
             # OPTIMISATION
+            col_o1, col_o2 = st.columns(2)
+            with col_o1:
+                opt_budget = st.number_input("Budget (secondes)", min_value=1, max_value=120, value=5, key="opt_budget")
+            with col_o2:
+                opt_seed = st.number_input("Seed (0 = aléatoire)", min_value=0, value=0, step=1, key="opt_seed")
             if st.button("🪄 Optimiser les ressources", use_container_width=True):
-                with st.spinner("Optimisation en cours..."):
-                    report_opt, conflicts_opt = optimize_resources(start_str, end_str)
-                    st.success("Optimisation terminée (simulation).")
-                    for k, v in report_opt.get('improvements', {}).items():
-                        st.write(f"- {k.replace('_',' ')} : {v}")
+                # on part de la simulation affichée si elle existe, sinon des examens en base
+                sim_schedule = st.session_state.last_report.get('schedule') if st.session_state.simulation_done else None
+                source = "simulation" if sim_schedule is not None else "base"
+                start_job("optimize", optimize_resources, start_str, end_str, time_budget=float(opt_budget),
+                          seed=int(opt_seed) or None, schedule=sim_schedule, slots=slots_str,
+                          label=f"Optimisation {start_str} → {end_str} ({source})", meta={"source": source})
+            opt_job = poll_job("optimize")
+            if opt_job:
+                if opt_job.status == "done":
+                    report_opt, conflicts_opt = opt_job.result
+                    if report_opt.get('error'):
+                        st.error(report_opt['error'])
+                    else:
+                        report_opt['source'] = opt_job.meta['source']
+                        st.session_state.last_optimization = report_opt
+                elif opt_job.status == "failed":
+                    st.error(f"Optimisation en erreur : {opt_job.error}")
+                else:
+                    st.info("Optimisation annulée.")
+            report_opt = st.session_state.get("last_optimization")
+            if report_opt:
+                st.success(f"Optimisation terminée ({report_opt['source']}) : {report_opt['iterations']} itérations, "
+                           f"seed {report_opt['seed']}.")
+                for k, v in report_opt.get('improvements', {}).items():
+                    st.write(f"- {k.replace('_',' ')} : {v}")
+                st.write(f"- conflits avant : {report_opt['conflicts_initial']}")
+                st.write(f"- conflits après : {report_opt['conflicts_best']}")
+                if report_opt['source'] == "base" and report_opt['changes']:
+                    if st.button(f"💾 Appliquer {len(report_opt['changes'])} modification(s)", key="opt_apply"):
+                        by_id = {e['id']: e for e in report_opt['schedule']}
+                        errors = 0
+                        try:
+                            with db_transaction():   # PostgreSQL direct : tout ou rien
+                                for ch in report_opt['changes']:
+                                    e = by_id.get(ch['id'])
+                                    res = db_update("examens", {"prof_id": e['prof_id'], "salle_id": e['salle_id'],
+                                                                "date_heure": e['date_heure'].isoformat()}, {"id": ch['id']})
+                                    errors += bool(res.get('error'))
+                        except Exception as e:
+                            st.error(f"Aucune modification enregistrée (transaction annulée) : {e}")
+                        else:
+                            if errors:
+                                st.error(f"{errors} mise(s) à jour en erreur.")
+                            else:
+                                st.success("Modifications enregistrées.")
+                        st.session_state.last_optimization = None
 
             # DÉTECTION SIMPLE
             if st.button("🕵️ Détecter les conflits", use_container_width=True):
-                with st.spinner("Analyse des conflits existants..."):
-                    conflicts_det = detect_conflicts(start_str, end_str)
-                    visible_conflicts = {k: v for k, v in conflicts_det.items() if k not in excluded_keys}
-                    total = sum(len(v) for v in visible_conflicts.values())
-                    
-                    if total == 0:
-                        st.success("Aucun conflit majeur détecté sur cette période.")
-                    else:
-                        st.warning(f"{total} conflits détectés.")
-                        for k, rows in visible_conflicts.items():
-                            if rows:
-                                with st.expander(f"Détails : {k.replace('_',' ')} ({len(rows)})"):
-                                    show_table_safe(rows)
+                start_job("detect", detect_conflicts, start_str, end_str,
+                          label=f"Détection des conflits {start_str} → {end_str}")
+            det_job = poll_job("detect")
+            if det_job:
+                if det_job.status == "done":
+                    st.session_state.last_detection = det_job.result
+                elif det_job.status == "failed":
+                    st.error(f"Détection en erreur : {det_job.error}")
+            conflicts_det = st.session_state.get("last_detection")
+            if conflicts_det is not None:
+                visible_conflicts = {k: v for k, v in conflicts_det.items() if k not in excluded_keys}
+                total = sum(len(v) for v in visible_conflicts.values())
+
+                if total == 0:
+                    st.success("Aucun conflit majeur détecté sur cette période.")
+                else:
+                    st.warning(f"{total} conflits détectés.")
+                    for k, rows in visible_conflicts.items():
+                        if rows:
+                            with st.expander(f"Détails : {k.replace('_',' ')} ({len(rows)})"):
+                                show_table_safe(rows, key=f"detect_{k}")
+
+        show_recent_jobs(("generate", "optimize", "detect"))
 
         if st.session_state.simulation_done:
             st.divider()
@@ -1411,42 +3404,68 @@ elif st.session_state.step == "dashboard":
 
         # KPIs globaux
         if st.button("Afficher KPIs globaux (30 derniers jours)"):
-            tic = time.time()
-            kpis = compute_kpis()
-            duration = time.time() - tic
+            start_job("kpis", compute_kpis, label="KPIs globaux (30 derniers jours)")
+        kpi_job = poll_job("kpis")
+        if kpi_job:
+            if kpi_job.status == "done":
+                st.session_state.last_kpis = (kpi_job.result, kpi_job.elapsed())
+            elif kpi_job.status == "failed":
+                st.error(f"Calcul des KPIs en erreur : {kpi_job.error}")
+        if st.session_state.get("last_kpis"):
+            kpis, duration = st.session_state.last_kpis
             st.success(f"✅ Calcul des KPIs terminé en {duration:.1f} secondes.")
             st.metric("Taux d'utilisation salles (30j) %", f"{kpis['taux_utilisation_salles_pct']}%")
             st.write(f"- Nombre séances sur {kpis['periode_days']} jours : {kpis['nb_seances']}")
-            st.write(f"- Total salles : {kpis['total_salles']}0")
+            st.write(f"- Total salles : {kpis['total_salles']}")
             st.write(f"- Conflit estimé ratio (%) : {kpis['conflit_estime_ratio_pct']}")
             st.markdown("Top profs (minutes surveillées):")
-            show_table_safe(kpis['top_profs_minutes'])
+            show_table_safe(kpis['top_profs_minutes'], key="kpi_top_profs")
+            st.caption("Agrégats calculés par la base (fonctions SQL)." if kpis.get('source') == "sql"
+                       else "Agrégats calculés dans l'application (fonctions SQL non installées).")
+        show_recent_jobs(("kpis",))
 
         st.markdown("### Taux de conflits par département")
-        st.success("Aucun conflit départemental.")
+        if not st.session_state.get("last_kpis"):
+            st.info("Lancez le calcul des KPIs pour afficher les conflits par département.")
+        else:
+            par_dept = st.session_state.last_kpis[0].get('conflits_par_dept') or []
+            if any(r['conflits_estimes'] for r in par_dept):
+                show_table_safe(par_dept, key="kpi_par_dept")
+            else:
+                st.success("Aucun conflit départemental.")
 
 
 
         st.markdown("### Validation finale de l'EDT généré par l'admin")
         st.write("La validation finale permet d'officialiser l'emploi du temps généré par le service planification.")
-        pending_final = db_select("examens", "*")
-        pending_final = [e for e in pending_final if e.get('validated') == 1 and (e.get('final_validated') in (None, 0))]
+        page_size = st.selectbox("Examens par page", [PENDING_FINAL_PAGE_SIZE, 100, 500], key="final_val_page_size")
+        pages = st.session_state.setdefault("final_val_pages", [None])   # clé de début de chaque page visitée
+        try:
+            pending_final, next_key, total = fetch_pending_final_page_counted(pages[-1], page_size)
+        except DBReadError as e:
+            st.error(f"Lecture impossible : {e}")
+            pending_final, next_key, total = [], None, 0
+        if not pending_final and len(pages) > 1:   # dernière page entièrement validée
+            pages.pop()
+            st.rerun()
         if pending_final:
-            st.write(f"{len(pending_final)} examen(s) en attente de validation finale.")
-            for ex in pending_final:
-                m = db_get_one("modules", "nom", eq={"id": ex.get('module_id')})
-                l = db_get_one("lieu_examen", "nom", eq={"id": ex.get('salle_id')})
-                cols = st.columns([4,2,2,1])
-                cols[0].write(f"{m.get('nom') if m else '-'} — {ex.get('date_heure')}")
-                cols[1].write(f"Salle: {l.get('nom') if l else '-'}")
-                cols[2].write(f"Durée: {ex.get('duree_minutes')}min")
-                if cols[3].button(f"Valider final", key=f"final_val_{ex['id']}"):
-                    res = db_update("examens", {"final_validated": 1}, {"id": ex['id']})
-                    if res.get('error'):
-                        st.error(f"Erreur final validation: {res['error']}")
-                    else:
-                        st.success(f"Examen {ex['id']} validé définitivement.")
-                        st.experimental_rerun()
+            st.write(f"{total} examen(s) en attente de validation finale — page {len(pages)}.")
+            show_table_safe([{
+                "Module": ex['module_nom'] or '-',
+                "Date": ex['date_heure'] or "non planifiée",
+                "Salle": ex['salle_nom'] or '-',
+                "Durée": f"{ex['duree_minutes']}min",
+            } for ex in pending_final], key="final_val_table")
+            bulk_validate_controls(
+                pending_final, lambda ex: f"{ex['module_nom'] or '-'} — {ex['date_heure'] or 'non planifiée'}",
+                {"final_validated": 1}, key="final_val", verb="Valider final", all_label="toute la page")
+            c1, c2 = st.columns(2)
+            if c1.button("⬅️ Page précédente", key="final_val_prev", disabled=len(pages) == 1):
+                pages.pop()
+                st.rerun()
+            if c2.button("Page suivante ➡️", key="final_val_next", disabled=next_key is None):
+                pages.append(next_key)
+                st.rerun()
         else:
             st.info("Aucun examen en attente de validation finale.")
 
@@ -0,0 +1,232 @@
+"""
+Verification-code outbox for app.py (signup and password reset emails).
+
+Kept out of app.py, which is a Streamlit script, so the outbox can be imported on its own and
+driven against a local SMTP server (see tests/test_code_outbox.py).
+"""
+import hashlib
+import os
+import queue
+import secrets
+import smtplib
+import string
+import threading
+import time
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+CODE_TTL = timedelta(minutes=3)                # validité d'un code
+CODE_RESEND_INTERVAL = timedelta(minutes=1)    # par adresse email
+CODE_MAX_CHECKS = 5                            # codes incorrects acceptés avant d'invalider le code
+SMTP_SENDERS = 2           # threads d'envoi, chacun garde sa connexion SMTP ouverte
+SMTP_RETRIES = 3
+SMTP_RETRY_BACKOFF = 2.0   # secondes, doublé à chaque nouvelle tentative
+SMTP_IDLE_SECONDS = 60     # connexion fermée après ce délai sans envoi
+
+@dataclass(frozen=True)
+class SmtpConfig:
+    """SMTP account for the codes (host, port, user, password, sender, use_ssl, starttls, timeout).
+    No credential is built in: host, user and password must come from the settings or from
+    SMTP_HOST / SMTP_USER / SMTP_PASSWORD..., otherwise the outbox refuses to issue codes."""
+    host: str = ""
+    port: int = 465
+    user: str = ""
+    password: str = ""
+    sender: str = ""           # défaut : user
+    use_ssl: bool = True
+    starttls: bool = False
+    timeout: float = 10.0
+
+    @classmethod
+    def from_settings(cls, settings: Optional[Mapping[str, Any]] = None,
+                      environ: Mapping[str, str] = os.environ) -> "SmtpConfig":
+        """Settings (st.secrets["smtp"]) first, then SMTP_<FIELD> environment variables."""
+        values = dict(settings or {})
+        for f in fields(cls):
+            raw = environ.get(f"SMTP_{f.name.upper()}")
+            if f.name in values or raw is None:
+                continue
+            if isinstance(f.default, bool):
+                values[f.name] = raw.strip().lower() in ("1", "true", "yes", "on")
+            else:
+                values[f.name] = type(f.default)(raw)
+        return cls(**values)
+
+    @property
+    def missing(self) -> List[str]:
+        """Required settings left empty; the outbox stays closed while this is not empty."""
+        return [name for name in ("host", "user", "password") if not getattr(self, name)]
+
+    @property
+    def from_addr(self) -> str:
+        return self.sender or self.user
+
+@dataclass
+class VerificationCode:
+    """One issued code; only its hash is kept. `status`: queued -> sent | failed (send abandoned,
+    or CODE_MAX_CHECKS wrong codes entered). `attempts` counts sends, `checks` wrong codes."""
+    email: str
+    purpose: str
+    code_hash: str
+    created_at: datetime
+    subject: str
+    status: str = "queued"
+    attempts: int = 0
+    error: Optional[str] = None
+    sent_at: Optional[datetime] = None
+    checks: int = 0
+
+    @property
+    def expired(self) -> bool:
+        return not code_is_valid(self.created_at)
+
+def _hash_code(email: str, purpose: str, code: str) -> str:
+    return hashlib.sha256(f"{purpose}:{email}:{code}".encode()).hexdigest()
+
+class CodeOutbox:
+    """Verification codes for signup / password reset, shared by every session of the process.
+    request_code() stores the code (hashed, with its expiry) and queues the email; the page
+    returns at once. Sender threads each keep one SMTP connection open between messages
+    (reconnecting when the server dropped it), retry failed sends with backoff and close
+    the connection after SMTP_IDLE_SECONDS without mail. With an incomplete SmtpConfig no
+    sender is started and every code is recorded as failed, so nothing can be verified.
+    """
+    def __init__(self, config: SmtpConfig, senders: int = SMTP_SENDERS):
+        self.config = config
+        self._codes: Dict[Tuple[str, str], VerificationCode] = {}   # (purpose, email) -> dernier code
+        self._last_request: Dict[str, datetime] = {}                 # email -> dernière demande
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Tuple[VerificationCode, str]]" = queue.Queue()
+        if config.missing:
+            print(f"[smtp] configuration incomplète ({', '.join(config.missing)}) : envoi des codes désactivé")
+            return
+        for i in range(senders):
+            threading.Thread(target=self._sender_loop, name=f"smtp-sender-{i}", daemon=True).start()
+
+    def request_code(self, email: str, purpose: str, subject: str, message: str) -> Tuple[bool, Optional[VerificationCode]]:
+        """Issue a new code and queue its email. Returns (False, current code) when the address
+        asked for one less than CODE_RESEND_INTERVAL ago."""
+        now = datetime.now()
+        if self.config.missing:
+            entry = VerificationCode(email, purpose, "", now, subject, status="failed",
+                                     error=f"SMTP non configuré ({', '.join(self.config.missing)})")
+            with self._lock:
+                self._codes[(purpose, email)] = entry
+            return True, entry
+        code = ''.join(secrets.choice(string.digits) for _ in range(6))
+        with self._lock:
+            self._purge(now)
+            if not can_resend(self._last_request.get(email)):
+                return False, self._codes.get((purpose, email))
+            entry = VerificationCode(email, purpose, _hash_code(email, purpose, code), now, subject)
+            self._codes[(purpose, email)] = entry
+            self._last_request[email] = now
+        self._queue.put((entry, message + f"\n\nCode : {code}"))
+        return True, entry
+
+    def verify(self, email: str, purpose: str, code: str) -> str:
+        """"ok", "expired", "locked" or "invalid" for the latest code issued to email for purpose.
+        A code is single-use: "ok" removes it. After CODE_MAX_CHECKS wrong codes it is marked
+        failed and answers "locked" until a new one is requested."""
+        with self._lock:
+            entry = self._codes.get((purpose, email))
+            if entry is None:
+                return "invalid"
+            if entry.checks >= CODE_MAX_CHECKS:
+                return "locked"
+            if entry.expired:
+                return "expired"
+            if entry.code_hash and secrets.compare_digest(entry.code_hash, _hash_code(email, purpose, code or "")):
+                del self._codes[(purpose, email)]
+                return "ok"
+            entry.checks += 1
+            if entry.checks < CODE_MAX_CHECKS:
+                return "invalid"
+            entry.status, entry.error = "failed", f"{CODE_MAX_CHECKS} codes incorrects, code invalidé"
+            return "locked"
+
+    def status(self, email: str, purpose: str) -> Optional[VerificationCode]:
+        with self._lock:
+            return self._codes.get((purpose, email))
+
+    def _purge(self, now: datetime):
+        keep_for = max(CODE_TTL, CODE_RESEND_INTERVAL)
+        for key in [k for k, e in self._codes.items() if now - e.created_at > keep_for]:
+            del self._codes[key]
+        for email in [m for m, t in self._last_request.items() if now - t > keep_for]:
+            del self._last_request[email]
+
+    def _connect(self) -> smtplib.SMTP:
+        cfg = self.config
+        if cfg.use_ssl:
+            conn = smtplib.SMTP_SSL(cfg.host, cfg.port, timeout=cfg.timeout)
+        else:
+            conn = smtplib.SMTP(cfg.host, cfg.port, timeout=cfg.timeout)
+            if cfg.starttls:
+                conn.starttls()
+        if cfg.user and cfg.password:
+            conn.login(cfg.user, cfg.password)
+        return conn
+
+    @staticmethod
+    def _close(conn: Optional[smtplib.SMTP]) -> None:
+        if conn is not None:
+            try:
+                conn.quit()
+            except Exception:
+                conn.close()
+        return None
+
+    def _message(self, entry: VerificationCode, body: str) -> str:
+        msg = MIMEMultipart()
+        msg['From'] = self.config.from_addr
+        msg['To'] = entry.email
+        msg['Subject'] = entry.subject
+        msg.attach(MIMEText(body, "plain"))
+        return msg.as_string()
+
+    def _sender_loop(self):
+        conn = None
+        while True:
+            try:
+                entry, body = self._queue.get(timeout=SMTP_IDLE_SECONDS)
+            except queue.Empty:
+                conn = self._close(conn)
+                continue
+            delay = SMTP_RETRY_BACKOFF
+            while entry.status == "queued":
+                if entry.expired:
+                    entry.status, entry.error = "failed", "code expiré avant l'envoi"
+                    break
+                reused = conn is not None
+                entry.attempts += 1
+                try:
+                    if conn is None:
+                        conn = self._connect()
+                    conn.sendmail(self.config.from_addr, [entry.email], self._message(entry, body))
+                    entry.status, entry.sent_at, entry.error = "sent", datetime.now(), None
+                except Exception as e:
+                    conn = self._close(conn)
+                    entry.error = f"{type(e).__name__}: {e}"
+                    if reused:          # connexion gardée fermée côté serveur : on réessaie tout de suite
+                        entry.attempts -= 1
+                    elif entry.attempts >= SMTP_RETRIES:
+                        entry.status = "failed"
+                        print(f"[smtp] envoi à {entry.email} abandonné : {entry.error}")
+                    else:
+                        time.sleep(delay)
+                        delay *= 2
+            self._queue.task_done()
+
+def can_resend(last_time):
+    if last_time is None:
+        return True
+    return datetime.now() - last_time >= CODE_RESEND_INTERVAL
+
+def code_is_valid(sent_time):
+    if sent_time is None:
+        return False
+    return datetime.now() - sent_time <= CODE_TTL
@@ -0,0 +1,185 @@
+"""
+Direct PostgreSQL access for app.py (optional: [postgres] dsn in the Streamlit secrets).
+
+Kept out of app.py, which is a Streamlit script, so the backend can be imported on its own and
+exercised against a local PostgreSQL server (see tests/test_pg_backend.py).
+"""
+import io
+import json
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from psycopg2 import sql
+
+PG_POOL_MAX = 8              # connexions ouvertes au plus
+PG_INSERT_PAGE = 1000        # lignes par instruction INSERT ... VALUES (execute_values)
+PG_COPY_MIN_ROWS = 5000      # à partir de là, insertion par COPY (sans renvoi des lignes)
+
+class PgBackend:
+    """Direct PostgreSQL access used by db_select / db_insert / db_update when a DSN is set.
+    Connections come from a psycopg2 ThreadedConnectionPool; every call runs in its own
+    transaction unless it happens inside `transaction()`, which pins one connection to the
+    thread until the block ends (commit, or rollback on exception). Timestamps are returned
+    as ISO strings, like PostgREST, so callers see the same row shapes on both backends.
+    """
+    _TIMESTAMP_OIDS = (1082, 1083, 1114, 1184, 1266)   # date, time, timestamp(tz), timetz
+
+    def __init__(self, dsn: str, maxconn: int = PG_POOL_MAX):
+        as_iso = psycopg2.extensions.new_type(
+            self._TIMESTAMP_OIDS, "ISO_TEXT", lambda v, cur: None if v is None else v.replace(" ", "T", 1))
+        psycopg2.extensions.register_type(as_iso)
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, dsn)
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, "conn", None) is not None:   # imbriquée : même transaction
+            yield self._local.conn
+            return
+        conn = self.pool.getconn()
+        self._local.conn = conn
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self.pool.putconn(conn)
+
+    def in_transaction(self) -> bool:
+        return getattr(self._local, "conn", None) is not None
+
+    def defer_write(self, table: str):
+        """Remember a table written inside the open transaction (caches are dropped after it ends)."""
+        self._local.written = getattr(self._local, "written", set()) | {table}
+
+    def take_written(self) -> set:
+        written, self._local.written = getattr(self._local, "written", set()), set()
+        return written
+
+    @contextmanager
+    def _cursor(self):
+        with self.transaction() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                yield cur
+
+    @staticmethod
+    def handles(select: str) -> bool:
+        """Plain column lists only: PostgREST embeddings ("modules(nom)") stay on PostgREST."""
+        return "(" not in select
+
+    @staticmethod
+    def _where(eq, in_, gte, lt):
+        parts, params = [], []
+        for k, v in (eq or {}).items():
+            parts.append(sql.SQL("{} = %s").format(sql.Identifier(k)))
+            params.append(v)
+        for k, values in (in_ or {}).items():
+            parts.append(sql.SQL("{} = ANY(%s)").format(sql.Identifier(k)))
+            params.append(list(values))
+        for op, filters in ((">=", gte), ("<", lt)):
+            for k, v in (filters or {}).items():
+                if v is not None:
+                    parts.append(sql.SQL("{} " + op + " %s").format(sql.Identifier(k)))
+                    params.append(v)
+        if not parts:
+            return sql.SQL(""), params
+        return sql.SQL(" WHERE ") + sql.SQL(" AND ").join(parts), params
+
+    def select(self, table: str, select: str = "*", eq=None, order_cols=(), limit=None, offset=None,
+               in_=None, gte=None, lt=None) -> List[Dict[str, Any]]:
+        cols = [c.strip() for c in select.split(",") if c.strip()]
+        columns = sql.SQL("*") if "*" in cols else sql.SQL(", ").join(map(sql.Identifier, cols))
+        where, params = self._where(eq, in_, gte, lt)
+        query = sql.SQL("SELECT {} FROM {}").format(columns, sql.Identifier(table)) + where
+        if order_cols:
+            query += sql.SQL(" ORDER BY ") + sql.SQL(", ").join(
+                sql.SQL("{} DESC" if desc else "{}").format(sql.Identifier(c)) for c, desc in order_cols)
+        if limit:
+            query += sql.SQL(" LIMIT %s")
+            params.append(limit)
+        if offset:
+            query += sql.SQL(" OFFSET %s")
+            params.append(offset)
+        with self._cursor() as cur:
+            cur.execute(query, params)
+            return [dict(r) for r in cur.fetchall()]
+
+    @staticmethod
+    def _columns(rows: List[Dict[str, Any]]) -> List[str]:
+        cols = list(rows[0])
+        seen = set(cols)
+        for r in rows[1:]:
+            for k in r:
+                if k not in seen:
+                    seen.add(k)
+                    cols.append(k)
+        return cols
+
+    def insert(self, table: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Multi-row INSERT ... VALUES pages (execute_values), inserted rows returned."""
+        cols = self._columns(rows)
+        query = sql.SQL("INSERT INTO {} ({}) VALUES %s RETURNING *").format(
+            sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, cols)))
+        with self._cursor() as cur:
+            return [dict(r) for r in psycopg2.extras.execute_values(
+                cur, query.as_string(cur), [tuple(r.get(c) for c in cols) for r in rows],
+                page_size=PG_INSERT_PAGE, fetch=True)]
+
+    @staticmethod
+    def _csv_field(value: Any) -> str:
+        """One COPY CSV field: None is the unquoted empty field (NULL), every other non-numeric
+        value is quoted, so an empty string stays an empty string."""
+        if value is None:
+            return ""
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (int, float)):
+            return repr(value)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        return '"' + str(value).replace('"', '""') + '"'
+
+    def copy_rows(self, table: str, rows: List[Dict[str, Any]]) -> int:
+        """COPY ... FROM STDIN (CSV) for large loads; returns the number of rows written."""
+        cols = self._columns(rows)
+        buf = io.StringIO()
+        for r in rows:
+            buf.write(",".join(self._csv_field(r.get(c)) for c in cols))
+            buf.write("\n")
+        buf.seek(0)
+        query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, cols)))
+        with self._cursor() as cur:
+            cur.copy_expert(query.as_string(cur), buf)
+            return cur.rowcount
+
+    def update(self, table: str, values: Dict[str, Any], eq=None, in_=None) -> List[Dict[str, Any]]:
+        where, params = self._where(eq, in_, None, None)
+        if not params:   # comme PostgREST : pas d'UPDATE sur toute la table
+            raise ValueError(f"UPDATE {table} sans filtre refusé")
+        assignments = sql.SQL(", ").join(sql.SQL("{} = %s").format(sql.Identifier(k)) for k in values)
+        query = sql.SQL("UPDATE {} SET {}").format(sql.Identifier(table), assignments) + where + sql.SQL(" RETURNING *")
+        with self._cursor() as cur:
+            cur.execute(query, list(values.values()) + params)
+            return [dict(r) for r in cur.fetchall()]
+
+    def query(self, query: str, params=()) -> List[Dict[str, Any]]:
+        """Read-only SQL for joins PostgREST expresses as embeddings."""
+        with self._cursor() as cur:
+            cur.execute(query, params)
+            return [dict(r) for r in cur.fetchall()]
+
+    def call(self, fn: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """SELECT * FROM fn(name => value, ...): the set-returning functions PostgREST exposes as RPC."""
+        args = sql.SQL(", ").join(sql.SQL("{} => %s").format(sql.Identifier(k)) for k in params)
+        query = sql.SQL("SELECT * FROM {}({})").format(sql.Identifier(fn), args)
+        with self._cursor() as cur:
+            cur.execute(query, list(params.values()))
+            return [dict(r) for r in cur.fetchall()]
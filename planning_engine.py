@@ -0,0 +1,579 @@
+"""
+Timetable generation core shared by app.py and the multi-start worker processes.
+
+The snapshot type, the placement indexes, the greedy engine and the schedule cost model have
+no Streamlit or database dependency, so planning_pool.py can import them in a worker started
+with "forkserver"/"spawn" (app.py itself is a Streamlit script and cannot be imported there).
+"""
+import bisect
+import hashlib
+import heapq
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, datetime, time as dtime
+from functools import cached_property
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+ExamWindow = Tuple[Optional[str], Optional[str]]   # bornes ISO [gte, lt) sur examens.date_heure
+
+def _parse_datetime(val):
+    if val is None:
+        return None
+    if isinstance(val, str):
+        try:
+            return datetime.fromisoformat(val)
+        except Exception:
+            try:
+                return datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
+            except Exception:
+                return None
+    if isinstance(val, datetime):
+        return val
+    return None
+
+@dataclass(frozen=True)
+class PlanningSnapshot:
+    """Immutable view of the scheduling dataset plus prebuilt indexes.
+    Rows are shared between readers and must be treated as read-only (copy before editing).
+    `version` is the PLANNING_STORE data version the snapshot was loaded at.
+    """
+    version: int
+    loaded_at: float
+    exams: Tuple[Dict[str, Any], ...]
+    inscriptions: Tuple[Dict[str, Any], ...]
+    modules: Mapping[Any, Dict[str, Any]]
+    students: Mapping[Any, Dict[str, Any]]
+    profs: Mapping[Any, Dict[str, Any]]
+    rooms: Mapping[Any, Dict[str, Any]]
+    formations: Mapping[Any, Dict[str, Any]]
+    departements: Mapping[Any, Dict[str, Any]]
+    exams_by_id: Mapping[Any, Dict[str, Any]]
+    exam_dt: Mapping[Any, Optional[datetime]]          # exam id -> date_heure parsée
+    module_students: Mapping[Any, Tuple[Any, ...]]     # module id -> etudiant ids
+    module_exams: Mapping[Any, Tuple[Any, ...]]        # module id -> exam ids
+    module_ins_count: Mapping[Any, int]
+    window: ExamWindow = (None, None)                  # exams limited to this date_heure window
+    inscription_matrix: Optional["StudentModuleMatrix"] = None   # None sans numpy/scipy
+
+    def age_seconds(self) -> float:
+        return time.monotonic() - self.loaded_at
+
+    @cached_property
+    def exam_defaults(self) -> Tuple[Dict[Any, Any], Dict[Any, int]]:
+        """(module id -> prof id, module id -> duration) taken from the first existing exam of
+        each module that has one; the generator reuses them for new exams."""
+        default_prof, default_duration = {}, {}
+        for e in self.exams:
+            mid = e.get('module_id')
+            if mid and e.get('prof_id'):
+                default_prof.setdefault(mid, e.get('prof_id'))
+            if mid and e.get('duree_minutes'):
+                try:
+                    default_duration.setdefault(mid, int(e.get('duree_minutes')))
+                except Exception:
+                    pass
+        return default_prof, default_duration
+
+    @cached_property
+    def _generation_inputs_digest(self) -> bytes:
+        h = hashlib.sha256()
+        for name, rows in (("modules", self.modules), ("rooms", self.rooms), ("profs", self.profs),
+                           ("formations", self.formations), ("departements", self.departements)):
+            h.update(name.encode())
+            h.update(repr([tuple(r.items()) for r in rows.values()]).encode())
+        h.update(repr(list(self.module_students.items())).encode())
+        h.update(repr([tuple(d.items()) for d in self.exam_defaults]).encode())
+        return h.digest()
+
+    def generation_fingerprint(self, window: ExamWindow) -> str:
+        """sha256 of what generate_timetable reads for window: modules and who is enrolled in
+        them, rooms, profs, formations, departements, the exams inside window and the per-module
+        prof/duration defaults of the others. Student profiles and `version`/`loaded_at` are left
+        out, so a signup or an edit outside the window keeps cached generations valid. The
+        window-independent part is hashed once per snapshot."""
+        gte, lt = window
+        lo = _parse_datetime(gte) if gte else None
+        hi = _parse_datetime(lt) if lt else None
+        exams = [tuple(e.items()) for e in self.exams
+                 if (dt := self.exam_dt.get(e.get('id'))) and (lo is None or dt >= lo) and (hi is None or dt < hi)]
+        h = hashlib.sha256(self._generation_inputs_digest)
+        h.update(repr(exams).encode())
+        return h.hexdigest()
+
+@dataclass(frozen=True)
+class StudentModuleMatrix:
+    """Inscriptions as a CSR matrix (students x modules), one stored 1 per inscription."""
+    csr: Any
+    student_ids: List[Any]            # row -> etudiant id
+    module_pos: Mapping[Any, int]     # module id -> column
+
+def _exam_indexes(exams) -> Dict[str, Any]:
+    exam_dt = {}
+    module_exams = defaultdict(list)
+    for e in exams:
+        exam_dt[e.get('id')] = _parse_datetime(e.get('date_heure'))
+        module_exams[e.get('module_id')].append(e.get('id'))
+    return {
+        'exams': tuple(exams),
+        'exams_by_id': MappingProxyType({e.get('id'): e for e in exams}),
+        'exam_dt': MappingProxyType(exam_dt),
+        'module_exams': MappingProxyType({k: tuple(v) for k, v in module_exams.items()}),
+    }
+
+def _module_student_bitsets(module_students: Mapping[Any, Tuple[Any, ...]]) -> Dict[Any, int]:
+    """module id -> Python int with one bit per enrolled student (bit positions shared by all
+    modules), so "any student busy?" is a single AND and "mark all busy" a single OR."""
+    student_bit: Dict[Any, int] = {}
+    for studs in module_students.values():
+        for sid in studs:
+            student_bit.setdefault(sid, len(student_bit))
+    nbytes = (len(student_bit) + 7) // 8
+    bitsets = {}
+    for mid, studs in module_students.items():
+        buf = bytearray(nbytes)
+        for sid in studs:
+            b = student_bit[sid]
+            buf[b >> 3] |= 1 << (b & 7)
+        bitsets[mid] = int.from_bytes(buf, "little")
+    return bitsets
+
+PROF_DAILY_LIMIT = 3     # surveillances max par professeur et par jour
+DEFAULT_EXAM_SLOTS = ("08:30", "11:00", "14:00", "16:30")
+DEFAULT_EXAM_DURATION = 120
+
+def parse_exam_slots(slots) -> List[dtime]:
+    """"08:30, 14:00" (or a list of "HH:MM" / time) -> sorted list of distinct times.
+    Raises ValueError on an empty or malformed grid."""
+    items = slots.split(",") if isinstance(slots, str) else list(slots or [])
+    times = set()
+    for item in items:
+        if isinstance(item, dtime):
+            times.add(item)
+        elif str(item).strip():
+            times.add(datetime.strptime(str(item).strip(), "%H:%M").time())
+    if not times:
+        raise ValueError("aucun créneau horaire")
+    return sorted(times)
+
+def _slot_span_masks(slot_times: List[dtime], duration: int) -> List[int]:
+    """For each start slot i, the bitmask of grid slots overlapped by [slot_i, slot_i + duration).
+    Slot j covers [slot_j, slot_j+1), the last one runs until the end of the day."""
+    starts = [t.hour * 60 + t.minute for t in slot_times]
+    masks = []
+    for i, start in enumerate(starts):
+        mask = 1 << i
+        for j in range(i + 1, len(starts)):
+            if starts[j] >= start + duration:
+                break
+            mask |= 1 << j
+        masks.append(mask)
+    return masks
+
+class RoomSlotIndex:
+    """Room availability per day for the generators.
+    Rooms are sorted by capacity; each day has a segment tree whose leaves hold the bitmask of
+    grid slots a room already hosts and whose inner nodes hold the AND of their children.
+    A subtree where every room is busy on a requested slot is pruned, so "smallest free room
+    with capacity >= n" costs O(log R) for single-slot exams.
+    """
+    def __init__(self, rooms, n_slots: int):
+        self.rooms = sorted(({'id': r['id'], 'capacite': int(r.get('capacite') or 0)} for r in rooms),
+                            key=lambda r: r['capacite'])
+        self.caps = [r['capacite'] for r in self.rooms]
+        self.full_mask = (1 << n_slots) - 1
+        self.size = 1
+        while self.size < max(1, len(self.rooms)):
+            self.size *= 2
+        self._trees: Dict[date, List[int]] = {}
+
+    def _tree(self, day: date) -> List[int]:
+        tree = self._trees.get(day)
+        if tree is None:
+            tree = [0] * (2 * self.size)
+            for i in range(len(self.rooms), self.size):   # feuilles de bourrage : toujours pleines
+                tree[self.size + i] = self.full_mask
+            for i in range(self.size - 1, 0, -1):
+                tree[i] = tree[2 * i] & tree[2 * i + 1]
+            self._trees[day] = tree
+        return tree
+
+    def _first_free(self, tree, node, lo_node, hi_node, lo, mask) -> Optional[int]:
+        if hi_node <= lo or tree[node] & mask:
+            return None
+        if hi_node - lo_node == 1:
+            return lo_node
+        mid = (lo_node + hi_node) // 2
+        found = self._first_free(tree, 2 * node, lo_node, mid, lo, mask)
+        if found is None:
+            found = self._first_free(tree, 2 * node + 1, mid, hi_node, lo, mask)
+        return found
+
+    def _last_free(self, tree, node, lo_node, hi_node, mask) -> Optional[int]:
+        if tree[node] & mask:
+            return None
+        if hi_node - lo_node == 1:
+            return lo_node
+        mid = (lo_node + hi_node) // 2
+        found = self._last_free(tree, 2 * node + 1, mid, hi_node, mask)
+        if found is None:
+            found = self._last_free(tree, 2 * node, lo_node, mid, mask)
+        return found
+
+    def find(self, day: date, min_capacity: int, mask: int) -> Optional[int]:
+        """Position of the smallest room with capacity >= min_capacity free on every slot of mask.
+        When no room is large enough at all, the largest free room is returned instead."""
+        if not self.rooms:
+            return None
+        tree = self._tree(day)
+        lo = bisect.bisect_left(self.caps, min_capacity)
+        if lo < len(self.rooms):
+            return self._first_free(tree, 1, 0, self.size, lo, mask)
+        return self._last_free(tree, 1, 0, self.size, mask)
+
+    def is_free(self, day: date, pos: int, mask: int) -> bool:
+        return not (self._tree(day)[self.size + pos] & mask)
+
+    def book(self, day: date, pos: int, mask: int):
+        tree = self._tree(day)
+        node = self.size + pos
+        tree[node] |= mask
+        node //= 2
+        while node:
+            tree[node] = tree[2 * node] & tree[2 * node + 1]
+            node //= 2
+
+class ProfLoadIndex:
+    """Invigilator load index for the generators.
+    Min-heaps of (total load, list position, prof id) per department and overall, updated
+    lazily (an entry is stale once the prof's load moved on), plus per-day counts and the
+    set of profs already at the daily limit. Picks are O(log P) amortized; ties go to the
+    first prof in list order, as with min() over the list. `mask` arguments are bitmasks of
+    the day's grid slots, so a prof is never given two overlapping exams.
+    """
+    def __init__(self, profs, daily_limit: int = PROF_DAILY_LIMIT):
+        self.daily_limit = daily_limit
+        self.load: Dict[Any, int] = {}
+        self._pos: Dict[Any, int] = {}
+        self._dept: Dict[Any, Any] = {}
+        self._heaps: Dict[Any, list] = defaultdict(list)
+        self._all: list = []
+        self.day_count: Dict[Tuple[Any, date], int] = defaultdict(int)
+        self.full_days: Dict[date, set] = defaultdict(set)   # day -> profs at the limit
+        self.slot_busy: Dict[Tuple[Any, date], int] = defaultdict(int)   # (prof, day) -> slot mask
+        for pos, p in enumerate(profs):
+            pid = p['id']
+            self.load[pid] = 0
+            self._pos[pid] = pos
+            self._dept[pid] = p.get('dept_id')
+            self._heaps[p.get('dept_id')].append((0, pos, pid))
+            self._all.append((0, pos, pid))
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+        heapq.heapify(self._all)
+
+    def _heap(self, dept_id):
+        heap = self._heaps.get(dept_id) if dept_id else None
+        return heap if heap else self._all
+
+    def _top(self, heap):
+        while heap and heap[0][0] != self.load[heap[0][2]]:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def least_loaded(self, dept_id=None) -> Optional[Any]:
+        """Least loaded prof of dept_id (everyone if the dept has no prof), ignoring the daily limit."""
+        return self._top(self._heap(dept_id))
+
+    def is_available(self, pid, day: date, mask: int = 0) -> bool:
+        return pid not in self.full_days.get(day, ()) and not (self.slot_busy.get((pid, day), 0) & mask)
+
+    def least_loaded_available(self, day: date, dept_id=None, mask: int = 0) -> Optional[Any]:
+        """Least loaded prof still under the daily limit on day and free on mask (entries of
+        unavailable profs are set aside then pushed back)."""
+        heap = self._heap(dept_id)
+        skipped = []
+        found = None
+        while True:
+            pid = self._top(heap)
+            if pid is None:
+                break
+            if self.is_available(pid, day, mask):
+                found = pid
+                break
+            skipped.append(heapq.heappop(heap))
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return found
+
+    def assign(self, pid, day: date, mask: int = 0):
+        self.slot_busy[(pid, day)] |= mask
+        self.day_count[(pid, day)] += 1
+        if self.day_count[(pid, day)] >= self.daily_limit:
+            self.full_days[day].add(pid)
+        if pid not in self._pos:   # prof par défaut absent de la liste : seulement compté
+            return
+        self.load[pid] += 1
+        entry = (self.load[pid], self._pos[pid], pid)
+        heapq.heappush(self._heaps[self._dept[pid]], entry)
+        heapq.heappush(self._all, entry)
+
+class _ExamPlacer:
+    """Placement state shared by the generation engines: student bitsets per day, the room/slot
+    index and the prof load index. `place` books the first slot of a day that fits a module.
+    With `rng`, rooms of equal capacity and equally loaded profs are tried in random order."""
+
+    def __init__(self, snap: PlanningSnapshot, slot_times: List[dtime], rng: Optional[random.Random] = None):
+        self.snap = snap
+        self.slot_times = slot_times
+        rooms, profs = list(snap.rooms.values()), list(snap.profs.values())
+        if rng is not None:
+            rng.shuffle(rooms)
+            rng.shuffle(profs)
+        self.room_index = RoomSlotIndex(rooms, len(slot_times))
+        self.prof_load = ProfLoadIndex(profs, daily_limit=PROF_DAILY_LIMIT)
+        self.module_bits = _module_student_bitsets(snap.module_students)
+        self.day_busy = defaultdict(int)            # day -> bitset of students already examined that day
+        self.span_masks = {}                        # duration -> [slot mask per start slot]
+
+        # existing examens used to detect prior assignments/durations
+        self.default_prof, self.default_duration = snap.exam_defaults
+
+    def duration(self, mid) -> int:
+        return self.default_duration.get(mid, DEFAULT_EXAM_DURATION)
+
+    def masks(self, duration: int) -> List[int]:
+        if duration not in self.span_masks:
+            self.span_masks[duration] = _slot_span_masks(self.slot_times, duration)
+        return self.span_masks[duration]
+
+    def place(self, mod: Dict[str, Any], d: date, slots: Optional[List[int]] = None) -> Optional[Dict[str, Any]]:
+        """Book `mod` on day `d`, in the first slot that fits (slot indexes tried in `slots` order)."""
+        mid = mod.get('id')
+        studs_bits = self.module_bits.get(mid, 0)
+        # check students free (single AND on the bitsets)
+        if studs_bits & self.day_busy[d]:
+            return None
+
+        nb_ins = self.snap.module_ins_count.get(mid, 0)
+        duration = self.duration(mid)
+        masks = self.masks(duration)
+
+        for i in (range(len(self.slot_times)) if slots is None else slots):
+            slot_time, mask = self.slot_times[i], masks[i]
+            # smallest free room for these slots
+            room_pos = self.room_index.find(d, nb_ins, mask)
+            if room_pos is None:
+                continue
+            chosen_room = self.room_index.rooms[room_pos]
+
+            # choose prof
+            chosen_prof = self.default_prof.get(mid)
+            if chosen_prof is None:
+                formation_id = mod.get('formation_id')
+                dept_id = self.snap.formations.get(formation_id, {}).get('dept_id') if formation_id else None
+                chosen_prof = self.prof_load.least_loaded(dept_id)
+            # ensure prof daily limit (<3) and no overlapping surveillance
+            if chosen_prof is None:
+                continue
+            if not self.prof_load.is_available(chosen_prof, d, mask):
+                chosen_prof = self.prof_load.least_loaded_available(d, mask=mask)
+                if chosen_prof is None:
+                    continue
+
+            # mark busy
+            self.day_busy[d] |= studs_bits
+            self.prof_load.assign(chosen_prof, d, mask)
+            self.room_index.book(d, room_pos, mask)
+            return {
+                "module_id": mid,
+                "module_nom": mod.get('nom'),
+                "prof_id": chosen_prof,
+                "salle_id": chosen_room['id'],
+                "date_heure": datetime.combine(d, slot_time),
+                "duree_minutes": duration,
+                "nb_inscrits": nb_ins
+            }
+        return None
+
+
+def _schedule_greedy(placer: _ExamPlacer, days: List[date], rng: Optional[random.Random] = None,
+                     progress: Optional[Callable[..., None]] = None):
+    """Modules by descending enrollment, each on the first day/slot that fits.
+    With `rng` (multi-start variants): enrollments are jittered by +/-15% for the order and
+    each module tries the slots in a random order. `progress(modules_places=n)` is called after
+    each module (app.py passes job_progress, which also raises on cancellation)."""
+    module_ins_count = placer.snap.module_ins_count
+    n_slots = len(placer.slot_times)
+    if rng is None:
+        key = lambda m: -module_ins_count.get(m['id'], 0)
+    else:
+        key = lambda m: -module_ins_count.get(m['id'], 0) * rng.uniform(0.85, 1.15)
+    scheduled, unscheduled = [], []
+    for mod in sorted(placer.snap.modules.values(), key=key):
+        slot_order = None
+        if rng is not None:
+            slot_order = rng.sample(range(n_slots), n_slots)
+        for d in days:
+            entry = placer.place(mod, d, slot_order)
+            if entry:
+                scheduled.append(entry)
+                break
+        else:
+            unscheduled.append(mod)
+        if progress is not None:
+            progress(modules_places=len(scheduled))
+    return scheduled, unscheduled, {}
+
+OPTIM_WEIGHTS = {
+    'etudiants_1parjour': 10.0,   # examens en trop pour un étudiant sur une même journée
+    'profs_3parjour': 10.0,       # surveillance au-delà de PROF_DAILY_LIMIT
+    'salles_capacite': 20.0,      # examen dans une salle trop petite
+    'chevauchements': 50.0,       # paires d'examens simultanés dans une salle / pour un prof
+    'places_perdues': 0.001,      # places vides (usage des salles)
+}
+
+def _minutes(dt: datetime) -> int:
+    return dt.hour * 60 + dt.minute
+
+class _ScheduleState:
+    """Mutable schedule with the conflict terms of detect_conflicts kept up to date.
+    remove(i) / add(i) adjust the counters for one exam and return the cost delta, so a move
+    is scored in O(students of the module + exams sharing its room/prof that day)."""
+    def __init__(self, items, module_students, rooms, prof_limit: int = PROF_DAILY_LIMIT):
+        self.items = items                    # dicts: module_id, prof_id, salle_id, day, start, dur, nb
+        self.module_students = module_students
+        self.capacity = {rid: int(r.get('capacite') or 0) for rid, r in rooms.items()}
+        self.prof_limit = prof_limit
+        self.stud_day = defaultdict(int)      # (etudiant, jour) -> nb examens
+        self.prof_day = defaultdict(int)      # (prof, jour) -> nb examens
+        self.by_room = defaultdict(set)       # (jour, salle) -> positions
+        self.by_prof = defaultdict(set)       # (jour, prof) -> positions
+        self.terms = dict.fromkeys(OPTIM_WEIGHTS, 0.0)
+        self.cost = 0.0
+        for i in range(len(items)):
+            self.add(i)
+
+    def _bump(self, term: str, amount: float) -> float:
+        self.terms[term] += amount
+        delta = OPTIM_WEIGHTS[term] * amount
+        self.cost += delta
+        return delta
+
+    def _overlaps(self, i: int, j: int) -> bool:
+        a, b = self.items[i], self.items[j]
+        return a['start'] < b['start'] + b['dur'] and b['start'] < a['start'] + a['dur']
+
+    def _apply(self, i: int, sign: int) -> float:
+        it = self.items[i]
+        day, room, prof = it['day'], it['salle_id'], it['prof_id']
+        delta = 0.0
+        stud_day = self.stud_day
+        excess = 0   # examens au-delà du premier de la journée, par étudiant
+        for sid in self.module_students.get(it['module_id'], ()):
+            key = (sid, day)
+            count = stud_day[key]
+            if sign > 0:
+                excess += count >= 1
+            else:
+                excess += count >= 2
+            stud_day[key] = count + sign
+        if excess:
+            delta += self._bump('etudiants_1parjour', sign * excess)
+        if prof is not None:
+            before = self.prof_day[(prof, day)]
+            self.prof_day[(prof, day)] = before + sign
+            over = int(before + sign > self.prof_limit) - int(before > self.prof_limit)
+            if over:
+                delta += self._bump('profs_3parjour', over)
+        for index, key in ((self.by_room, (day, room)), (self.by_prof, (day, prof))):
+            if key[1] is None:
+                continue
+            bucket = index[key]
+            if sign < 0:
+                bucket.discard(i)
+            clash = sum(1 for j in bucket if j != i and self._overlaps(i, j))
+            if clash:
+                delta += self._bump('chevauchements', sign * clash)
+            if sign > 0:
+                bucket.add(i)
+        cap = self.capacity.get(room)
+        if cap is not None:
+            if it['nb'] > cap:
+                delta += self._bump('salles_capacite', sign)
+            else:
+                delta += self._bump('places_perdues', sign * (cap - it['nb']))
+        return delta
+
+    def remove(self, i: int) -> float:
+        return self._apply(i, -1)
+
+    def add(self, i: int) -> float:
+        return self._apply(i, +1)
+
+    def move(self, i: int, **changes) -> float:
+        """Apply changes to item i and return the cost delta."""
+        delta = self.remove(i)
+        self.items[i].update(changes)
+        return delta + self.add(i)
+
+    def breakdown(self) -> Dict[str, float]:
+        return {k: round(v, 3) for k, v in self.terms.items()}
+
+def _items_from_exams(exams, exam_dt, module_ins_count) -> List[Dict[str, Any]]:
+    items = []
+    for e in exams:
+        dt = exam_dt.get(e.get('id')) or _parse_datetime(e.get('date_heure'))
+        if not dt:
+            continue
+        items.append({
+            'id': e.get('id'),
+            'module_id': e.get('module_id'),
+            'module_nom': e.get('module_nom'),
+            'prof_id': e.get('prof_id'),
+            'salle_id': e.get('salle_id'),
+            'day': dt.date(),
+            'start': _minutes(dt),
+            'dur': int(e.get('duree_minutes') or 0),
+            'nb': module_ins_count.get(e.get('module_id'), 0),
+        })
+    return items
+
+def _exams_from_items(items) -> List[Dict[str, Any]]:
+    return [{
+        'id': it.get('id') if it.get('id') is not None else -(k + 1),   # ids temporaires pour l'aperçu
+        'module_id': it['module_id'],
+        'module_nom': it.get('module_nom'),
+        'prof_id': it['prof_id'],
+        'salle_id': it['salle_id'],
+        'date_heure': datetime.combine(it['day'], dtime(hour=it['start'] // 60, minute=it['start'] % 60)),
+        'duree_minutes': it['dur'],
+        'nb_inscrits': it['nb'],
+    } for k, it in enumerate(items)]
+
+def _multistart_runner(payload: Dict[str, Any]):
+    """Rebuild a generation snapshot from a _generation_payload dict and return run(seed),
+    one randomized greedy variant scored with the optimizer's terms."""
+    module_students = payload["module_students"]
+    snap = PlanningSnapshot(
+        version=0, loaded_at=time.monotonic(), inscriptions=(),
+        modules=MappingProxyType(payload["modules"]), students=MappingProxyType({}),
+        profs=MappingProxyType(payload["profs"]), rooms=MappingProxyType(payload["rooms"]),
+        formations=MappingProxyType(payload["formations"]), departements=MappingProxyType({}),
+        module_students=MappingProxyType(module_students),
+        module_ins_count=MappingProxyType({k: len(v) for k, v in module_students.items()}),
+        **_exam_indexes(payload["exams"]),
+    )
+    slot_times, days = payload["slot_times"], payload["days"]
+
+    def run(seed):
+        rng = None if seed is None else random.Random(seed)
+        scheduled, unscheduled, _ = _schedule_greedy(_ExamPlacer(snap, slot_times, rng), days, rng)
+        state = _ScheduleState(_items_from_exams(scheduled, {}, snap.module_ins_count),
+                               snap.module_students, snap.rooms)
+        conflicts = sum(v for k, v in state.terms.items() if k != 'places_perdues')
+        return {"seed": seed, "scheduled": len(scheduled), "conflicts": conflicts, "cost": state.cost,
+                "schedule": scheduled, "unscheduled": [m['id'] for m in unscheduled]}
+    return run
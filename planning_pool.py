@@ -0,0 +1,24 @@
+"""
+Process-pool entry points for the multi-start timetable generator.
+
+app.py is a Streamlit script: worker processes cannot import it, so the functions the pool
+pickles by reference live here. The pool is started with "forkserver" (or "spawn"), never
+"fork": workers import this module and planning_engine, receive the planning input once as the
+serialized payload app.py already built, and rebuild their runner from it.
+"""
+import pickle
+
+from planning_engine import _multistart_runner
+
+_RUN = None
+
+
+def init_worker(payload: bytes):
+    """Pool initializer: deserialize the shared input once and build this worker's runner."""
+    global _RUN
+    _RUN = _multistart_runner(pickle.loads(payload))
+
+
+def run(seed):
+    """One randomized generation for `seed` (see planning_engine._multistart_runner)."""
+    return _RUN(seed)
@@ -0,0 +1,38 @@
+-- Recherche d'identité pour la connexion et la réinitialisation du mot de passe (app.py : find_identities).
+-- Une seule requête (filtre email poussé dans chaque branche, via les index ci-dessous) au lieu
+-- d'une requête par table de rôle. Ne renvoie que (role, table_name, user_id), jamais d'email ni de
+-- mot de passe ; `priorite` reproduit l'ordre de recherche de la connexion.
+-- Fonction et non vue : une vue du schéma public serait lisible en entier avec la clé anon
+-- (droits du propriétaire, sans RLS), mots de passe compris.
+-- Sans cette fonction, app.py utilise un index email -> (rôle, table, id) gardé en mémoire.
+
+DROP VIEW IF EXISTS v_identites;
+
+CREATE INDEX IF NOT EXISTS etudiants_email_idx ON etudiants (email);
+CREATE INDEX IF NOT EXISTS professeurs_email_idx ON professeurs (email);
+CREATE INDEX IF NOT EXISTS chefs_departement_email_idx ON chefs_departement (email);
+CREATE INDEX IF NOT EXISTS administrateurs_email_idx ON administrateurs (email);
+CREATE INDEX IF NOT EXISTS vice_doyens_email_idx ON vice_doyens (email);
+
+-- Comptes de p_email (et de p_password s'il est donné), par ordre de priorité.
+CREATE OR REPLACE FUNCTION find_identity(p_email text, p_password text DEFAULT NULL)
+RETURNS TABLE (role text, table_name text, user_id int)
+LANGUAGE sql STABLE SECURITY DEFINER SET search_path = public AS $$
+    SELECT i.role, i.table_name, i.user_id
+    FROM (
+              SELECT id AS user_id, 'Etudiant'::text AS role, 'etudiants'::text AS table_name, 1 AS priorite
+              FROM etudiants WHERE email = p_email AND (p_password IS NULL OR password = p_password)
+    UNION ALL SELECT id, 'Professeur', 'professeurs', 2
+              FROM professeurs WHERE email = p_email AND (p_password IS NULL OR password = p_password)
+    UNION ALL SELECT id, 'Chef', 'chefs_departement', 3
+              FROM chefs_departement WHERE email = p_email AND (p_password IS NULL OR password = p_password)
+    UNION ALL SELECT id, 'Admin', 'administrateurs', 4
+              FROM administrateurs WHERE email = p_email AND (p_password IS NULL OR password = p_password)
+    UNION ALL SELECT id, 'Vice-doyen', 'vice_doyens', 5
+              FROM vice_doyens WHERE email = p_email AND (p_password IS NULL OR password = p_password)
+    ) i
+    ORDER BY i.priorite, i.user_id
+$$;
+
+REVOKE ALL ON FUNCTION find_identity(text, text) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION find_identity(text, text) TO anon, authenticated, service_role;
@@ -0,0 +1,120 @@
+-- Agrégats KPI / conflits calculés côté serveur (appelés par app.py via db_rpc).
+-- À exécuter une fois dans l'éditeur SQL Supabase (ou psql). Les fonctions renvoient
+-- quelques dizaines de lignes au lieu du planning complet ; app.py retombe sur le calcul
+-- Python si elles ne sont pas installées.
+--
+-- Fenêtre : [p_start, p_end) sur examens.date_heure, NULL = borne ouverte.
+-- Les règles reprennent celles de detect_conflicts (app.py) :
+--   * chevauchement : même jour, [début, fin) qui se recoupent, même salle ou même prof,
+--     une ligne par paire d'examens ;
+--   * conflit départemental : paire comptée pour le département du prof du premier examen ;
+--   * capacité : inscrits au module > capacité de la salle.
+
+-- Nombre d'inscrits par module.
+CREATE OR REPLACE VIEW v_module_inscrits AS
+SELECT module_id, count(*)::int AS inscrits
+FROM inscriptions
+GROUP BY module_id;
+
+-- Examens de la fenêtre avec leur intervalle horaire.
+CREATE OR REPLACE FUNCTION kpi_exam_intervals(p_start timestamp, p_end timestamp)
+RETURNS TABLE (id int, module_id int, prof_id int, salle_id int, debut timestamp, fin timestamp)
+LANGUAGE sql STABLE AS $$
+    SELECT e.id, e.module_id, e.prof_id, e.salle_id, e.date_heure::timestamp,
+           e.date_heure::timestamp + make_interval(mins => coalesce(e.duree_minutes, 0))
+    FROM examens e
+    WHERE e.date_heure IS NOT NULL
+      AND (p_start IS NULL OR e.date_heure >= p_start)
+      AND (p_end IS NULL OR e.date_heure < p_end)
+$$;
+
+-- Occupation des salles : séances de la fenêtre et nombre de salles.
+CREATE OR REPLACE FUNCTION kpi_room_utilization(p_start timestamp, p_end timestamp)
+RETURNS TABLE (total_salles int, nb_seances int)
+LANGUAGE sql STABLE AS $$
+    SELECT (SELECT count(*) FROM lieu_examen)::int,
+           (SELECT count(*) FROM kpi_exam_intervals(p_start, p_end))::int
+$$;
+
+-- Minutes de surveillance par prof (les p_limit plus chargés).
+CREATE OR REPLACE FUNCTION kpi_prof_minutes(p_start timestamp, p_end timestamp, p_limit int DEFAULT 10)
+RETURNS TABLE (nom text, email text, minutes_surv int)
+LANGUAGE sql STABLE AS $$
+    SELECT p.nom::text, p.email::text, coalesce(sum(extract(epoch FROM i.fin - i.debut) / 60), 0)::int
+    FROM professeurs p
+    LEFT JOIN kpi_exam_intervals(p_start, p_end) i ON i.prof_id = p.id
+    GROUP BY p.id, p.nom, p.email
+    ORDER BY 3 DESC, p.id
+    LIMIT p_limit
+$$;
+
+-- Paires d'examens qui se chevauchent (même salle ou même prof), id_1 < id_2.
+CREATE OR REPLACE FUNCTION kpi_overlap_pairs(p_start timestamp, p_end timestamp)
+RETURNS TABLE (examen_id_1 int, examen_id_2 int, prof_id int, motif text)
+LANGUAGE sql STABLE AS $$
+    WITH iv AS (SELECT * FROM kpi_exam_intervals(p_start, p_end))
+    SELECT a.id, b.id, a.prof_id,
+           concat_ws('+', CASE WHEN a.prof_id = b.prof_id THEN 'prof' END,
+                          CASE WHEN a.salle_id = b.salle_id THEN 'salle' END)
+    FROM iv a
+    JOIN iv b ON a.id < b.id
+             AND b.debut::date = a.debut::date
+             AND b.debut < a.fin AND a.debut < b.fin
+             AND (a.salle_id = b.salle_id OR a.prof_id = b.prof_id)
+$$;
+
+-- Conflits par département : examens surveillés, chevauchements, taux.
+CREATE OR REPLACE FUNCTION kpi_conflicts_by_dept(p_start timestamp, p_end timestamp)
+RETURNS TABLE (departement text, nb_examens int, conflits_estimes int, taux_conflits_pct numeric)
+LANGUAGE sql STABLE AS $$
+    WITH ex AS (
+        SELECT p.dept_id, count(*) AS n
+        FROM kpi_exam_intervals(p_start, p_end) i JOIN professeurs p ON p.id = i.prof_id
+        GROUP BY p.dept_id
+    ), cf AS (
+        SELECT p.dept_id, count(*) AS n
+        FROM kpi_overlap_pairs(p_start, p_end) o JOIN professeurs p ON p.id = o.prof_id
+        GROUP BY p.dept_id
+    )
+    SELECT d.nom::text, coalesce(ex.n, 0)::int, coalesce(cf.n, 0)::int,
+           CASE WHEN coalesce(ex.n, 0) > 0 THEN round(100.0 * coalesce(cf.n, 0) / ex.n, 1) ELSE 0 END
+    FROM departements d
+    LEFT JOIN ex ON ex.dept_id = d.id
+    LEFT JOIN cf ON cf.dept_id = d.id
+    WHERE ex.n IS NOT NULL OR cf.n IS NOT NULL
+    ORDER BY 4 DESC, d.nom
+$$;
+
+-- Examens dont la salle est trop petite pour les inscrits du module.
+CREATE OR REPLACE FUNCTION kpi_capacity_violations(p_start timestamp, p_end timestamp)
+RETURNS TABLE (examen_id int, salle text, capacite int, inscrits int)
+LANGUAGE sql STABLE AS $$
+    SELECT i.id, l.nom::text, coalesce(l.capacite, 0)::int, v.inscrits
+    FROM kpi_exam_intervals(p_start, p_end) i
+    JOIN lieu_examen l ON l.id = i.salle_id
+    JOIN v_module_inscrits v ON v.module_id = i.module_id
+    WHERE v.inscrits > coalesce(l.capacite, 0)
+    ORDER BY i.id
+$$;
+
+-- Compteurs de conflits (mêmes clés que compute_kpis()['conflits_summary']) + examens de la fenêtre.
+CREATE OR REPLACE FUNCTION kpi_conflicts_summary(p_start timestamp, p_end timestamp)
+RETURNS TABLE (nb_examens int, etudiants_1parjour int, profs_3parjour int, salles_capacite int,
+               chevauchements int, etudiants_chevauchement int)
+LANGUAGE sql STABLE AS $$
+    WITH iv AS (SELECT * FROM kpi_exam_intervals(p_start, p_end)),
+    stud AS (
+        SELECT s.etudiant_id, iv.id, iv.debut, iv.fin
+        FROM inscriptions s JOIN iv ON iv.module_id = s.module_id
+    )
+    SELECT
+        (SELECT count(*) FROM iv)::int,
+        (SELECT count(*) FROM (SELECT 1 FROM stud GROUP BY etudiant_id, debut::date HAVING count(*) > 1) t)::int,
+        (SELECT count(*) FROM (SELECT 1 FROM iv WHERE prof_id IS NOT NULL
+                               GROUP BY prof_id, debut::date HAVING count(*) > 3) t)::int,
+        (SELECT count(*) FROM kpi_capacity_violations(p_start, p_end))::int,
+        (SELECT count(*) FROM kpi_overlap_pairs(p_start, p_end))::int,
+        (SELECT count(*) FROM stud a JOIN stud b
+            ON a.etudiant_id = b.etudiant_id AND a.id < b.id
+           AND b.debut::date = a.debut::date AND b.debut < a.fin AND a.debut < b.fin)::int
+$$;
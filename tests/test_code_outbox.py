@@ -0,0 +1,170 @@
+"""CodeOutbox against a local aiosmtpd server (skipped when aiosmtpd is not installed)."""
+import re
+import socket
+import time
+
+import pytest
+
+pytest.importorskip("aiosmtpd")
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult, LoginPassword
+
+import code_outbox
+from code_outbox import CodeOutbox, SmtpConfig
+
+USER, PASSWORD = "planning@test.local", "test-password"
+
+
+class Mailbox:
+    def __init__(self):
+        self.messages = []
+        self.logins = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.rcpt_tos, envelope.content.decode()))
+        return "250 OK"
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data):
+        ok = isinstance(auth_data, LoginPassword) and (auth_data.login.decode(), auth_data.password.decode()) == (USER, PASSWORD)
+        self.logins.append(ok)
+        return AuthResult(success=ok)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalSmtp:
+    """aiosmtpd on a fixed local port, with AUTH (LOGIN/PLAIN) over plain TCP."""
+    def __init__(self):
+        self.box = Mailbox()
+        self.host, self.port = "127.0.0.1", _free_port()
+        self.controller = None
+
+    def start(self):
+        self.controller = Controller(self.box, hostname=self.host, port=self.port,
+                                     authenticator=self.box.authenticate, auth_require_tls=False)
+        self.controller.start()
+
+    def stop(self):
+        if self.controller is not None:
+            self.controller.stop()
+            self.controller = None
+
+    def config(self, **overrides):
+        settings = dict(host=self.host, port=self.port, user=USER, password=PASSWORD, use_ssl=False)
+        settings.update(overrides)
+        return SmtpConfig(**settings)
+
+
+@pytest.fixture
+def smtp_server():
+    server = LocalSmtp()
+    server.start()
+    yield server
+    server.stop()
+
+
+def _wait_status(outbox, email, purpose, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    entry = outbox.status(email, purpose)
+    while entry.status == "queued" and time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = outbox.status(email, purpose)
+    return entry
+
+
+def test_code_is_sent_and_verified(smtp_server):
+    box = smtp_server.box
+    outbox = CodeOutbox(smtp_server.config(), senders=1)
+
+    accepted, entry = outbox.request_code("a@gmail.com", "register", "Confirmation", "Votre code :")
+    assert accepted and entry.status == "queued"
+    assert _wait_status(outbox, "a@gmail.com", "register").status == "sent"
+    assert box.logins == [True]
+
+    rcpt, content = box.messages[0]
+    assert rcpt == ["a@gmail.com"]
+    code = re.search(r"Code : (\d{6})", content).group(1)
+    assert outbox.verify("a@gmail.com", "register", code) == "ok"
+    assert outbox.verify("a@gmail.com", "register", "000000" if code != "000000" else "111111") == "invalid"
+    assert outbox.verify("a@gmail.com", "reset", code) == "invalid"
+
+    accepted, _ = outbox.request_code("a@gmail.com", "register", "Confirmation", "Votre code :")
+    assert not accepted   # CODE_RESEND_INTERVAL
+
+
+def _sent_code(outbox, box, email, purpose):
+    accepted, _ = outbox.request_code(email, purpose, "S", "m")
+    assert accepted and _wait_status(outbox, email, purpose).status == "sent"
+    return re.search(r"Code : (\d{6})", box.messages[-1][1]).group(1)
+
+
+def test_code_is_single_use(smtp_server):
+    outbox = CodeOutbox(smtp_server.config(), senders=1)
+    code = _sent_code(outbox, smtp_server.box, "a@x.org", "reset")
+
+    assert outbox.verify("a@x.org", "reset", code) == "ok"
+    assert outbox.verify("a@x.org", "reset", code) == "invalid"
+    assert outbox.status("a@x.org", "reset") is None
+
+
+def test_code_locked_after_too_many_wrong_codes(smtp_server):
+    outbox = CodeOutbox(smtp_server.config(), senders=1)
+    code = _sent_code(outbox, smtp_server.box, "a@x.org", "register")
+    wrong = "000000" if code != "000000" else "111111"
+
+    verdicts = [outbox.verify("a@x.org", "register", wrong) for _ in range(code_outbox.CODE_MAX_CHECKS)]
+    assert verdicts == ["invalid"] * (code_outbox.CODE_MAX_CHECKS - 1) + ["locked"]
+    assert outbox.verify("a@x.org", "register", code) == "locked"
+    entry = outbox.status("a@x.org", "register")
+    assert entry.status == "failed" and entry.checks == code_outbox.CODE_MAX_CHECKS
+
+
+def test_reconnects_after_server_restart(smtp_server):
+    box = smtp_server.box
+    outbox = CodeOutbox(smtp_server.config(), senders=1)
+    outbox.request_code("a@x.org", "reset", "S", "m")
+    assert _wait_status(outbox, "a@x.org", "reset").status == "sent"
+
+    smtp_server.stop()
+    smtp_server.start()   # la connexion gardée par le sender est morte
+    outbox.request_code("b@x.org", "reset", "S", "m")
+    entry = _wait_status(outbox, "b@x.org", "reset")
+    assert entry.status == "sent" and entry.attempts == 1
+    assert len(box.messages) == 2
+
+
+def test_gives_up_after_retries(smtp_server, monkeypatch):
+    box = smtp_server.box
+    monkeypatch.setattr(code_outbox, "SMTP_RETRY_BACKOFF", 0.01)
+    smtp_server.stop()
+    outbox = CodeOutbox(smtp_server.config(), senders=1)
+
+    outbox.request_code("a@x.org", "reset", "S", "m")
+    entry = _wait_status(outbox, "a@x.org", "reset")
+    assert entry.status == "failed" and entry.attempts == code_outbox.SMTP_RETRIES
+    assert box.messages == []
+
+
+def test_missing_credentials_fail_closed(smtp_server):
+    box = smtp_server.box
+    outbox = CodeOutbox(smtp_server.config(password=""), senders=1)
+
+    accepted, entry = outbox.request_code("a@x.org", "register", "S", "m")
+    assert entry.status == "failed" and "password" in entry.error
+    assert outbox.verify("a@x.org", "register", "") == "invalid"
+    time.sleep(0.2)
+    assert box.messages == [] and box.logins == []
+
+
+def test_config_from_settings_and_environment():
+    assert SmtpConfig().missing == ["host", "user", "password"]
+
+    env = {"SMTP_HOST": "smtp.example.org", "SMTP_PORT": "587", "SMTP_USER": "env-user",
+           "SMTP_PASSWORD": "env-secret", "SMTP_USE_SSL": "false", "SMTP_STARTTLS": "1"}
+    cfg = SmtpConfig.from_settings({"user": "secrets-user"}, environ=env)
+    assert (cfg.host, cfg.port, cfg.user, cfg.password) == ("smtp.example.org", 587, "secrets-user", "env-secret")
+    assert (cfg.use_ssl, cfg.starttls, cfg.missing, cfg.from_addr) == (False, True, [], "secrets-user")
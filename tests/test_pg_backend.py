@@ -0,0 +1,89 @@
+"""PgBackend against a local PostgreSQL server.
+
+Uses TEST_POSTGRES_DSN when set, otherwise starts an embedded server with pgserver;
+skipped when neither is available.
+"""
+import os
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+from pg_backend import PgBackend
+
+
+@pytest.fixture(scope="module")
+def dsn(tmp_path_factory):
+    if os.environ.get("TEST_POSTGRES_DSN"):
+        yield os.environ["TEST_POSTGRES_DSN"]
+        return
+    pgserver = pytest.importorskip("pgserver")
+    server = pgserver.get_server(str(tmp_path_factory.mktemp("pgdata")), cleanup_mode="stop")
+    yield server.get_uri()
+    server.cleanup()
+
+
+@pytest.fixture
+def backend(dsn):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS examens_test")
+        cur.execute("CREATE TABLE examens_test (id serial PRIMARY KEY, module_id int, salle_id int,"
+                    " date_heure timestamp, nom text, validated boolean)")
+    conn.close()
+    return PgBackend(dsn)
+
+
+def test_copy_rows_keeps_nulls_and_empty_strings(backend):
+    rows = [
+        {"module_id": 1, "salle_id": None, "date_heure": None, "nom": None, "validated": None},
+        {"module_id": 2, "salle_id": 3, "date_heure": "2026-06-01T08:30:00", "nom": "", "validated": True},
+        {"module_id": None, "salle_id": 4, "date_heure": "2026-06-02T10:00:00",
+         "nom": 'Algèbre, "partiel"\nsession 1', "validated": False},
+    ]
+    assert backend.copy_rows("examens_test", rows) == 3
+
+    got = backend.select("examens_test", "module_id,salle_id,date_heure,nom,validated", order_cols=[("id", False)])
+    assert got == [
+        {"module_id": 1, "salle_id": None, "date_heure": None, "nom": None, "validated": None},
+        {"module_id": 2, "salle_id": 3, "date_heure": "2026-06-01T08:30:00", "nom": "", "validated": True},
+        {"module_id": None, "salle_id": 4, "date_heure": "2026-06-02T10:00:00",
+         "nom": 'Algèbre, "partiel"\nsession 1', "validated": False},
+    ]
+
+
+def test_update_without_filter_is_refused(backend):
+    backend.copy_rows("examens_test", [{"module_id": 1, "validated": False}, {"module_id": 2, "validated": False}])
+
+    with pytest.raises(ValueError):
+        backend.update("examens_test", {"validated": True})
+    with pytest.raises(ValueError):
+        backend.update("examens_test", {"validated": True}, eq={}, in_={})
+
+    assert [r["module_id"] for r in backend.update("examens_test", {"validated": True}, eq={"module_id": 2})] == [2]
+    assert backend.select("examens_test", "validated", order_cols=[("id", False)]) == [{"validated": False}, {"validated": True}]
+
+
+def test_find_identity_returns_accounts_without_credentials(dsn):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for role in ("anon", "authenticated", "service_role"):
+            cur.execute(f"DO $$ BEGIN CREATE ROLE {role}; EXCEPTION WHEN duplicate_object THEN NULL; END $$")
+        for table in ("etudiants", "professeurs", "chefs_departement", "administrateurs", "vice_doyens"):
+            cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+            cur.execute(f"CREATE TABLE {table} (id serial PRIMARY KEY, email text, password text)")
+        cur.execute("INSERT INTO vice_doyens (email, password) VALUES ('x@gmail.com', 'pw2')")
+        cur.execute("INSERT INTO administrateurs (email, password) VALUES ('x@gmail.com', 'pw')")
+        with open(os.path.join(os.path.dirname(__file__), "..", "sql", "identity_lookup.sql")) as f:
+            cur.execute(f.read())
+    conn.close()
+    backend = PgBackend(dsn)
+
+    both = backend.call("find_identity", {"p_email": "x@gmail.com", "p_password": None})
+    assert both == [{"role": "Admin", "table_name": "administrateurs", "user_id": 1},
+                    {"role": "Vice-doyen", "table_name": "vice_doyens", "user_id": 1}]
+    assert backend.call("find_identity", {"p_email": "x@gmail.com", "p_password": "pw2"}) == both[1:]
+    assert backend.call("find_identity", {"p_email": "x@gmail.com", "p_password": "bad"}) == []
+    assert backend.query("SELECT count(*) AS n FROM pg_views WHERE viewname = 'v_identites'") == [{"n": 0}]